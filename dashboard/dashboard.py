@@ -1,6 +1,18 @@
 import streamlit as st
 import pandas as pd
 import numpy as np
+from itertools import islice
+
+def stream2df(rows, batch_size:int=100000):
+    # build the DataFrame chunk by chunk instead of from one full list of dicts
+    rows = iter(rows)
+    frames = []
+    while True:
+        chunk = list(islice(rows, batch_size))
+        if not chunk:
+            break
+        frames.append(pd.DataFrame(chunk))
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
 
 neurodb = st.session_state.GLOBAL.neurodb
 
@@ -32,16 +44,13 @@ st.bar_chart(
 nodesTab, edgesTab, segsTab = st.tabs(["Nodes", "Edges", "Segs"]) 
 
 nodesTab.subheader("Nodes Table")
-NODES = neurodb.DB.read_nodes()
-df_nodes = pd.DataFrame(NODES)
+df_nodes = neurodb.DB.read_nodes_columnar(as_frame=True)
 nodesTab.dataframe(df_nodes)
 
 edgesTab.subheader("Edges Table")
-EDGES = neurodb.DB.read_edges()
-df_edges = pd.DataFrame(EDGES)
+df_edges = neurodb.DB.read_edges_columnar(as_frame=True)
 edgesTab.dataframe(df_edges)
 
 segsTab.subheader("Segs Table")
-SEGS = neurodb.DB.read_segs()
-df_segs = pd.DataFrame(SEGS)
+df_segs = stream2df(neurodb.DB.iter_segs())
 segsTab.dataframe(df_segs)
\ No newline at end of file
@@ -0,0 +1,17 @@
+from .benchmarks import SCALES, BENCHMARKS, run_benchmarks, save_results, load_results, compare_results
+from .synthetic import random_neurites, neurites_to_segs, render_volume, write_tif, write_zip_zarr, write_ims
+
+__all__ = [
+    'SCALES',
+    'BENCHMARKS',
+    'run_benchmarks',
+    'save_results',
+    'load_results',
+    'compare_results',
+    'random_neurites',
+    'neurites_to_segs',
+    'render_volume',
+    'write_tif',
+    'write_zip_zarr',
+    'write_ims',
+]
@@ -0,0 +1,43 @@
+import argparse
+import json
+
+from .benchmarks import SCALES, BENCHMARKS, run_benchmarks, save_results, load_results, compare_results
+
+'''
+    python -m neurodb.bench --scales small medium --out results.json
+    python -m neurodb.bench --compare base.json results.json
+'''
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m neurodb.bench', description='NeuroDB benchmarks on synthetic data')
+    parser.add_argument('--scales', nargs='+', default=['small'], choices=list(SCALES))
+    parser.add_argument('--only', nargs='+', default=None, choices=list(BENCHMARKS))
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', default=None, help='directory for the temporary databases and images')
+    parser.add_argument('--dj-config', default=None,
+                        help="json file with db_url, username, password (and db_name prefix) of a scratch datajoint server")
+    parser.add_argument('--out', default=None, help='json file to write the results to')
+    parser.add_argument('--compare', nargs=2, metavar=('BASE', 'NEW'), default=None,
+                        help='compare two result files instead of running')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        rows = compare_results(load_results(args.compare[0]), load_results(args.compare[1]))
+        for name, scale, params, old_mean, new_mean, ratio in rows:
+            detail = ' '.join(f'{k}={v}' for k, v in params.items())
+            print(f"{scale:>6} {name:<20} {detail:<50} {old_mean*1000:10.3f} -> {new_mean*1000:10.3f} ms  x{ratio:.2f}")
+        return
+
+    dj_config = None
+    if args.dj_config:
+        with open(args.dj_config) as f:
+            dj_config = json.load(f)
+    results = run_benchmarks(
+        scales=args.scales, only=args.only, repeat=args.repeat, seed=args.seed, workdir=args.workdir, dj_config=dj_config
+    )
+    if args.out:
+        save_results(results, args.out)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,285 @@
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+import numpy as np
+
+from ..src import NeuroDB
+from ..src.blockCache import BlockCache
+from ..src.imageReader import ImageReader
+from ..src.imageTranscode import transcode
+from ..script import sqlite2dj, dj2sqlite
+from .synthetic import random_neurites, neurites_to_segs, render_volume, write_tif, write_zip_zarr, write_ims
+
+'''
+    timings of the hot paths on synthetic data, written as json:
+        {'meta': {...}, 'results': [{'name', 'scale', 'params', 'stats'}]}
+    stats are in seconds: n, total, mean, min, p50, p95, max
+'''
+
+BENCH_FORMAT = 1
+
+SCALES = {
+    # neurons in a cube of extent voxels; volume: side of the image volume
+    # serial_connect: also time the serial connect_segs, which grows quadratically with the end nodes
+    'small': {'neurons': 20, 'extent': 256, 'volume': 128, 'serial_connect': True},
+    'medium': {'neurons': 200, 'extent': 1024, 'volume': 256, 'serial_connect': True},
+    'large': {'neurons': 2000, 'extent': 4096, 'volume': 512, 'serial_connect': False},
+}
+BENCHMARKS = (
+    'segs2db', 'init_graph', 'read_nid_within_roi', 'connect_segs', 'get_annotation_info', 'transfer', 'from_roi',
+)
+ROI_SIZES = (64, 128)
+
+def _stats(times:list):
+    times = np.asarray(times, dtype=np.float64)
+    return {
+        'n': int(len(times)),
+        'total': float(times.sum()),
+        'mean': float(times.mean()),
+        'min': float(times.min()),
+        'p50': float(np.percentile(times, 50)),
+        'p95': float(np.percentile(times, 95)),
+        'max': float(times.max()),
+    }
+
+def _quiet():
+    # the database layer reports progress on stdout
+    return contextlib.redirect_stdout(io.StringIO())
+
+def _time(fn, repeat:int=1, setup=None):
+    # stats of repeat calls of fn(); setup() runs untimed before every call
+    times = []
+    with _quiet():
+        for _ in range(repeat):
+            if setup is not None:
+                setup()
+            start = time.perf_counter()
+            fn()
+            times.append(time.perf_counter() - start)
+    return _stats(times)
+
+def _random_rois(rng, extent:int, size:int, count:int):
+    offsets = rng.integers(0, max(extent - size, 1), size=(count, 3))
+    return [[int(o) for o in offset] + [size]*3 for offset in offsets]
+
+def _meta(seed:int, scales:list):
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, timeout=5
+        ).stdout.strip() or None
+    except Exception:
+        commit = None
+    return {
+        'format': BENCH_FORMAT,
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'commit': commit,
+        'python': sys.version.split()[0],
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'seed': seed,
+        'scales': {scale: SCALES[scale] for scale in scales},
+    }
+
+
+class _Run():
+    def __init__(self, results:list, scale:str, verbose:bool):
+        self.results = results
+        self.scale = scale
+        self.verbose = verbose
+
+    def add(self, name:str, stats:dict, **params):
+        self.results.append({'name': name, 'scale': self.scale, 'params': params, 'stats': stats})
+        if self.verbose:
+            detail = ' '.join(f'{k}={v}' for k, v in params.items())
+            print(f"{self.scale:>6} {name:<20} {detail:<40} mean {stats['mean']*1000:10.3f} ms  (n={stats['n']})")
+
+    def skip(self, name:str, reason:str, **params):
+        self.results.append({'name': name, 'scale': self.scale, 'params': params, 'stats': None, 'skipped': reason})
+        if self.verbose:
+            print(f"{self.scale:>6} {name:<20} skipped: {reason}")
+
+
+def _bench_db(run:_Run, workdir:str, config:dict, segs:list, only:set, repeat:int, seed:int, dj_config:dict):
+    db_path = os.path.join(workdir, 'bench.db')
+    snapshot_dir = os.path.join(workdir, 'snapshots')
+    params = {'segs': len(segs), 'nodes': sum(len(seg['sampled_points']) for seg in segs)}
+
+    def _fresh():
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(db_path + suffix):
+                os.remove(db_path + suffix)
+        shutil.rmtree(snapshot_dir, ignore_errors=True)
+
+    def _segs2db(mode):
+        db = NeuroDB(db_path, snapshot=False)
+        db.segs2db(segs, bulk=mode != 'default', defer_indexes=mode == 'bulk_deferred')
+
+    # segs2db is always run, the other benchmarks need its database
+    modes = ('bulk', 'bulk_deferred', 'default') if 'segs2db' in only else ('default',)
+    for mode in modes:
+        stats = _time(lambda: _segs2db(mode), repeat=max(1, repeat//5), setup=_fresh)
+        if 'segs2db' in only:
+            run.add('segs2db', stats, mode=mode, **params)
+
+    if 'init_graph' in only:
+        def _init(backend, use_snapshot):
+            db = NeuroDB(db_path, graph_backend=backend, snapshot=use_snapshot, snapshot_dir=snapshot_dir)
+            db.init_graph()
+        for backend in ('networkx', 'csr'):
+            run.add('init_graph', _time(lambda: _init(backend, False), repeat=max(1, repeat//5)),
+                    backend=backend, snapshot='none', **params)
+            with _quiet():
+                _init(backend, True)
+            run.add('init_graph', _time(lambda: _init(backend, True), repeat=max(1, repeat//5)),
+                    backend=backend, snapshot='load', **params)
+
+    if 'read_nid_within_roi' in only:
+        with _quiet():
+            db = NeuroDB(db_path, snapshot=False)
+            # builds G and its GridIndex, which the first query would otherwise include
+            db.index
+        rng = np.random.default_rng(seed)
+        for size in ROI_SIZES:
+            rois = iter(_random_rois(rng, config['extent'], size, repeat))
+            run.add('read_nid_within_roi', _time(lambda: db.read_nid_within_roi(next(rois)), repeat=repeat),
+                    roi_size=size, **params)
+
+    if 'get_annotation_info' in only:
+        with _quiet():
+            db = NeuroDB(db_path, snapshot=False)
+            db.init_graph()
+        run.add('get_annotation_info', _time(db.get_annotation_info, repeat=1), cache='cold', **params)
+        run.add('get_annotation_info', _time(db.get_annotation_info, repeat=repeat), cache='warm', **params)
+
+    if 'transfer' in only:
+        if dj_config is None:
+            run.skip('transfer', 'no datajoint config, see --dj-config', **params)
+        else:
+            _bench_transfer(run, workdir, db_path, dj_config, params)
+
+    if 'connect_segs' in only:
+        # connect_segs changes the database, every run starts from a copy
+        work_path = os.path.join(workdir, 'connect.db')
+        def _copy():
+            # backup api, so pages still in the WAL file of the source are copied as well
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(work_path + suffix):
+                    os.remove(work_path + suffix)
+            src, dst = sqlite3.connect(db_path), sqlite3.connect(work_path)
+            try:
+                src.backup(dst)
+            finally:
+                src.close()
+                dst.close()
+        for num_workers in ((None,) if config['serial_connect'] else ()) + (os.cpu_count() or 1,):
+            def _connect():
+                db = NeuroDB(work_path, snapshot=False)
+                db.connect_segs(num_workers=num_workers)
+            run.add('connect_segs', _time(_connect, repeat=1, setup=_copy),
+                    num_workers=num_workers or 'serial', **params)
+
+def _bench_transfer(run:_Run, workdir:str, db_path:str, dj_config:dict, params:dict):
+    import datajoint as dj
+    db_name = f"{dj_config.get('db_name', 'neurodb_bench')}_{run.scale}_{int(time.time())}"
+    config = dict(dj_config, db_name=db_name)
+    back_path = os.path.join(workdir, 'back.db')
+    try:
+        ok = []
+        run.add('sqlite2dj', _time(lambda: ok.append(sqlite2dj(db_path, config))), **params)
+        run.add('dj2sqlite', _time(lambda: ok.append(dj2sqlite(back_path, config))), **params)
+        if not all(ok):
+            run.skip('transfer', 'sqlite2dj/dj2sqlite reported a failure', **params)
+    finally:
+        try:
+            dj.Schema(db_name).drop(force=True)
+        except Exception as e:
+            print(f"Error in _bench_transfer: {e}")
+
+def _bench_images(run:_Run, workdir:str, config:dict, neurites:list, repeat:int, seed:int):
+    size = config['volume']
+    # neurites are drawn into the volume at the scale of the volume
+    scale = size / config['extent']
+    volume = render_volume([n*scale for n in neurites], (size, size, size), seed=seed)
+    paths = {
+        'tif': write_tif(os.path.join(workdir, 'bench.tif'), volume),
+        'zip_zarr': write_zip_zarr(os.path.join(workdir, 'bench.zarr.zip'), volume),
+        'ims': write_ims(os.path.join(workdir, 'bench.ims'), volume),
+    }
+    with contextlib.redirect_stderr(io.StringIO()):
+        paths['local_zarr'] = transcode(paths['ims'], out_path=os.path.join(workdir, 'bench.local.zarr'))
+    rng = np.random.default_rng(seed)
+    for roi_size in ROI_SIZES:
+        if roi_size > size:
+            continue
+        rois = _random_rois(rng, size, roi_size, repeat)
+        for name, path in paths.items():
+            for cache in ('none', 'block'):
+                if name == 'tif' and cache == 'block':
+                    continue
+                reader = ImageReader(path, cache=False if cache == 'none' else BlockCache(), transcoded=False)
+                queue = iter(rois)
+                run.add('from_roi', _time(lambda: reader.from_roi(next(queue)), repeat=repeat),
+                        reader=name, roi_size=roi_size, cache=cache, volume=size)
+                if hasattr(reader, 'close'):
+                    reader.close()
+
+def run_benchmarks(scales:list=('small',), only:list=None, repeat:int=20, seed:int=0, workdir:str=None,
+                   dj_config:dict=None, verbose:bool=True):
+    # {'meta', 'results'} of the benchmarks in only (all of BENCHMARKS by default) at every scale
+    # dj_config: {'db_url', 'username', 'password', 'db_name'} of a scratch datajoint server for transfer,
+    # e.g. a local MySQL container; a new schema is created and dropped for every scale
+    only = set(only or BENCHMARKS)
+    unknown = only - set(BENCHMARKS)
+    if unknown:
+        raise ValueError(f"Unknown benchmarks: {sorted(unknown)}")
+    if workdir is not None:
+        os.makedirs(workdir, exist_ok=True)
+    results = []
+    for scale in scales:
+        config = SCALES[scale]
+        run = _Run(results, scale, verbose)
+        scale_dir = tempfile.mkdtemp(prefix=f'neurodb-bench-{scale}-', dir=workdir)
+        try:
+            neurites = random_neurites(config['neurons'], config['extent'], seed=seed)
+            segs = neurites_to_segs(neurites, seed=seed)
+            if only - {'from_roi'}:
+                _bench_db(run, scale_dir, config, segs, only, repeat, seed, dj_config)
+            if 'from_roi' in only:
+                _bench_images(run, scale_dir, config, neurites, repeat, seed)
+        finally:
+            shutil.rmtree(scale_dir, ignore_errors=True)
+    return {'meta': _meta(seed, list(scales)), 'results': results}
+
+def save_results(results:dict, path:str):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2)
+
+def load_results(path:str):
+    with open(path) as f:
+        return json.load(f)
+
+def _result_key(result:dict):
+    return (result['name'], result['scale'], json.dumps(result['params'], sort_keys=True))
+
+def compare_results(base:dict, new:dict):
+    # [(name, scale, params, base mean, new mean, new/base)] of the benchmarks both runs have
+    base_stats = {_result_key(r): r['stats'] for r in base['results'] if r.get('stats')}
+    rows = []
+    for result in new['results']:
+        key = _result_key(result)
+        if result.get('stats') and key in base_stats:
+            old_mean, new_mean = base_stats[key]['mean'], result['stats']['mean']
+            rows.append((result['name'], result['scale'], result['params'], old_mean, new_mean,
+                         new_mean / old_mean if old_mean else float('inf')))
+    return rows
@@ -0,0 +1,120 @@
+import numpy as np
+import h5py
+import tifffile
+import zarr
+
+'''
+    reproducible synthetic data for the benchmarks
+        neurites: random-walk branching polylines, float [x,y,z] points about step voxels apart
+        segs: neurites cut into fragments with gaps, in the format of NeuroDB.segs2db
+        volumes: neurites rendered into a uint16 [x,y,z] image, written as tif / zip-zarr / ims
+'''
+
+def random_neurites(num_neurons:int, extent:int, seed:int=0, branch_length:int=60, step:float=2.0,
+                    branch_prob:float=0.02, max_branches:int=16, turn:float=0.25):
+    # [(n,3) float array] of branches, every branch starts at a point of its parent
+    rng = np.random.default_rng(seed)
+    neurites = []
+    for _ in range(num_neurons):
+        soma = rng.uniform(0, extent, 3)
+        stack = [(soma, rng.normal(size=3))]
+        num_branches = 0
+        while stack and num_branches < max_branches:
+            start, direction = stack.pop()
+            num_branches += 1
+            noise = rng.normal(scale=turn, size=(branch_length, 3))
+            points = np.empty((branch_length, 3))
+            point, direction = start, direction / np.linalg.norm(direction)
+            for i in range(branch_length):
+                direction = direction + noise[i]
+                direction /= np.linalg.norm(direction)
+                point = np.clip(point + step*direction, 0, extent-1)
+                points[i] = point
+                if rng.random() < branch_prob:
+                    stack.append((point, direction + rng.normal(size=3)))
+            neurites.append(np.vstack([start, points]))
+    return neurites
+
+def neurites_to_segs(neurites:list, seed:int=0, seg_points:tuple=(20, 80), gap_points:tuple=(1, 4), sample_step:int=3):
+    # neurites cut into fragments of seg_points points, gap_points points dropped between fragments
+    # sampled_points: every sample_step-th point and the last one, the nodes segs2db creates
+    rng = np.random.default_rng(seed)
+    segs = []
+    for points in neurites:
+        points = np.rint(points).astype(np.int32)
+        start = 0
+        while start < len(points) - 1:
+            stop = min(start + int(rng.integers(*seg_points)), len(points))
+            seg = points[start:stop]
+            if len(seg) >= 2:
+                index = np.unique(np.append(np.arange(0, len(seg), sample_step), len(seg)-1))
+                segs.append({'points': seg, 'sampled_points': seg[index]})
+            start = stop + int(rng.integers(*gap_points))
+    return segs
+
+def render_volume(neurites:list, shape:tuple, seed:int=0, background:int=100, noise:int=10, signal:int=1000):
+    # uint16 [x,y,z] image of shape with the neurites drawn as bright 3 voxel wide tubes over noise
+    rng = np.random.default_rng(seed)
+    volume = rng.integers(background-noise, background+noise+1, size=shape, dtype=np.uint16)
+    if not neurites:
+        return volume
+    points = np.rint(np.concatenate(neurites)).astype(np.int64)
+    # fill the gaps between consecutive points of a branch
+    dense = [points]
+    for neurite in neurites:
+        neurite = np.asarray(neurite)
+        for t in (0.25, 0.5, 0.75):
+            dense.append(np.rint(neurite[:-1] + t*(neurite[1:] - neurite[:-1])).astype(np.int64))
+    points = np.concatenate(dense)
+    for offset in np.ndindex(3, 3, 3):
+        p = points + np.asarray(offset) - 1
+        inside = np.all((p >= 0) & (p < np.asarray(shape)), axis=1)
+        p = p[inside]
+        volume[p[:, 0], p[:, 1], p[:, 2]] = signal
+    return volume
+
+def write_tif(path:str, volume:np.ndarray):
+    # read back by Tiff as [x,y,z]
+    tifffile.imwrite(path, volume)
+    return path
+
+def write_zip_zarr(path:str, volume:np.ndarray, chunks:tuple=(128, 128, 128)):
+    # one '1um' [z,y,x] array in a zip store, as read by ZipZarr
+    data = np.ascontiguousarray(volume.transpose(2, 1, 0))
+    chunks = tuple(min(c, s) for c, s in zip(chunks, data.shape))
+    try:
+        store = zarr.storage.ZipStore(path, mode='w')
+    except AttributeError:
+        # zarr 2
+        store = zarr.ZipStore(path, mode='w')
+    try:
+        group = zarr.open_group(store, mode='w')
+        if hasattr(group, 'create_array'):
+            array = group.create_array('1um', shape=data.shape, chunks=chunks, dtype=data.dtype)
+        else:
+            array = group.create_dataset('1um', shape=data.shape, chunks=chunks, dtype=data.dtype)
+        array[...] = data
+    finally:
+        store.close()
+    return path
+
+def write_ims(path:str, volume:np.ndarray, chunks:tuple=(16, 128, 128), levels:int=2):
+    # Imaris layout read by Ims: DataSet/ResolutionLevel i/TimePoint 0/Channel 0/Data as [z,y,x]
+    # level i takes every 2**i-th voxel, chunks are [z,y,x] and flat in z as Imaris writes them
+    with h5py.File(path, 'w') as f:
+        image = f.create_group('DataSetInfo').create_group('Image')
+        size = volume.shape
+        for i in range(3):
+            image.attrs[f'ExtMin{i}'] = np.bytes_('0')
+            image.attrs[f'ExtMax{i}'] = np.bytes_(str(size[i]))
+        for level in range(levels):
+            factor = 2**level
+            data = np.ascontiguousarray(volume[::factor, ::factor, ::factor].transpose(2, 1, 0))
+            channel = f.create_group(f'DataSet/ResolutionLevel {level}/TimePoint 0/Channel 0')
+            for k, n in zip(('ImageSizeX', 'ImageSizeY', 'ImageSizeZ'), data.shape[::-1]):
+                channel.attrs[k] = np.bytes_(str(n))
+            channel.create_dataset(
+                'Data', data=data, chunks=tuple(min(c, s) for c, s in zip(chunks, data.shape)),
+                compression='gzip', compression_opts=2
+            )
+    return path
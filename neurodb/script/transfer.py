@@ -1,45 +1,198 @@
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from tqdm import tqdm
+
 from ..src import sqliteDBIO
 from ..src import datajointDBIO
 
-def sqlite2dj(db_path_sqlite:str, db_config_dj:dict):
-    try:
-        sqlite = sqliteDBIO(db_path_sqlite)
+'''
+    chunked, resumable copies between a sqlite database and a datajoint schema
+        tables are copied in foreign key order: segs, nodes, edges
+        the source is read in batches (keyset pagination), the batches are inserted by num_workers processes,
+        each with its own connection to the target
+        the checkpoint keeps per table the key up to which every batch is written, a rerun continues there;
+        a resumed run skips rows that exist already, so batches written twice by an interrupted run are harmless
+        a run without a checkpoint needs an empty target and fails on any conflicting row
+'''
 
-        db_name_dj = db_config_dj['db_name']
-        db_url_dj = db_config_dj['db_url']
-        username_dj = db_config_dj['username']
-        password_dj = db_config_dj['password']
-        dj = datajointDBIO(db_name_dj, db_url_dj, username_dj, password_dj)
+TABLES = ('segs', 'nodes', 'edges')
+CHECKPOINT_SECONDS = 5
+SEGS_BATCH_DIVISOR = 10     # segs carry their points, they are read in batches of batch_size // 10
 
-        NODES = sqlite.read_nodes()
-        EDGES = sqlite.read_edges()
+_TARGET = None
 
-        dj.add_nodes(NODES)
-        dj.add_edges(EDGES)
+def _open(kind:str, args:dict):
+    if kind == 'sqlite':
+        return sqliteDBIO(args['db_path'])
+    return datajointDBIO(args['db_name'], args['db_url'], args['username'], args['password'])
 
-        return True
+def _init_worker(kind:str, args:dict):
+    # the target is created, upgraded and checked by _transfer already, workers only connect to it
+    global _TARGET
+    if kind == 'sqlite':
+        _TARGET = sqliteDBIO(None)
+        _TARGET.switch_to(args['db_path'])
+    else:
+        _TARGET = _open(kind, args)
+
+def _insert(task):
+    # task: (table, rows, skip_duplicates); returns the number of rows
+    table, rows, skip_duplicates = task
+    getattr(_TARGET, f'add_{table}')(rows, skip_duplicates=skip_duplicates)
+    return len(rows)
+
+def _is_empty(db):
+    return tuple(db.get_counts()) == (0, 0) and next(db.iter_segs_batches(batch_size=1, after=None), None) is None
+
+def _key(key):
+    # json turns the (src, dst) keys of datajoint edges into lists
+    return tuple(key) if isinstance(key, list) else key
+
+def _load_checkpoint(path:str, source:str, target:str):
+    if path is None or not os.path.exists(path):
+        return None
+    try:
+        with open(path) as f:
+            checkpoint = json.load(f)
     except Exception as e:
-        print(e)
-        return False
+        print(f"Error in transfer: unreadable checkpoint {path}, starting over: {e}")
+        return None
+    if checkpoint.get('source') != source or checkpoint.get('target') != target:
+        print(f"Checkpoint {path} belongs to another transfer, starting over.")
+        return None
+    return checkpoint
+
+def _save_checkpoint(path:str, checkpoint:dict):
+    if path is None:
+        return
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(checkpoint, f, default=str)
+    os.replace(tmp_path, path)
+
+def _transfer(source, target_kind:str, target_args:dict, batch_size:int, num_workers:int, checkpoint_path:str):
+    # copies TABLES of source into the target opened by _open(target_kind, target_args)
+    global _TARGET
+    target = _open(target_kind, target_args)
+    identities = {'source': source.get_identity(), 'target': target.get_identity()}
+    checkpoint = _load_checkpoint(checkpoint_path, **identities)
+    # only a resumed run may meet rows it wrote before
+    skip_duplicates = checkpoint is not None
+    if checkpoint is None:
+        if not _is_empty(target):
+            raise ValueError(f"target {identities['target']} is not empty and there is no checkpoint to resume from.")
+        checkpoint = dict(identities, tables={})
+    else:
+        print(f"Resuming transfer from {checkpoint_path}.")
+    num_nodes, num_edges = source.get_counts()
+    totals = {'segs': None, 'nodes': num_nodes, 'edges': num_edges}
 
-def dj2sqlite(db_path_sqlite:str, db_config_dj:dict):
+    pool = None
+    if num_workers > 1:
+        # spawned workers, a forked one would share the datajoint connection of this process
+        pool = ProcessPoolExecutor(
+            max_workers=num_workers, mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_worker, initargs=(target_kind, target_args)
+        )
+    else:
+        _TARGET = target
     try:
-        sqlite = sqliteDBIO(db_path_sqlite)
+        for table in TABLES:
+            state = checkpoint['tables'].setdefault(table, {'after': None, 'rows': 0, 'done': False})
+            if state['done']:
+                print(f"{table}: done in an earlier run ({state['rows']} rows)")
+                continue
+            size = max(1, batch_size // SEGS_BATCH_DIVISOR) if table == 'segs' else batch_size
+            batches = getattr(source, f'iter_{table}_batches')(batch_size=size, after=_key(state['after']))
+
+            # batch i is written once every batch up to i is; only then its last key becomes the checkpoint
+            keys = {}
+            finished = set()
+            next_index = 0
+            last_checkpoint = time.monotonic()
+            start = time.perf_counter()
+            rows_before = state['rows']
+            pbar = tqdm(total=totals[table], initial=state['rows'] if totals[table] else 0, desc=table, unit='rows')
+
+            def _done(index, count):
+                nonlocal next_index, last_checkpoint
+                finished.add(index)
+                state['rows'] += count
+                pbar.update(count)
+                while next_index in finished:
+                    finished.remove(next_index)
+                    state['after'] = keys.pop(next_index)
+                    next_index += 1
+                if time.monotonic() - last_checkpoint > CHECKPOINT_SECONDS:
+                    _save_checkpoint(checkpoint_path, checkpoint)
+                    last_checkpoint = time.monotonic()
+
+            try:
+                if pool is None:
+                    for index, (batch, key) in enumerate(batches):
+                        keys[index] = key
+                        _done(index, _insert((table, batch, skip_duplicates)))
+                else:
+                    # a bounded number of batches in flight, the source is not read ahead of the workers
+                    pending = {}
+                    for index, (batch, key) in enumerate(batches):
+                        keys[index] = key
+                        pending[pool.submit(_insert, (table, batch, skip_duplicates))] = index
+                        while len(pending) >= 2*num_workers:
+                            finished_futures, _ = wait(pending, return_when=FIRST_COMPLETED)
+                            for future in finished_futures:
+                                _done(pending.pop(future), future.result())
+                    for future in list(pending):
+                        _done(pending.pop(future), future.result())
+            finally:
+                pbar.close()
+                _save_checkpoint(checkpoint_path, checkpoint)
+
+            elapsed = time.perf_counter() - start
+            state['done'] = True
+            _save_checkpoint(checkpoint_path, checkpoint)
+            rows = state['rows'] - rows_before
+            print(f"{table}: {rows} rows in {elapsed:.1f} s, {rows / elapsed if elapsed else 0:.0f} rows/s")
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+        else:
+            _TARGET = None
+
+    if checkpoint_path is not None and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    return checkpoint
 
-        db_name_dj = db_config_dj['db_name']
-        db_url_dj = db_config_dj['db_url']
-        username_dj = db_config_dj['username']
-        password_dj = db_config_dj['password']
-        dj = datajointDBIO(db_name_dj, db_url_dj, username_dj, password_dj)
+def _dj_args(db_config_dj:dict):
+    return {key: db_config_dj[key] for key in ('db_name', 'db_url', 'username', 'password')}
 
-        NODES = dj.read_nodes()
-        EDGES = dj.read_edges()
+def sqlite2dj(db_path_sqlite:str, db_config_dj:dict, batch_size:int=10000, num_workers:int=4,
+              checkpoint_path:str=None):
+    # copies the sqlite database into the datajoint schema db_config_dj['db_name']
+    # num_workers: insert processes, 1 to insert in this process
+    # checkpoint_path: <db_path_sqlite>.sqlite2dj.json by default; rerunning after a failure continues from it
+    try:
+        sqlite = sqliteDBIO(db_path_sqlite)
+        _transfer(sqlite, 'datajoint', _dj_args(db_config_dj), batch_size, num_workers,
+                  checkpoint_path or f'{db_path_sqlite}.sqlite2dj.json')
+        return True
+    except Exception as e:
+        print(f"Error in sqlite2dj: {e}")
+        return False
 
-        sqlite.add_nodes(NODES)
-        sqlite.add_edges(EDGES)
-        
+def dj2sqlite(db_path_sqlite:str, db_config_dj:dict, batch_size:int=10000, num_workers:int=1,
+              checkpoint_path:str=None):
+    # copies the datajoint schema db_config_dj['db_name'] into the sqlite database
+    # num_workers: insert processes; sqlite has a single writer, so more than 1 only overlaps reading and writing
+    # checkpoint_path: <db_path_sqlite>.dj2sqlite.json by default; rerunning after a failure continues from it
+    try:
+        dj = datajointDBIO(**_dj_args(db_config_dj))
+        _transfer(dj, 'sqlite', {'db_path': db_path_sqlite}, batch_size, num_workers,
+                  checkpoint_path or f'{db_path_sqlite}.dj2sqlite.json')
         return True
     except Exception as e:
-        print(e)
+        print(f"Error in dj2sqlite: {e}")
         return False
-        
\ No newline at end of file
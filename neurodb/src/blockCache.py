@@ -0,0 +1,163 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+from . import metrics
+
+'''
+    decoded chunk cache shared by the chunked image readers (Ims, ZipZarr)
+        key: (file, level, channel, chunk index), chunk index in the array's own axis order
+        value: the decoded chunk as a read-only numpy array
+    regions are assembled from whole chunks, so panning by a few voxels only decodes the new chunks.
+'''
+
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024   # 1 GB
+DEFAULT_CHUNKS = (64, 64, 64)            # for datasets stored without chunks
+
+class BlockCache():
+    def __init__(self, max_bytes:int=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._blocks = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._blocks)
+
+    def __contains__(self, key):
+        return key in self._blocks
+
+    def get(self, key):
+        with self._lock:
+            block = self._blocks.get(key)
+            if block is None:
+                self.misses += 1
+                return None
+            self._blocks.move_to_end(key)
+            self.hits += 1
+            return block
+
+    def put(self, key, block:np.ndarray):
+        if block.nbytes > self.max_bytes:
+            return
+        block.flags.writeable = False
+        with self._lock:
+            old = self._blocks.pop(key, None)
+            if old is not None:
+                self.nbytes -= old.nbytes
+            self._blocks[key] = block
+            self.nbytes += block.nbytes
+            self._evict()
+
+    def _evict(self):
+        while self.nbytes > self.max_bytes and self._blocks:
+            _, block = self._blocks.popitem(last=False)
+            self.nbytes -= block.nbytes
+            self.evictions += 1
+
+    def set_max_bytes(self, max_bytes:int):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._blocks.clear()
+            self.nbytes = 0
+
+    def reset_stats(self):
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'blocks': len(self._blocks),
+                'nbytes': self.nbytes,
+                'max_bytes': self.max_bytes,
+            }
+
+    def read(self, array, key:tuple, region:tuple, chunks:tuple=None):
+        # array[region] assembled from cached chunks
+        # key: (file, level, channel), region: one slice with step 1 per axis of array
+        bounds = _bounds(region, array.shape)
+        if bounds is None:
+            return np.asarray(array[region])
+        out = np.empty([stop-start for start, stop in bounds], dtype=array.dtype)
+        read_regions(array, [region], [out], cache=self, key=key, chunks=chunks)
+        return out
+
+
+def _bounds(region:tuple, shape:tuple):
+    # [(start, stop)] per axis, None if a slice has a step
+    bounds = []
+    for s, size in zip(region, shape):
+        start, stop, step = s.indices(size)
+        if step != 1:
+            return None
+        bounds.append((start, max(start, stop)))
+    return bounds
+
+def read_regions(array, regions:list, outs:list, cache:BlockCache=None, key:tuple=None, chunks:tuple=None, num_workers:int=None):
+    # outs[i][...] = array[regions[i]], reading every chunk the regions touch once
+    # regions: slices with step 1 in the axis order of array; outs: arrays (or views) of the region shapes
+    # cache/key: optional BlockCache and (file, level, channel) to look chunks up in and keep them
+    chunks = tuple(chunks or getattr(array, 'chunks', None) or DEFAULT_CHUNKS)
+    shape = array.shape
+    users = {}
+    all_bounds = []
+    for i, region in enumerate(regions):
+        bounds = _bounds(region, shape)
+        if bounds is None:
+            raise ValueError('read_regions does not support slices with a step.')
+        all_bounds.append(bounds)
+        if any(stop <= start for start, stop in bounds):
+            continue
+        chunk_ranges = [range(start//c, (stop-1)//c+1) for (start, stop), c in zip(bounds, chunks)]
+        for index in np.ndindex(*[len(r) for r in chunk_ranges]):
+            users.setdefault(tuple(r[j] for r, j in zip(chunk_ranges, index)), []).append(i)
+
+    def _load(index):
+        block_start = [i*c for i, c in zip(index, chunks)]
+        block = cache.get(key + (index,)) if cache is not None else None
+        if block is None:
+            block = np.asarray(array[tuple(
+                slice(b, min(b+c, size)) for b, c, size in zip(block_start, chunks, shape)
+            )])
+            if cache is not None:
+                cache.put(key + (index,), block)
+        for i in users[index]:
+            src, dst = [], []
+            for (start, stop), b, n in zip(all_bounds[i], block_start, block.shape):
+                lo, hi = max(start, b), min(stop, b+n)
+                src.append(slice(lo-b, hi-b))
+                dst.append(slice(lo-start, hi-start))
+            outs[i][tuple(dst)] = block[tuple(src)]
+
+    indices = sorted(users)
+    if num_workers is not None and num_workers > 1 and len(indices) > 1:
+        # regions of different chunks never overlap in outs, so chunks can be copied concurrently
+        with ThreadPoolExecutor(max_workers=num_workers) as pool:
+            list(pool.map(_load, indices))
+    else:
+        for index in indices:
+            _load(index)
+
+
+_default_cache = BlockCache()
+metrics.register_gauge('neurodb_block_cache', _default_cache.stats, cache='default')
+
+def default_block_cache():
+    # process wide cache used by readers created without an explicit cache
+    return _default_cache
@@ -0,0 +1,250 @@
+import numpy as np
+
+from .csrGraph import connected_component_labels
+
+'''
+    per connected component statistics used by NeuroDB.get_annotation_info
+        nodes are rows 0..N-1, edges are (src, dst) row pairs, each undirected edge listed once
+        components are numbered in the order networkx.connected_components yields them
+'''
+
+def component_stats(num_nodes:int, src:np.ndarray, dst:np.ndarray, coords:np.ndarray, checked:np.ndarray):
+    # returns
+    #   comp, degree: (N,) component and degree of every row
+    #   size, length, num_branch, num_end: per component
+    #   valid: per component, False if it has an unchecked end node (checked==0) or a node with checked==-1
+    src = np.asarray(src, dtype=np.int64)
+    dst = np.asarray(dst, dtype=np.int64)
+    labels = connected_component_labels(num_nodes, src, dst)
+    # labels are the smallest row of each component, so sorting them gives the networkx order
+    _, comp = np.unique(labels, return_inverse=True)
+    comp = comp.reshape(-1)
+    num_comps = int(comp.max()) + 1 if num_nodes else 0
+
+    degree = np.bincount(src, minlength=num_nodes) + np.bincount(dst, minlength=num_nodes)
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 3)
+    edge_length = np.linalg.norm(coords[src] - coords[dst], axis=1)
+    invalid = ((degree == 1) & (checked == 0)) | (checked == -1)
+    return {
+        'comp': comp,
+        'size': np.bincount(comp, minlength=num_comps),
+        'length': np.bincount(comp[src], weights=edge_length, minlength=num_comps),
+        'num_branch': np.bincount(comp, weights=degree > 2, minlength=num_comps).astype(np.int64),
+        'num_end': np.bincount(comp, weights=degree == 1, minlength=num_comps).astype(np.int64),
+        'valid': np.bincount(comp, weights=invalid, minlength=num_comps) == 0,
+        'degree': degree,
+    }
+
+
+class _Component():
+    __slots__ = ('nodes', 'length', 'branch', 'end', 'invalid', 'first')
+
+    def __init__(self):
+        self.nodes = set()
+        self.length = 0.0
+        self.branch = set()    # nodes with degree > 2
+        self.end = set()       # nodes with degree == 1
+        self.invalid = set()   # unchecked end nodes and nodes with checked==-1
+        self.first = None      # smallest node position, orders components as networkx does
+
+
+class ComponentCache():
+    '''
+    Connected components of NeuroDB.G with their statistics, kept up to date by the mutators of NeuroDB.
+    Every hook is called right after the change was applied to G:
+        adding an edge merges the smaller component into the larger one,
+        removing an edge searches from both ends at once and splits off the side that is exhausted first,
+        removing nodes recomputes the components they belonged to.
+    '''
+    def __init__(self):
+        self.comps = {}
+        self.comp_of = {}
+        self.pos = {}
+        self._next_comp = 0
+        self._next_pos = 0
+
+    @classmethod
+    def from_arrays(cls, nids:np.ndarray, coords:np.ndarray, checked:np.ndarray, src:np.ndarray, dst:np.ndarray):
+        # nids/coords/checked in node order, edges once each as (src, dst) rows
+        cache = cls()
+        stats = component_stats(len(nids), src, dst, coords, checked)
+        comp, degree = stats['comp'], stats['degree']
+        nid_list = nids.tolist()
+        cache.pos = dict(zip(nid_list, range(len(nid_list))))
+        cache._next_pos = len(nid_list)
+        cache.comp_of = dict(zip(nid_list, comp.tolist()))
+        order = np.argsort(comp, kind='stable')
+        splits = np.cumsum(stats['size'])[:-1]
+        invalid = ((degree == 1) & (checked == 0)) | (checked == -1)
+        for c, rows in enumerate(np.split(order, splits) if len(nid_list) else []):
+            component = _Component()
+            component.nodes = set(nids[rows].tolist())
+            component.length = float(stats['length'][c])
+            component.branch = set(nids[rows[degree[rows] > 2]].tolist())
+            component.end = set(nids[rows[degree[rows] == 1]].tolist())
+            component.invalid = set(nids[rows[invalid[rows]]].tolist())
+            component.first = int(rows[0])
+            cache.comps[c] = component
+        cache._next_comp = len(cache.comps)
+        return cache
+
+    def _new_comp(self):
+        c = self._next_comp
+        self._next_comp += 1
+        self.comps[c] = _Component()
+        return c
+
+    @staticmethod
+    def _dist(G, u, v):
+        cu = G.nodes[u].get('coord')
+        cv = G.nodes[v].get('coord')
+        if cu is None or cv is None:
+            return 0.0
+        return float(np.linalg.norm(np.asarray(cu, dtype=np.float64) - np.asarray(cv, dtype=np.float64)))
+
+    def _refresh_node(self, G, nid):
+        # re-classify nid in its component after its degree or checked value changed
+        component = self.comps[self.comp_of[nid]]
+        degree = G.degree[nid]
+        checked = G.nodes[nid].get('checked', 0)
+        for members, member in (
+            (component.branch, degree > 2),
+            (component.end, degree == 1),
+            (component.invalid, (degree == 1 and checked == 0) or checked == -1),
+        ):
+            if member:
+                members.add(nid)
+            else:
+                members.discard(nid)
+
+    def _build(self, G, nodes:set):
+        # new component over nodes (a whole component of G), statistics computed from G
+        c = self._new_comp()
+        component = self.comps[c]
+        component.nodes = nodes
+        length = 0.0
+        for nid in nodes:
+            self.comp_of[nid] = c
+            for nbr in G.neighbors(nid):
+                if nbr != nid:
+                    length += self._dist(G, nid, nbr)
+            self._refresh_node(G, nid)
+        component.length = length / 2
+        component.first = min(self.pos[nid] for nid in nodes)
+        return c
+
+    def _assign(self, G, nodes:set):
+        # split nodes into the components of G they form
+        left = set(nodes)
+        while left:
+            seed = left.pop()
+            seen = {seed}
+            stack = [seed]
+            while stack:
+                for nbr in G.neighbors(stack.pop()):
+                    if nbr not in seen:
+                        seen.add(nbr)
+                        stack.append(nbr)
+            left -= seen
+            self._build(G, seen)
+
+    def _split_side(self, G, u, v):
+        # after removing (u, v): None if u and v are still connected, otherwise the nodes of the smaller side
+        seen = ({u}, {v})
+        frontier = ([u], [v])
+        while True:
+            for i in (0, 1):
+                if not frontier[i]:
+                    return seen[i]
+                node = frontier[i].pop()
+                for nbr in G.neighbors(node):
+                    if nbr in seen[1-i]:
+                        return None
+                    if nbr not in seen[i]:
+                        seen[i].add(nbr)
+                        frontier[i].append(nbr)
+
+    def add_node(self, G, nid):
+        if nid in self.comp_of:
+            # re-added node, its coord may have changed
+            component = self.comps.pop(self.comp_of[nid])
+            self._assign(G, component.nodes)
+            return
+        c = self._new_comp()
+        self.pos[nid] = self._next_pos
+        self._next_pos += 1
+        self.comp_of[nid] = c
+        self.comps[c].nodes.add(nid)
+        self.comps[c].first = self.pos[nid]
+        self._refresh_node(G, nid)
+
+    def add_edge(self, G, u, v):
+        for nid in (u, v):
+            if nid not in self.comp_of:
+                self.add_node(G, nid)
+        cu, cv = self.comp_of[u], self.comp_of[v]
+        if cu != cv:
+            # merge the smaller component into the larger one
+            if len(self.comps[cu].nodes) < len(self.comps[cv].nodes):
+                cu, cv = cv, cu
+            big, small = self.comps[cu], self.comps.pop(cv)
+            for nid in small.nodes:
+                self.comp_of[nid] = cu
+            big.nodes |= small.nodes
+            big.branch |= small.branch
+            big.end |= small.end
+            big.invalid |= small.invalid
+            big.length += small.length
+            big.first = min(big.first, small.first)
+        self.comps[cu].length += self._dist(G, u, v)
+        self._refresh_node(G, u)
+        self._refresh_node(G, v)
+
+    def remove_edge(self, G, u, v):
+        c = self.comp_of[u]
+        component = self.comps[c]
+        component.length -= self._dist(G, u, v)
+        self._refresh_node(G, u)
+        self._refresh_node(G, v)
+        if u == v:
+            return
+        side = self._split_side(G, u, v)
+        if side is None:
+            return
+        for members in (component.nodes, component.branch, component.end, component.invalid):
+            members -= side
+        new = self.comps[self._build(G, side)]
+        component.length -= new.length
+        if new.first == component.first:
+            component.first = min(self.pos[nid] for nid in component.nodes)
+
+    def remove_nodes(self, G, nids:list):
+        removed = set(nid for nid in nids if nid in self.comp_of)
+        affected = set(self.comp_of[nid] for nid in removed)
+        for nid in removed:
+            del self.comp_of[nid]
+            del self.pos[nid]
+        for c in affected:
+            component = self.comps.pop(c)
+            self._assign(G, component.nodes - removed)
+
+    def update_nodes(self, G, nids:list):
+        for nid in nids:
+            if nid in self.comp_of:
+                self._refresh_node(G, nid)
+
+    def info(self, len_threshold:int=0):
+        # the output of NeuroDB.get_annotation_info
+        comps = sorted(
+            (component for component in self.comps.values()
+                if not component.invalid and len(component.nodes) >= len_threshold),
+            key=lambda component: component.first
+        )
+        info = [{
+            'nid': list(component.nodes),
+            'branch_nid': list(component.branch),
+            'end_nid': list(component.end),
+            'length': int(component.length)
+        } for component in comps]
+        info.sort(key=lambda x:x['length'], reverse=True)
+        return info
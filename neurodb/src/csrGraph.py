@@ -0,0 +1,799 @@
+from collections.abc import Mapping, MutableMapping
+from datetime import datetime
+
+import networkx as nx
+import numpy as np
+
+'''
+    CSRGraph: compact alternative to networkx.Graph for NeuroDB.G
+        node columns (one row per node):
+            nid: int64
+            coord: int32 (3,)
+            type, checked, status: int8
+            creator: int32, code into CSRGraph.creators
+            date: int64, microseconds since epoch (NAT for missing)
+        adjacency:
+            CSR (indptr, indices) over node rows, edge creator/date stored per directed entry
+            delta buffer of added/removed edges, merged into CSR by compact()
+    Neighbour and node iteration order follow networkx (insertion order).
+'''
+
+NODE_ATTRS = ('coord', 'creator', 'type', 'checked', 'status', 'date')
+EDGE_ATTRS = ('creator', 'date')
+NAT = np.iinfo(np.int64).min
+
+def _to_epoch(date):
+    if date is None:
+        return NAT
+    return int(np.datetime64(date, 'us').astype(np.int64))
+
+def _to_epoch_array(dates):
+    if isinstance(dates, np.ndarray) and np.issubdtype(dates.dtype, np.datetime64):
+        return dates.astype('datetime64[us]').astype(np.int64)
+    return np.asarray(np.array(list(dates), dtype='datetime64[us]'), dtype=np.int64)
+
+def _from_epoch(value):
+    if value == NAT:
+        return None
+    return np.datetime64(int(value), 'us').astype(datetime)
+
+def connected_component_labels(num_nodes:int, src:np.ndarray, dst:np.ndarray):
+    # array based union-find: every node is labelled with the smallest row of its component
+    labels = np.arange(num_nodes, dtype=np.int64)
+    src = np.asarray(src, dtype=np.int64)
+    dst = np.asarray(dst, dtype=np.int64)
+    while True:
+        l_src = labels[src]
+        l_dst = labels[dst]
+        diff = l_src != l_dst
+        if not diff.any():
+            return labels
+        l_src, l_dst = l_src[diff], l_dst[diff]
+        lo = np.minimum(l_src, l_dst)
+        # hook roots onto the smaller label, then compress paths
+        np.minimum.at(labels, l_src, lo)
+        np.minimum.at(labels, l_dst, lo)
+        while True:
+            jumped = labels[labels]
+            if np.array_equal(jumped, labels):
+                break
+            labels = jumped
+
+
+class CSRGraph():
+    def __init__(self):
+        self.creators = []
+        self._creator_code = {}
+        self._n = 0
+        self._columns = {
+            'nid': np.empty(0, np.int64),
+            'coord': np.empty((0, 3), np.int32),
+            'type': np.empty(0, np.int8),
+            'checked': np.empty(0, np.int8),
+            'status': np.empty(0, np.int8),
+            'creator': np.empty(0, np.int32),
+            'date': np.empty(0, np.int64),
+            'alive': np.empty(0, bool),
+            'has_attrs': np.empty(0, bool),
+            'deg': np.empty(0, np.int64),
+        }
+        self._node_extra = {}     # row -> dict of attributes outside NODE_ATTRS
+        # nid lookup: sorted snapshot of nids built with the CSR, plus rows appended after it
+        self._sorted_nids = np.empty(0, np.int64)
+        self._sorted_rows = np.empty(0, np.int64)
+        self._extra_rows = {}
+        # adjacency
+        self._indptr = np.zeros(1, np.int64)
+        self._indices = np.empty(0, np.int64)
+        self._edge_creator = np.empty(0, np.int32)
+        self._edge_date = np.empty(0, np.int64)
+        self._added = {}          # row -> {nbr_row: [creator, date]}, shared by both directions
+        self._removed = {}        # row -> set of nbr_row removed from CSR
+        self._num_added = 0
+        self.version = 0
+
+    # ---- construction ----
+    @classmethod
+    def from_records(cls, nodes, edges):
+        # nodes: iterable of {'nid', 'coord', 'creator', 'type', 'checked', 'status', 'date'}
+        # edges: iterable of {'src', 'dst', 'creator', 'date'}
+        # consumed in one pass, so streams from iter_nodes/iter_edges work
+        node_cols = {key: [] for key in ('nid', 'coord', 'creator', 'type', 'checked', 'status', 'date')}
+        for n in nodes:
+            for key, col in node_cols.items():
+                col.append(n[key])
+        edge_cols = {key: [] for key in ('src', 'dst', 'creator', 'date')}
+        for e in edges:
+            for key, col in edge_cols.items():
+                col.append(e[key])
+        return cls.from_arrays(
+            nid=node_cols['nid'],
+            coord=np.asarray(node_cols['coord'], dtype=np.int32).reshape(-1, 3),
+            creator=node_cols['creator'],
+            type=node_cols['type'],
+            checked=node_cols['checked'],
+            status=node_cols['status'],
+            date=node_cols['date'],
+            src=edge_cols['src'],
+            dst=edge_cols['dst'],
+            edge_creator=edge_cols['creator'],
+            edge_date=edge_cols['date'],
+        )
+
+    @classmethod
+    def from_arrays(cls, nid, coord, creator, type, checked, status, date, src, dst, edge_creator, edge_date):
+        # date/edge_date: datetimes, ISO strings or datetime64 values
+        G = cls()
+        nid = np.asarray(nid, dtype=np.int64)
+        n = len(nid)
+        G._grow(n)
+        G._n = n
+        cols = G._columns
+        cols['nid'][:n] = nid
+        cols['coord'][:n] = np.asarray(coord, dtype=np.int32).reshape(-1, 3)
+        cols['type'][:n] = np.asarray(type, dtype=np.int8)
+        cols['checked'][:n] = np.asarray(checked, dtype=np.int8)
+        cols['status'][:n] = np.asarray(status, dtype=np.int8)
+        cols['creator'][:n] = G._encode_creators(creator)
+        cols['date'][:n] = _to_epoch_array(date)
+        cols['alive'][:n] = True
+        cols['has_attrs'][:n] = True
+        G._build_lookup()
+
+        src = np.asarray(src, dtype=np.int64)
+        dst = np.asarray(dst, dtype=np.int64)
+        # endpoints without a node row are created without attributes, as networkx does
+        missing = np.setdiff1d(np.concatenate([src, dst]), nid)
+        for m in missing.tolist():
+            G._new_row(m)
+        if len(missing):
+            G._build_lookup()
+        G._build_csr(G._rows(src), G._rows(dst), G._encode_creators(edge_creator), _to_epoch_array(edge_date))
+        return G
+
+    def _encode_creators(self, creators):
+        codes = np.empty(len(creators), dtype=np.int32)
+        for i, creator in enumerate(creators):
+            codes[i] = self._encode_creator(creator)
+        return codes
+
+    def _encode_creator(self, creator):
+        if creator is None:
+            return -1
+        code = self._creator_code.get(creator)
+        if code is None:
+            code = len(self.creators)
+            self.creators.append(creator)
+            self._creator_code[creator] = code
+        return code
+
+    def _decode_creator(self, code):
+        return None if code < 0 else self.creators[code]
+
+    def _grow(self, size):
+        capacity = len(self._columns['nid'])
+        if size <= capacity:
+            return
+        capacity = max(size, 2*capacity, 16)
+        for key, col in self._columns.items():
+            new = np.zeros((capacity,) + col.shape[1:], dtype=col.dtype)
+            new[:len(col)] = col
+            self._columns[key] = new
+
+    def _build_lookup(self):
+        nids = self._columns['nid'][:self._n]
+        rows = np.flatnonzero(self._columns['alive'][:self._n])
+        order = np.argsort(nids[rows], kind='stable')
+        self._sorted_rows = rows[order]
+        self._sorted_nids = nids[self._sorted_rows]
+        self._extra_rows = {}
+
+    def _build_csr(self, src_rows, dst_rows, creator, date):
+        # directed entries interleaved per edge so that a stable sort keeps insertion order per row
+        n = self._n
+        rows = np.stack([src_rows, dst_rows], axis=1).ravel()
+        cols = np.stack([dst_rows, src_rows], axis=1).ravel()
+        keep = np.ones(len(rows), dtype=bool)
+        keep[1::2] = src_rows != dst_rows
+        rows, cols = rows[keep], cols[keep]
+        creator = np.repeat(creator, 2)[keep]
+        date = np.repeat(date, 2)[keep]
+        self._set_csr(n, rows, cols, creator, date)
+        loops = src_rows[src_rows == dst_rows]
+        deg = np.bincount(rows, minlength=n) + np.bincount(loops, minlength=n)
+        self._columns['deg'][:n] = deg
+
+    def _set_csr(self, n, rows, cols, creator, date):
+        order = np.argsort(rows, kind='stable')
+        self._indices = cols[order].astype(np.int64)
+        self._edge_creator = np.asarray(creator[order], dtype=np.int32)
+        self._edge_date = np.asarray(date[order], dtype=np.int64)
+        self._indptr = np.zeros(n+1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=n), out=self._indptr[1:])
+        self._added = {}
+        self._removed = {}
+        self._num_added = 0
+
+    # ---- row lookup ----
+    def _row(self, nid):
+        row = self._extra_rows.get(nid)
+        if row is not None:
+            return row
+        pos = np.searchsorted(self._sorted_nids, nid)
+        if pos < len(self._sorted_nids) and self._sorted_nids[pos] == nid:
+            row = int(self._sorted_rows[pos])
+            if self._columns['alive'][row]:
+                return row
+        raise KeyError(nid)
+
+    def _rows(self, nids):
+        nids = np.asarray(nids, dtype=np.int64)
+        pos = np.searchsorted(self._sorted_nids, nids)
+        pos = np.minimum(pos, max(len(self._sorted_nids)-1, 0))
+        rows = np.full(len(nids), -1, dtype=np.int64)
+        if len(self._sorted_nids):
+            found = self._sorted_nids[pos] == nids
+            rows[found] = self._sorted_rows[pos[found]]
+            rows[found] = np.where(self._columns['alive'][rows[found]], rows[found], -1)
+        for i in np.flatnonzero(rows < 0).tolist():
+            rows[i] = self._row(int(nids[i]))
+        return rows
+
+    def _new_row(self, nid):
+        row = self._n
+        self._grow(row+1)
+        self._n += 1
+        cols = self._columns
+        cols['nid'][row] = nid
+        cols['coord'][row] = 0
+        cols['type'][row] = 0
+        cols['checked'][row] = 0
+        cols['status'][row] = 0
+        cols['creator'][row] = -1
+        cols['date'][row] = NAT
+        cols['alive'][row] = True
+        cols['has_attrs'][row] = False
+        cols['deg'][row] = 0
+        self._extra_rows[nid] = row
+        return row
+
+    # ---- adjacency primitives on rows ----
+    def _base_slice(self, row):
+        if row >= len(self._indptr)-1:
+            return 0, 0
+        return int(self._indptr[row]), int(self._indptr[row+1])
+
+    def _neighbor_rows(self, row):
+        start, stop = self._base_slice(row)
+        out = self._indices[start:stop].tolist()
+        removed = self._removed.get(row)
+        if removed:
+            out = [c for c in out if c not in removed]
+        added = self._added.get(row)
+        if added:
+            out.extend(added)
+        return out
+
+    def _base_pos(self, row, nbr):
+        # position of nbr in the CSR slice of row, or -1
+        start, stop = self._base_slice(row)
+        if start == stop:
+            return -1
+        hits = np.flatnonzero(self._indices[start:stop] == nbr)
+        if len(hits) == 0 or nbr in self._removed.get(row, ()):
+            return -1
+        return start + int(hits[0])
+
+    def _has_edge_rows(self, ru, rv):
+        if rv in self._added.get(ru, ()):
+            return True
+        return self._base_pos(ru, rv) >= 0
+
+    def _edge_get(self, ru, rv):
+        added = self._added.get(ru)
+        if added is not None and rv in added:
+            return added[rv]
+        pos = self._base_pos(ru, rv)
+        if pos < 0:
+            raise KeyError((ru, rv))
+        return [int(self._edge_creator[pos]), int(self._edge_date[pos])]
+
+    def _edge_set(self, ru, rv, creator=None, date=None):
+        added = self._added.get(ru)
+        if added is not None and rv in added:
+            entry = added[rv]
+            if creator is not None:
+                entry[0] = creator
+            if date is not None:
+                entry[1] = date
+            return
+        for a, b in ((ru, rv), (rv, ru)):
+            pos = self._base_pos(a, b)
+            if creator is not None:
+                self._edge_creator[pos] = creator
+            if date is not None:
+                self._edge_date[pos] = date
+
+    # ---- networkx-like API used by NeuroDB ----
+    def __len__(self):
+        return int(self._columns['alive'][:self._n].sum())
+
+    def __contains__(self, nid):
+        try:
+            self._row(nid)
+            return True
+        except (KeyError, TypeError):
+            return False
+
+    def __iter__(self):
+        return iter(self.nodes)
+
+    def number_of_nodes(self):
+        return len(self)
+
+    def number_of_edges(self):
+        return int(self._columns['deg'][:self._n].sum()) // 2
+
+    @property
+    def nodes(self):
+        return _NodeView(self)
+
+    @property
+    def edges(self):
+        return _EdgeView(self)
+
+    @property
+    def degree(self):
+        return _DegreeView(self)
+
+    def neighbors(self, nid):
+        nids = self._columns['nid']
+        return iter([int(nids[r]) for r in self._neighbor_rows(self._row(nid))])
+
+    def has_edge(self, u, v):
+        try:
+            return self._has_edge_rows(self._row(u), self._row(v))
+        except KeyError:
+            return False
+
+    def add_node(self, nid, **attrs):
+        try:
+            row = self._row(nid)
+        except KeyError:
+            row = self._new_row(nid)
+        node = _NodeAttrs(self, row)
+        for key, value in attrs.items():
+            node[key] = value
+        self.version += 1
+
+    def add_edge(self, u, v, creator=None, date=None):
+        ru = self._row(u) if u in self else self._new_row(u)
+        rv = self._row(v) if v in self else self._new_row(v)
+        code = self._encode_creator(creator)
+        epoch = _to_epoch(date)
+        if self._has_edge_rows(ru, rv):
+            self._edge_set(ru, rv, code, epoch)
+        else:
+            entry = [code, epoch]
+            self._added.setdefault(ru, {})[rv] = entry
+            self._added.setdefault(rv, {})[ru] = entry
+            deg = self._columns['deg']
+            deg[ru] += 1
+            deg[rv] += 1
+            self._num_added += 1
+            if self._num_added > max(1024, len(self._indices)//4):
+                self._compact_edges()
+        self.version += 1
+
+    def remove_edge(self, u, v):
+        try:
+            ru, rv = self._row(u), self._row(v)
+        except KeyError:
+            raise nx.NetworkXError(f"The edge {u}-{v} is not in the graph")
+        if not self._has_edge_rows(ru, rv):
+            raise nx.NetworkXError(f"The edge {u}-{v} is not in the graph")
+        added = self._added.get(ru)
+        if added is not None and rv in added:
+            del added[rv]
+            self._added[rv].pop(ru, None)
+            self._num_added -= 1
+        else:
+            self._removed.setdefault(ru, set()).add(rv)
+            self._removed.setdefault(rv, set()).add(ru)
+        deg = self._columns['deg']
+        deg[ru] -= 1
+        deg[rv] -= 1
+        self.version += 1
+
+    def remove_edges_from(self, edges):
+        for edge in edges:
+            if self.has_edge(edge[0], edge[1]):
+                self.remove_edge(edge[0], edge[1])
+
+    def remove_node(self, nid):
+        try:
+            row = self._row(nid)
+        except KeyError:
+            raise nx.NetworkXError(f"The node {nid} is not in the graph.")
+        nids = self._columns['nid']
+        for nbr in self._neighbor_rows(row):
+            self.remove_edge(nid, int(nids[nbr]))
+        self._columns['alive'][row] = False
+        self._columns['deg'][row] = 0
+        self._node_extra.pop(row, None)
+        self._extra_rows.pop(nid, None)
+        self.version += 1
+
+    def remove_nodes_from(self, nids):
+        for nid in nids:
+            if nid in self:
+                self.remove_node(nid)
+
+    def dfs_edges(self, source, depth_limit:int=None):
+        # same traversal order as networkx.dfs_edges(G, source, depth_limit)
+        nids = self._columns['nid']
+        start = self._row(source)
+        if depth_limit is None:
+            depth_limit = len(self)
+        visited = {start}
+        stack = [(start, iter(self._neighbor_rows(start)))]
+        depth_now = 1
+        while stack:
+            parent, children = stack[-1]
+            for child in children:
+                if child not in visited:
+                    yield int(nids[parent]), int(nids[child])
+                    visited.add(child)
+                    if depth_now < depth_limit:
+                        stack.append((child, iter(self._neighbor_rows(child))))
+                        depth_now += 1
+                        break
+            else:
+                stack.pop()
+                depth_now -= 1
+
+    def edge_rows(self):
+        # current adjacency as directed (src_row, dst_row) entries, in neighbour order
+        n = self._n
+        base_rows = np.repeat(np.arange(len(self._indptr)-1, dtype=np.int64), np.diff(self._indptr))
+        keep = np.ones(len(base_rows), dtype=bool)
+        for row, removed in self._removed.items():
+            start, stop = self._base_slice(row)
+            for pos in range(start, stop):
+                if self._indices[pos] in removed:
+                    keep[pos] = False
+        added_src, added_dst, added_creator, added_date = [], [], [], []
+        for row, nbrs in self._added.items():
+            for nbr, (creator, date) in nbrs.items():
+                added_src.append(row)
+                added_dst.append(nbr)
+                added_creator.append(creator)
+                added_date.append(date)
+        src = np.concatenate([base_rows[keep], np.asarray(added_src, dtype=np.int64)])
+        dst = np.concatenate([self._indices[keep], np.asarray(added_dst, dtype=np.int64)])
+        creator = np.concatenate([self._edge_creator[keep], np.asarray(added_creator, dtype=np.int32)])
+        date = np.concatenate([self._edge_date[keep], np.asarray(added_date, dtype=np.int64)])
+        alive = self._columns['alive'][:n]
+        valid = alive[src] & alive[dst]
+        return src[valid], dst[valid], creator[valid], date[valid]
+
+    def _compact_edges(self):
+        src, dst, creator, date = self.edge_rows()
+        self._set_csr(self._n, src, dst, creator, date)
+
+    def compact(self):
+        # merge the edge delta buffer into CSR and drop rows of removed nodes
+        src, dst, creator, date = self.edge_rows()
+        alive = self._columns['alive'][:self._n]
+        rows = np.flatnonzero(alive)
+        remap = np.full(self._n, -1, dtype=np.int64)
+        remap[rows] = np.arange(len(rows))
+        for key, col in self._columns.items():
+            self._columns[key] = col[rows].copy()
+        self._node_extra = {int(remap[r]): attrs for r, attrs in self._node_extra.items()}
+        self._n = len(rows)
+        self._build_lookup()
+        self._set_csr(self._n, remap[src], remap[dst], creator, date)
+        self.version += 1
+
+    def connected_components(self):
+        # sets of nids, in the order networkx.connected_components yields them
+        src, dst, _, _ = self.edge_rows()
+        labels = connected_component_labels(self._n, src, dst)
+        rows = np.flatnonzero(self._columns['alive'][:self._n])
+        labels = labels[rows]
+        order = np.argsort(labels, kind='stable')
+        labels, rows = labels[order], rows[order]
+        splits = np.flatnonzero(np.diff(labels)) + 1
+        nids = self._columns['nid']
+        for group in np.split(rows, splits):
+            if len(group):
+                yield set(nids[group].tolist())
+
+    def alive(self):
+        # (rows,) bool mask of live nodes over the rows edge_rows refers to; columns() holds the True rows in order
+        return self._columns['alive'][:self._n]
+
+    def num_attributed_nodes(self):
+        # live nodes that carry attributes, i.e. all but endpoints added by add_edge without a node
+        n = self._n
+        return int((self._columns['alive'][:n] & self._columns['has_attrs'][:n]).sum())
+
+    def columns(self):
+        # node columns of live rows, as numpy arrays
+        alive = self._columns['alive'][:self._n]
+        return {key: col[:self._n][alive] for key, col in self._columns.items() if key not in ('alive', 'has_attrs')}
+
+    def nx_view(self):
+        # read-only networkx.Graph over this graph; attribute dicts are copies
+        G = nx.Graph()
+        G._node = _NxNodeMap(self)
+        G._adj = _NxAdjMap(self)
+        return nx.freeze(G)
+
+
+class _NodeAttrs(MutableMapping):
+    def __init__(self, graph:CSRGraph, row:int):
+        self._graph = graph
+        self._row = row
+
+    def __getitem__(self, key):
+        cols = self._graph._columns
+        row = self._row
+        if key in NODE_ATTRS:
+            if not cols['has_attrs'][row]:
+                raise KeyError(key)
+            if key == 'coord':
+                return cols['coord'][row].tolist()
+            if key == 'creator':
+                return self._graph._decode_creator(int(cols['creator'][row]))
+            if key == 'date':
+                return _from_epoch(int(cols['date'][row]))
+            value = int(cols[key][row])
+            # the smallest value of the column stands for None, as in the columnar reads of the DB layers
+            return None if value == np.iinfo(cols[key].dtype).min else value
+        return self._graph._node_extra[row][key]
+
+    def __setitem__(self, key, value):
+        cols = self._graph._columns
+        row = self._row
+        if key in NODE_ATTRS:
+            cols['has_attrs'][row] = True
+            if key == 'coord':
+                cols['coord'][row] = value
+            elif key == 'creator':
+                cols['creator'][row] = self._graph._encode_creator(value)
+            elif key == 'date':
+                cols['date'][row] = _to_epoch(value)
+            else:
+                cols[key][row] = np.iinfo(cols[key].dtype).min if value is None else value
+        else:
+            self._graph._node_extra.setdefault(row, {})[key] = value
+
+    def __delitem__(self, key):
+        # NODE_ATTRS are stored column-wise and disappear together
+        if key in NODE_ATTRS:
+            self._graph._columns['has_attrs'][self._row] = False
+        else:
+            del self._graph._node_extra[self._row][key]
+
+    def clear(self):
+        self._graph._columns['has_attrs'][self._row] = False
+        self._graph._node_extra.pop(self._row, None)
+
+    def __iter__(self):
+        if self._graph._columns['has_attrs'][self._row]:
+            yield from NODE_ATTRS
+        yield from list(self._graph._node_extra.get(self._row, {}))
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+
+class _EdgeAttrs(MutableMapping):
+    def __init__(self, graph:CSRGraph, ru:int, rv:int):
+        self._graph = graph
+        self._ru = ru
+        self._rv = rv
+
+    def __getitem__(self, key):
+        creator, date = self._graph._edge_get(self._ru, self._rv)
+        if key == 'creator':
+            return self._graph._decode_creator(creator)
+        if key == 'date':
+            return _from_epoch(date)
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key == 'creator':
+            self._graph._edge_set(self._ru, self._rv, creator=self._graph._encode_creator(value))
+        elif key == 'date':
+            self._graph._edge_set(self._ru, self._rv, date=_to_epoch(value))
+        else:
+            raise KeyError(key)
+
+    def __delitem__(self, key):
+        self[key] = None
+
+    def clear(self):
+        self._graph._edge_set(self._ru, self._rv, creator=-1, date=NAT)
+
+    def __iter__(self):
+        return iter(EDGE_ATTRS)
+
+    def __len__(self):
+        return len(EDGE_ATTRS)
+
+
+class _NodeView():
+    def __init__(self, graph:CSRGraph):
+        self._graph = graph
+
+    def __call__(self, data=False, default=None):
+        if data is False:
+            return self
+        return _NodeDataView(self._graph, data, default)
+
+    def __iter__(self):
+        nids = self._graph._columns['nid']
+        rows = np.flatnonzero(self._graph._columns['alive'][:self._graph._n])
+        return iter(nids[rows].tolist())
+
+    def __len__(self):
+        return len(self._graph)
+
+    def __contains__(self, nid):
+        return nid in self._graph
+
+    def __getitem__(self, nid):
+        return _NodeAttrs(self._graph, self._graph._row(nid))
+
+
+class _NodeDataView():
+    def __init__(self, graph:CSRGraph, data, default=None):
+        self._graph = graph
+        self._data = data
+        self._default = default
+
+    def __iter__(self):
+        for nid in self._graph.nodes:
+            yield nid, self[nid]
+
+    def __len__(self):
+        return len(self._graph)
+
+    def __getitem__(self, nid):
+        attrs = _NodeAttrs(self._graph, self._graph._row(nid))
+        if self._data is True:
+            return dict(attrs)
+        return attrs.get(self._data, self._default)
+
+
+class _EdgeView():
+    def __init__(self, graph:CSRGraph):
+        self._graph = graph
+
+    def __call__(self, nbunch=None, data=False, default=None):
+        graph = self._graph
+        if nbunch is None:
+            nids = list(graph.nodes)
+        elif nbunch in graph:
+            nids = [nbunch]
+        else:
+            nids = [nid for nid in nbunch if nid in graph]
+        seen = set()
+        edges = []
+        nid_col = graph._columns['nid']
+        for nid in nids:
+            row = graph._row(nid)
+            for nbr in graph._neighbor_rows(row):
+                if nbr in seen:
+                    continue
+                v = int(nid_col[nbr])
+                if data is False:
+                    edges.append((nid, v))
+                else:
+                    attrs = _EdgeAttrs(graph, row, nbr)
+                    edges.append((nid, v, dict(attrs) if data is True else attrs.get(data, default)))
+            seen.add(row)
+        return edges
+
+    def __iter__(self):
+        return iter(self())
+
+    def __len__(self):
+        return self._graph.number_of_edges()
+
+    def __contains__(self, edge):
+        return self._graph.has_edge(edge[0], edge[1])
+
+    def __getitem__(self, edge):
+        u, v = edge[:2]
+        ru, rv = self._graph._row(u), self._graph._row(v)
+        if not self._graph._has_edge_rows(ru, rv):
+            raise KeyError(edge)
+        return _EdgeAttrs(self._graph, ru, rv)
+
+
+class _DegreeView():
+    def __init__(self, graph:CSRGraph):
+        self._graph = graph
+
+    def __call__(self, nbunch=None):
+        if nbunch is None:
+            return self
+        if nbunch in self._graph:
+            return self[nbunch]
+        return iter([(nid, self[nid]) for nid in nbunch if nid in self._graph])
+
+    def __getitem__(self, nid):
+        return int(self._graph._columns['deg'][self._graph._row(nid)])
+
+    def __iter__(self):
+        graph = self._graph
+        alive = graph._columns['alive'][:graph._n]
+        nids = graph._columns['nid'][:graph._n][alive].tolist()
+        degs = graph._columns['deg'][:graph._n][alive].tolist()
+        return iter(zip(nids, degs))
+
+    def __len__(self):
+        return len(self._graph)
+
+
+class _NxNodeMap(Mapping):
+    def __init__(self, graph:CSRGraph):
+        self._graph = graph
+
+    def __getitem__(self, nid):
+        return dict(self._graph.nodes[nid])
+
+    def __iter__(self):
+        return iter(self._graph.nodes)
+
+    def __len__(self):
+        return len(self._graph)
+
+    def __contains__(self, nid):
+        return nid in self._graph
+
+
+class _NxAdjMap(Mapping):
+    def __init__(self, graph:CSRGraph):
+        self._graph = graph
+
+    def __getitem__(self, nid):
+        return _NxNbrMap(self._graph, self._graph._row(nid))
+
+    def __iter__(self):
+        return iter(self._graph.nodes)
+
+    def __len__(self):
+        return len(self._graph)
+
+    def __contains__(self, nid):
+        return nid in self._graph
+
+
+class _NxNbrMap(Mapping):
+    def __init__(self, graph:CSRGraph, row:int):
+        self._graph = graph
+        self._row = row
+
+    def __getitem__(self, nbr):
+        rv = self._graph._row(nbr)
+        if not self._graph._has_edge_rows(self._row, rv):
+            raise KeyError(nbr)
+        return dict(_EdgeAttrs(self._graph, self._row, rv))
+
+    def __iter__(self):
+        nids = self._graph._columns['nid']
+        return iter([int(nids[r]) for r in self._graph._neighbor_rows(self._row)])
+
+    def __len__(self):
+        return len(self._graph._neighbor_rows(self._row))
+
+    def __contains__(self, nbr):
+        try:
+            return self._graph._has_edge_rows(self._row, self._graph._row(nbr))
+        except KeyError:
+            return False
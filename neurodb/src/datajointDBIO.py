@@ -1,7 +1,19 @@
 import datajoint as dj
+import numpy as np
+import pandas as pd
+from contextlib import contextmanager
 from datetime import datetime
 
+from .segCodec import encode_points, decode_points
+from .metrics import instrumented
+from . import metrics
+
 class datajointDBIO:
+    # seqs behind the latest one that may still show up, see NeuroDB.refresh(). MySQL assigns auto_increment
+    # values on insert, not on commit, so a transaction committing late makes a lower seq visible after
+    # higher ones; it is picked up as long as fewer than CHANGELOG_WINDOW changes were made meanwhile
+    CHANGELOG_WINDOW = 10000
+
     def __init__(self, db_name:str, db_url:str, username:str, password:str):
         # Configure DataJoint connection
         dj.config['database.host'] = db_url
@@ -21,8 +33,8 @@ class datajointDBIO:
             definition = """
             sid: int                      # Segment ID (Primary Key)
             ---
-            points: longblob              # List of points in the segment
-            sampled_points: longblob      # List of sampled points in the segment
+            points: longblob              # Points of the segment, packed by segCodec
+            sampled_points: longblob      # Sampled points of the segment, packed by segCodec
             version: int                  # Version of the segment
             date: timestamp               # Creation timestamp
             """
@@ -42,8 +54,10 @@ class datajointDBIO:
             status: int                         # Status of the node
             -> [nullable] Segs.proj(sid='sid')  # Segment ID (Foreign Key)
             date: timestamp                     # Creation timestamp
+            index(x, y, z)
             """
         self.NodesTable = Nodes
+        self._ensure_coord_index()
 
         @self.schema
         class Edges(dj.Manual):
@@ -61,23 +75,85 @@ class datajointDBIO:
                 self.insert1(key)
         self.EdgesTable = Edges
 
-    def add_segs(self, seg:list[dict]):
+        @self.schema
+        class Changelog(dj.Manual):
+            definition = """
+            seq: bigint auto_increment      # Change sequence number (Primary Key)
+            ---
+            tbl: varchar(16)                # 'nodes' or 'edges'
+            op: varchar(16)                 # 'insert', 'update' or 'delete'
+            key1: int                       # nid for nodes, src for edges
+            key2=null: int                  # dst for edges
+            date=CURRENT_TIMESTAMP: timestamp
+            """
+        self.ChangelogTable = Changelog
+
+    @contextmanager
+    def transaction(self):
+        # datajoint does not nest transactions, so inner calls join the outer one
+        conn = dj.conn()
+        if conn.in_transaction:
+            yield conn
+        else:
+            try:
+                with conn.transaction:
+                    yield conn
+            except BaseException:
+                metrics.transaction('datajoint', 'rollback')
+                raise
+            metrics.transaction('datajoint', 'commit')
+
+    def _log_changes(self, tbl:str, op:str, keys:list):
+        # record mutations in the changelog, called inside the transaction of the mutation
+        # keys: [nid] for nodes, [(src, dst)] for edges
+        if tbl == 'nodes':
+            entries = [{'tbl': tbl, 'op': op, 'key1': int(nid)} for nid in keys]
+        else:
+            entries = [{'tbl': tbl, 'op': op, 'key1': int(src), 'key2': int(dst)} for src, dst in keys]
+        if entries:
+            self.ChangelogTable.insert(entries)
+
+    def _ensure_coord_index(self):
+        # tables declared before index(x, y, z) was part of the definition need it added
+        table = self.NodesTable.full_table_name
+        rows = dj.conn().query(f"SHOW INDEX FROM {table}", as_dict=True).fetchall()
+        columns = {}
+        for row in rows:
+            columns.setdefault(row['Key_name'], []).append((row['Seq_in_index'], row['Column_name']))
+        for key_columns in columns.values():
+            if [c for _, c in sorted(key_columns)][:3] == ['x', 'y', 'z']:
+                return
+        dj.conn().query(f"ALTER TABLE {table} ADD INDEX idx_nodes_xyz (x, y, z)")
+
+    @instrumented(rows='arg')
+    def add_segs(self, seg:list[dict], skip_duplicates:bool=False):
         # seg: [{'sid', 'points', 'sampled_points', 'version', 'date'}]
-        with dj.conn().transaction:
+        # skip_duplicates: skip segs whose sid already exists
+        with self.transaction():
             try:
-                if seg:
-                    self.SegsTable.insert(seg)
+                entries = []
+                for s in seg:
+                    entries.append(dict(
+                        s,
+                        points=encode_points(s['points']),
+                        sampled_points=encode_points(s['sampled_points'])
+                    ))
+                if entries:
+                    self.SegsTable.insert(entries, skip_duplicates=skip_duplicates)
             except Exception as e:
                 print(f'Error in add_seg: {e}')
                 raise e
 
-    def add_nodes(self, nodes:list[dict]):
+    @instrumented(rows='arg')
+    def add_nodes(self, nodes:list[dict], skip_duplicates:bool=False):
         # nodes: [{'nid', 'coord', 'creator', 'type', 'checked', 'status', 'sid', 'date'}]
-        with dj.conn().transaction:
+        # skip_duplicates: skip nodes whose nid exists; their changelog entries are harmless, refresh() is state based
+        with self.transaction():
             entries = []
             date = datetime.now()
             for n in nodes:
-                x, y, z = n['coord']
+                # numpy scalars, e.g. coords of segs given as arrays
+                x, y, z = (c.item() if isinstance(c, np.generic) else c for c in n['coord'])
                 entries.append({
                     'nid': n['nid'],
                     'x': x,
@@ -93,14 +169,17 @@ class datajointDBIO:
             # Insert all nodes at once
             try:
                 if entries:
-                    self.NodesTable.insert(entries)
+                    self.NodesTable.insert(entries, skip_duplicates=skip_duplicates)
+                    self._log_changes('nodes', 'insert', [n['nid'] for n in entries])
             except Exception as e:
                 print(f'Error in add_nodes: {e}')
                 raise e
     
-    def add_edges(self, edges:list[dict]):
+    @instrumented(rows='arg')
+    def add_edges(self, edges:list[dict], skip_duplicates:bool=False):
         # edges: [{'src', 'dst', 'creator', 'date'}]
-        with dj.conn().transaction:
+        # skip_duplicates: see add_nodes
+        with self.transaction():
             entries = []
             date = datetime.now()
             for e in edges:
@@ -115,60 +194,147 @@ class datajointDBIO:
                 })
             try:
                 if entries:
-                    self.EdgesTable.insert(entries)
+                    self.EdgesTable.insert(entries, skip_duplicates=skip_duplicates)
+                    self._log_changes('edges', 'insert', [(e['src'], e['dst']) for e in entries])
             except Exception as e:
                 print(f'Error in add_edges: {e}')
                 raise e
     
-    def read_segs(self):
-        return self.SegsTable.fetch(as_dict=True)
+    def iter_segs_batches(self, batch_size:int=1000, after:int=None):
+        # ([seg], last sid) ordered by sid, batch_size rows per query (keyset pagination)
+        # after: only segs with sid > after, e.g. the last sid of an earlier run
+        while True:
+            table = self.SegsTable if after is None else self.SegsTable & f'sid > {int(after)}'
+            segs = table.fetch(as_dict=True, order_by='sid', limit=batch_size)
+            if len(segs) == 0:
+                return
+            for seg in segs:
+                seg['points'] = decode_points(seg['points'])
+                seg['sampled_points'] = decode_points(seg['sampled_points'])
+            after = segs[-1]['sid']
+            yield list(segs), after
 
-    def read_nodes(self):
-        nodes_entries = self.NodesTable.fetch(as_dict=True)
-        nodes = []
-        for entry in nodes_entries:
-            coord = [entry['x'], entry['y'], entry['z']]
-            nodes.append({
+    def iter_nodes_batches(self, batch_size:int=10000, after:int=None):
+        # ([node], last nid) ordered by nid, batch_size rows per query (keyset pagination)
+        while True:
+            table = self.NodesTable if after is None else self.NodesTable & f'nid > {int(after)}'
+            entries = table.fetch(as_dict=True, order_by='nid', limit=batch_size)
+            if len(entries) == 0:
+                return
+            after = entries[-1]['nid']
+            yield [{
                 'nid': entry['nid'],
-                'coord': coord,
+                'coord': [entry['x'], entry['y'], entry['z']],
                 'creator': entry['creator'],
                 'type': entry['type'],
                 'checked': entry['checked'],
                 'status': entry['status'],
+                'sid': entry['sid'],
                 'date': entry['date']
-            })
-        return nodes
+            } for entry in entries], after
 
-    def read_edges(self, creator:str=None):
+    def iter_edges_batches(self, creator:str=None, batch_size:int=10000, after:tuple=None):
+        # ([edge], last (src, dst)) ordered by (src, dst), batch_size rows per query (keyset pagination)
+        edges = self.EdgesTable
         if creator is not None:
-            filter = {'creator': creator}
-            edges = self.EdgesTable & filter
-        else:
-            edges = self.EdgesTable
-        return edges.fetch(as_dict=True)
+            edges = edges & {'creator': creator}
+        while True:
+            if after is None:
+                table = edges
+            else:
+                src, dst = int(after[0]), int(after[1])
+                table = edges & f'src > {src} OR (src = {src} AND dst > {dst})'
+            entries = table.fetch(as_dict=True, order_by=('src', 'dst'), limit=batch_size)
+            if len(entries) == 0:
+                return
+            after = (entries[-1]['src'], entries[-1]['dst'])
+            yield list(entries), after
+
+    def iter_segs(self, batch_size:int=1000):
+        # stream segs ordered by sid
+        for segs, _ in self.iter_segs_batches(batch_size):
+            yield from segs
+
+    def iter_nodes(self, batch_size:int=10000):
+        # stream nodes ordered by nid
+        for nodes, _ in self.iter_nodes_batches(batch_size):
+            yield from nodes
+
+    def iter_edges(self, creator:str=None, batch_size:int=10000):
+        # stream edges ordered by (src, dst)
+        for edges, _ in self.iter_edges_batches(creator, batch_size):
+            yield from edges
+
+    @instrumented(rows='result')
+    def read_nodes_columnar(self, nids:list=None, as_frame:bool=False):
+        # {'nid', 'x', 'y', 'z', 'creator', 'type', 'checked', 'status', 'date'} as numpy arrays, ordered by nid
+        # nids: only read these nodes (missing ones are skipped)
+        columns = {
+            'nid': np.int64, 'x': np.int32, 'y': np.int32, 'z': np.int32, 'creator': object,
+            'type': np.int8, 'checked': np.int8, 'status': np.int8, 'date': 'datetime64[us]'
+        }
+        nodes = self.NodesTable
+        if nids is not None:
+            nodes = nodes & {'nid': {'in': [int(nid) for nid in nids]}}
+        values = nodes.fetch(*columns, order_by='nid')
+        data = {name: np.asarray(value, dtype=dtype) for (name, dtype), value in zip(columns.items(), values)}
+        if as_frame:
+            return pd.DataFrame(data)
+        return data
+
+    @instrumented(rows='result')
+    def read_edges_columnar(self, creator:str=None, pairs:list=None, as_frame:bool=False):
+        # {'src', 'dst', 'creator', 'date'} as numpy arrays, ordered by (src, dst)
+        # pairs: only read these (src,dst) edges (missing ones are skipped)
+        columns = {'src': np.int64, 'dst': np.int64, 'creator': object, 'date': 'datetime64[us]'}
+        edges = self.EdgesTable
+        if creator is not None:
+            edges = edges & {'creator': creator}
+        if pairs is not None:
+            edges = edges & [{'src': int(src), 'dst': int(dst)} for src, dst in pairs]
+        values = edges.fetch(*columns, order_by=('src', 'dst'))
+        data = {name: np.asarray(value, dtype=dtype) for (name, dtype), value in zip(columns.items(), values)}
+        if as_frame:
+            return pd.DataFrame(data)
+        return data
+
+    def read_segs(self):
+        return list(self.iter_segs())
+
+    def read_nodes(self):
+        return list(self.iter_nodes())
+
+    def read_edges(self, creator:str=None):
+        return list(self.iter_edges(creator))
     
+    @instrumented(rows='arg')
     def delete_nodes(self, nids:list, safemode=False):
-        with dj.conn().transaction:
+        with self.transaction():
             filter = {'nid': {'in': nids}}
             try:
-                (self.NodesTable & filter).delete(safemode=safemode)
+                # incident edges are removed by the cascade, refresh() drops them with the node
+                (self.NodesTable & filter).delete(safemode=safemode, transaction=False)
+                self._log_changes('nodes', 'delete', nids)
             except Exception as e:
                 print(e)
                 raise e
 
+    @instrumented(rows='arg')
     def delete_edges(self, edges:list, safemode=False):
         entries = []
         for src, dst in edges:
             if src > dst:
                 src, dst = dst, src
             entries.append({'src': src, 'dst': dst})
-        with dj.conn().transaction:
+        with self.transaction():
             try:
-                (self.EdgesTable & entries).delete(safemode=safemode)
+                (self.EdgesTable & entries).delete(safemode=safemode, transaction=False)
+                self._log_changes('edges', 'delete', [(e['src'], e['dst']) for e in entries])
             except Exception as e:
                 print(e)
                 raise e
     
+    @instrumented(rows='arg')
     def update_nodes(self, nids:list, creator:str=None, type:int=None, checked:int=None, status:int=None, date:datetime=None):
         filter = {'nid': {'in': nids}}
         update = {}
@@ -188,9 +354,11 @@ class datajointDBIO:
             date = datetime.now()
         update['date'] = date
 
-        with dj.conn().transaction:
+        with self.transaction():
             try:
+                updated = (self.NodesTable & filter).fetch('nid')
                 (self.NodesTable & filter).update(update)
+                self._log_changes('nodes', 'update', updated)
             except Exception as e: 
                 print(e)
                 raise e
@@ -213,6 +381,28 @@ class datajointDBIO:
         seg_version = seg_version[0] if len(seg_version) > 0 else 0
         return max_sid, seg_version
     
+    def get_identity(self):
+        # stable name of this database, used to key graph snapshots
+        return f"mysql:{dj.config['database.host']}/{self.schema.database}"
+
+    def get_counts(self):
+        # (number of nodes, number of edges)
+        return len(self.NodesTable), len(self.EdgesTable)
+
+    def get_max_change_seq(self):
+        # sequence number of the latest recorded change, 0 if there is none
+        max_seq = self.ChangelogTable.fetch('seq', order_by='seq DESC', limit=1)
+        max_seq = max_seq[0] if len(max_seq) > 0 else 0
+        return max_seq
+
+    @instrumented(rows='result')
+    def read_changes(self, since:int=0, limit:int=None):
+        # changes with seq > since, in seq order: [{'seq', 'tbl', 'op', 'key1', 'key2'}]
+        return (self.ChangelogTable & f'seq > {int(since)}').fetch(
+            'seq', 'tbl', 'op', 'key1', 'key2', as_dict=True, order_by='seq', limit=limit
+        )
+
+    @instrumented(rows='result')
     def read_nid_within_roi(self, roi):
         offset, size = roi[:3], roi[-3:]
         # between: [start, end]
@@ -223,9 +413,28 @@ class datajointDBIO:
         }
         nids = (self.NodesTable & filter).fetch('nid')
         return nids
+
+    @instrumented(rows='result')
+    def read_nid_nearest(self, coord, radius:int, k:int=None):
+        # nids within euclidean distance radius of coord, sorted by distance
+        x, y, z = [int(c) for c in coord]
+        r = int(radius)
+        filter = {
+            'x': {'between': (x-r, x+r)},
+            'y': {'between': (y-r, y+r)},
+            'z': {'between': (z-r, z+r)}
+        }
+        nids, xs, ys, zs = (self.NodesTable & filter).fetch('nid', 'x', 'y', 'z')
+        d2 = [(nx-x)**2+(ny-y)**2+(nz-z)**2 for nx, ny, nz in zip(xs, ys, zs)]
+        nearest = sorted((d, nid) for d, nid in zip(d2, nids) if d <= r*r)
+        nids = [nid for _, nid in nearest]
+        if k is not None:
+            nids = nids[:k]
+        return nids
     
+    @instrumented(rows='arg')
     def segs2db(self, segs):
-        with dj.conn().transaction:
+        with self.transaction():
             date = datetime.now()
             try:
                 max_sid, seg_version = self.get_max_sid_version()
@@ -266,6 +475,7 @@ class datajointDBIO:
                     self.add_nodes(node_entries)
                 if edge_entries:
                     self.add_edges(edge_entries)
+                return node_entries, edge_entries
             except Exception as e:
                 print(f'Error in segs2db: {e}')
                 raise e
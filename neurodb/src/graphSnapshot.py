@@ -0,0 +1,100 @@
+import hashlib
+import json
+import os
+import numpy as np
+import pandas as pd
+
+'''
+    graph snapshot: columnar nodes/edges of NeuroDB.G saved as one uncompressed .npz
+        meta: json {'format', 'identity', 'seq', 'num_nodes', 'num_edges'}
+        node_*: nid, x, y, z, type, checked, status, date (datetime64[us]), creator codes
+        edge_*: src, dst, date (datetime64[us]), creator codes
+        creators: creator names, code -1 stands for None
+    snapshots are opt-in (NeuroDB(snapshot=True)); one file per database in default_snapshot_dir(), the least
+    recently used ones are removed once the directory holds more than SNAPSHOT_DIR_MAX_BYTES
+'''
+
+SNAPSHOT_FORMAT = 1
+NODE_COLUMNS = ('nid', 'x', 'y', 'z', 'creator', 'type', 'checked', 'status', 'date')
+EDGE_COLUMNS = ('src', 'dst', 'creator', 'date')
+SNAPSHOT_DIR_MAX_BYTES = 4 * 1024 * 1024 * 1024    # 4 GB
+
+def default_snapshot_dir():
+    return os.environ.get('NEURODB_SNAPSHOT_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'neurodb', 'snapshots'))
+
+def snapshot_path(snapshot_dir:str, identity:str):
+    name = hashlib.sha1(identity.encode()).hexdigest()[:16]
+    return os.path.join(snapshot_dir, f'{name}.npz')
+
+def save_snapshot(path:str, meta:dict, NODES:dict, EDGES:dict):
+    # NODES/EDGES: columnar dicts as returned by read_nodes_columnar/read_edges_columnar
+    # written to a temporary file first, so a crash never leaves a truncated snapshot behind
+    creators = pd.Index(np.concatenate([
+        np.asarray(NODES['creator'], dtype=object), np.asarray(EDGES['creator'], dtype=object)
+    ])).dropna().unique()
+    arrays = {
+        'meta': np.array(json.dumps(dict(meta, format=SNAPSHOT_FORMAT))),
+        'creators': np.asarray(creators, dtype=str),
+    }
+    for prefix, data, columns in (('node', NODES, NODE_COLUMNS), ('edge', EDGES, EDGE_COLUMNS)):
+        for name in columns:
+            value = data[name]
+            if name == 'creator':
+                value = creators.get_indexer(np.asarray(value, dtype=object)).astype(np.int32)
+            elif name == 'date':
+                value = np.asarray(value, dtype='datetime64[us]')
+            arrays[f'{prefix}_{name}'] = np.asarray(value)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    prune_snapshots(os.path.dirname(os.path.abspath(path)), keep=path)
+
+def prune_snapshots(snapshot_dir:str, max_bytes:int=None, keep:str=None):
+    # remove the least recently used snapshots until the directory holds at most max_bytes of them
+    max_bytes = SNAPSHOT_DIR_MAX_BYTES if max_bytes is None else max_bytes
+    entries = []
+    for entry in os.scandir(snapshot_dir):
+        if entry.name.endswith('.npz') and entry.is_file():
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if keep is not None and os.path.abspath(path) == os.path.abspath(keep):
+            continue
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+
+def load_snapshot(path:str):
+    # (meta, NODES, EDGES), or None if the file is missing, unreadable or of another format
+    if not os.path.exists(path):
+        return None
+    try:
+        with np.load(path, allow_pickle=False) as data:
+            meta = json.loads(str(data['meta']))
+            if meta.get('format') != SNAPSHOT_FORMAT:
+                return None
+            names = np.append(data['creators'].astype(object), None)
+            tables = []
+            for prefix, columns in (('node', NODE_COLUMNS), ('edge', EDGE_COLUMNS)):
+                table = {}
+                for name in columns:
+                    value = data[f'{prefix}_{name}']
+                    table[name] = names[value] if name == 'creator' else value
+                tables.append(table)
+        # the modification time orders snapshots for prune_snapshots
+        os.utime(path)
+    except Exception as e:
+        print(f'Error in load_snapshot: {e}')
+        return None
+    return meta, tables[0], tables[1]
@@ -1,63 +1,322 @@
+import hashlib
+import json
+import os
 import numpy as np
 import h5py
 import zarr
 import re
-from tifffile import imread
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import tifffile
+
+from .blockCache import default_block_cache, read_regions
+from .metrics import instrumented
+
+
+HDF5_CACHE_CHUNKS = 64                      # chunks of the largest level the HDF5 chunk cache holds
+HDF5_CACHE_MIN_BYTES = 16 * 1024 * 1024
+HDF5_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+
+def _next_prime(n:int):
+    n = max(int(n), 2)
+    while any(n % i == 0 for i in range(2, int(n**0.5)+1)):
+        n += 1
+    return n
+
+def hdf5_cache_defaults(info:list, rdcc_nbytes:int=None):
+    # rdcc_nbytes/rdcc_nslots/rdcc_w0 for h5py.File from the data_chunks and dtype of the levels in Ims.get_info
+    #   nbytes: HDF5_CACHE_CHUNKS chunks of the largest level, within [HDF5_CACHE_MIN_BYTES, HDF5_CACHE_MAX_BYTES]
+    #   nslots: a prime about 100 times the number of chunks that fit, as the HDF5 docs advise
+    #   w0: chunks are re-read when ROIs overlap, so fully read chunks are not evicted first
+    chunk_bytes = max(int(np.prod(i['data_chunks'])) * np.dtype(i['dtype']).itemsize for i in info)
+    if rdcc_nbytes is None:
+        nbytes = min(max(HDF5_CACHE_CHUNKS*chunk_bytes, HDF5_CACHE_MIN_BYTES), HDF5_CACHE_MAX_BYTES)
+        nbytes = max(nbytes, chunk_bytes)
+    else:
+        nbytes = int(rdcc_nbytes)
+    return {
+        'rdcc_nbytes': nbytes,
+        'rdcc_nslots': _next_prime(100 * max(nbytes // chunk_bytes, 1)),
+        'rdcc_w0': 0.75,
+    }
+
+def _batch_rois(coords_list):
+    # (N,6) int array of [x_offset,y_offset,z_offset,x_size,y_size,z_size], all of the same size
+    rois = np.asarray([[int(coord) for coord in coords] for coords in coords_list], dtype=np.int64).reshape(-1, 6)
+    if len(rois) and not (rois[:, 3:] == rois[0, 3:]).all():
+        raise ValueError('from_rois needs ROIs of the same size.')
+    return rois
+
+def _from_rois_chunked(reader, image, key, rois, image_roi, padding, num_workers, native:str='zyx', **kwargs):
+    # rois read from the dataset image into one (N,X,Y,Z) array, every chunk read once
+    # image_roi: [x_offset,y_offset,z_offset,x_size,y_size,z_size] of the level
+    # native: axis order of image, 'zyx' or 'xyz'
+    axes = (2, 1, 0) if native == 'zyx' else (0, 1, 2)
+    size = tuple(rois[0, 3:]) if len(rois) else (0, 0, 0)
+    out = np.zeros((len(rois),) + size, dtype=image.dtype)
+    image_lo = np.asarray(image_roi[:3])
+    image_hi = image_lo + np.asarray(image_roi[3:])
+    regions, outs = [], []
+    for i, roi in enumerate(rois):
+        roi_lo, roi_hi = roi[:3], roi[:3] + roi[3:]
+        lo, hi = np.maximum(roi_lo, image_lo), np.minimum(roi_hi, image_hi)
+        if padding != 'constant' and ((lo != roi_lo).any() or (hi != roi_hi).any()):
+            # other padding modes are computed from the image content by np.pad
+            out[i] = reader.from_roi(roi, padding=padding, **kwargs)
+            continue
+        if (hi <= lo).any():
+            continue
+        rel_lo, rel_hi = lo - image_lo, hi - image_lo
+        regions.append(tuple(slice(int(rel_lo[d]), int(rel_hi[d])) for d in axes))
+        o, e = lo - roi_lo, hi - roi_lo
+        outs.append(out[i, o[0]:e[0], o[1]:e[1], o[2]:e[2]].transpose(axes))
+    read_regions(image, regions, outs, cache=getattr(reader, 'cache', None), key=key, num_workers=num_workers)
+    return out
+
+def _from_roi(coords, image_roi, dtype, read_into, native:str, padding='constant', out=None, order='xyz'):
+    # coords: [x_offset,y_offset,z_offset,x_size,y_size,z_size], image_roi: the same for the level
+    # read_into(region, target, sel): target[sel] = image[region], both in the native axis order of the reader
+    # out: optional buffer of the roi shape in order; the part inside the image is read straight into it and
+    # only the border outside the image is padded
+    if order not in ('xyz', 'zyx'):
+        raise ValueError(f"order must be 'xyz' or 'zyx', not {order!r}")
+    coords = [int(coord) for coord in coords]
+    roi_lo, size = coords[:3], coords[3:]
+    shape = tuple(size) if order == 'xyz' else tuple(size[::-1])
+    if out is None:
+        out = np.empty(shape, dtype=dtype)
+    elif tuple(out.shape) != shape:
+        raise ValueError(f'out has shape {tuple(out.shape)}, expected {shape}.')
+    image_lo = [int(i) for i in image_roi[:3]]
+    image_hi = [int(i)+int(j) for i, j in zip(image_roi[:3], image_roi[3:])]
+    lo = [max(r, l) for r, l in zip(roi_lo, image_lo)]
+    hi = [max(min(r+n, h), l) for r, n, h, l in zip(roi_lo, size, image_hi, lo)]
+    inner = [slice(l-r, h-r) for l, h, r in zip(lo, hi, roi_lo)]
+    region = [slice(l-i, h-i) for l, h, i in zip(lo, hi, image_lo)]
+    empty = any(h <= l for l, h in zip(lo, hi))
+    if not empty:
+        if native == order:
+            target = out
+        else:
+            target = out.transpose(2, 1, 0)
+        if native == 'xyz':
+            read_into(tuple(region), target, tuple(inner))
+        else:
+            read_into(tuple(region[::-1]), target, tuple(inner[::-1]))
+
+    pads = [(l-r, r+n-h) for l, h, r, n in zip(lo, hi, roi_lo, size)]
+    if any(p for pad in pads for p in pad):
+        out_xyz = out if order == 'xyz' else out.transpose(2, 1, 0)
+        if empty:
+            # nothing of the image to extend
+            out_xyz[...] = 0
+        elif padding == 'constant':
+            for axis, (before, after) in enumerate(pads):
+                index = [slice(None)]*3
+                if before:
+                    index[axis] = slice(0, before)
+                    out_xyz[tuple(index)] = 0
+                if after:
+                    index[axis] = slice(size[axis]-after, size[axis])
+                    out_xyz[tuple(index)] = 0
+        else:
+            # other modes are computed from the image content
+            out_xyz[...] = np.pad(out_xyz[tuple(inner)], pads, padding)
+    return out
+
+def _zarr_read_into(image, region, target, sel):
+    # target[sel] = image[region] decoded in place by zarr
+    view = target[sel]
+    try:
+        from zarr.core.buffer import default_buffer_prototype
+        image.get_basic_selection(region, out=default_buffer_prototype().nd_buffer.from_numpy_array(view))
+    except ImportError:
+        image.get_basic_selection(region, out=view)
+
+class _Squeezed():
+    '''
+    array without its length-1 axes, read on indexing (like np.squeeze for arrays that are not in memory)
+    '''
+    def __init__(self, array):
+        self.array = array
+        self.axes = [i for i, n in enumerate(array.shape) if n != 1]
+        self.shape = tuple(array.shape[i] for i in self.axes)
+        self.ndim = len(self.shape)
+        self.dtype = array.dtype
+        chunks = getattr(array, 'chunks', None)
+        self.chunks = tuple(chunks[i] for i in self.axes) if chunks is not None else None
+
+    def __getitem__(self, indices):
+        if not isinstance(indices, tuple):
+            indices = (indices,)
+        indices = indices + (slice(None),)*(self.ndim-len(indices))
+        full = [0]*self.array.ndim
+        for axis, index in zip(self.axes, indices):
+            full[axis] = index
+        return np.asarray(self.array[tuple(full)])
+
+
+class _Downsampled():
+    '''
+    every factor-th voxel of array along each axis, read on indexing with step 1 slices
+    '''
+    def __init__(self, array, factor:int):
+        self.array = array
+        self.factor = factor
+        self.shape = tuple(-(-n//factor) for n in array.shape)
+        self.ndim = len(self.shape)
+        self.dtype = array.dtype
+        self.chunks = None
+
+    def __getitem__(self, indices):
+        if not isinstance(indices, tuple):
+            indices = (indices,)
+        indices = indices + (slice(None),)*(self.ndim-len(indices))
+        full = []
+        for index, size in zip(indices, self.shape):
+            start, stop, _ = index.indices(size)
+            full.append(slice(start*self.factor, max(start, stop)*self.factor, self.factor))
+        return np.asarray(self.array[tuple(full)])
+
+
+def _open_tiff(image_path):
+    # lazy arrays of the resolution levels of the first series: a memmap for contiguous uncompressed
+    # data, tifffile's zarr store for tiled or compressed data
+    with tifffile.TiffFile(image_path) as tif:
+        num_levels = len(tif.series[0].levels)
+    if num_levels == 1:
+        try:
+            return [np.squeeze(tifffile.memmap(image_path, mode='r'))], None
+        except ValueError:
+            pass
+    store = tifffile.imread(image_path, aszarr=True)
+    data = zarr.open(store, mode='r')
+    arrays = [data] if isinstance(data, zarr.Array) else [data[str(i)] for i in range(num_levels)]
+    return [_Squeezed(array) if 1 in array.shape else array for array in arrays], store
+
 
 class Tiff():
-    def __init__(self, image_path):
-        self.image = np.squeeze(imread(image_path))
-        self.roi = [0,0,0] + list(self.image.shape)
-        self.rois = [self.roi]
+    '''
+    tiff image and returned image: [x,y,z], opened lazily, regions are read on demand
+    levels: number of resolution levels for files without a pyramid, level i takes every 2**i-th voxel
+    '''
+    def __init__(self, image_path, levels:int=1):
+        self.image_path = image_path
+        self.images, self._store = _open_tiff(image_path)
+        if len(self.images) == 1:
+            for i in range(1, levels):
+                factor = 2**i
+                if isinstance(self.images[0], np.ndarray):
+                    # strided view of the memmap, nothing is read until it is indexed
+                    self.images.append(self.images[0][::factor, ::factor, ::factor])
+                else:
+                    self.images.append(_Downsampled(self.images[0], factor))
+        self.image = self.images[0]
+        self.rois = [[0,0,0] + list(image.shape) for image in self.images]
+        self.roi = self.rois[0]
         self.shape = self.roi[3:6]
-    
-    def __getitem__(self, indices):
-        coords = [int(coord) for coord in coords]
+        self.info = [
+            {
+                'level': i,
+                'spacing': [s0/s for s0, s in zip(self.rois[0][3:], roi[3:])],
+                'image_size': roi[3:]
+            }
+            for i, roi in enumerate(self.rois)
+        ]
+
+    def close(self):
+        if self._store is not None:
+            self._store.close()
+            self._store = None
+
+    @instrumented(nbytes=True)
+    def __getitem__(self, indices, level=0):
         x_min, x_max = indices[0].start, indices[0].stop
         y_min, y_max = indices[1].start, indices[1].stop
         z_min, z_max = indices[2].start, indices[2].stop
-        x_slice = slice(x_min-self.roi[0],x_max-self.roi[0])
-        y_slice = slice(y_min-self.roi[1],y_max-self.roi[1])
-        z_slice = slice(z_min-self.roi[2],z_max-self.roi[2])
-        return self.image[x_slice,y_slice,z_slice]
-
-    def from_roi(self, coords, padding='constant', level=0, channel=0):
-        # coords: [x_offset,y_offset,z_offset,x_size,y_size,z_size]
-        coords = [int(coord) for coord in coords]
-        x_min, x_max = coords[0], coords[3]+coords[0]
-        y_min, y_max = coords[1], coords[4]+coords[1]
-        z_min, z_max = coords[2], coords[5]+coords[2]
-
-        # add padding
-        [xlb, ylb, zlb] = self.roi[0:3] 
-        [xhb, yhb, zhb] = [i+j for i,j in zip(self.roi[:3], self.roi[3:])]
-
-        xlp = max(xlb-x_min, 0)
-        xhp = max(x_max-xhb, 0)
-        ylp = max(ylb-y_min, 0)
-        yhp = max(y_max-yhb, 0)
-        zlp = max(zlb-z_min, 0)
-        zhp = max(z_max-zhb, 0)
+        x_slice = slice(x_min-self.rois[level][0],x_max-self.rois[level][0])
+        y_slice = slice(y_min-self.rois[level][1],y_max-self.rois[level][1])
+        z_slice = slice(z_min-self.rois[level][2],z_max-self.rois[level][2])
+        return np.asarray(self.images[level][x_slice,y_slice,z_slice])
 
-        x_slice = slice(x_min-self.roi[0]+xlp, x_max-self.roi[0]-xhp)
-        y_slice = slice(y_min-self.roi[1]+ylp, y_max-self.roi[1]-yhp)
-        z_slice = slice(z_min-self.roi[2]+zlp, z_max-self.roi[2]-zhp) 
-        img = self.image[x_slice,y_slice,z_slice]
+    def _read_into(self, level:int, region, target, sel):
+        target[sel] = self.images[level][region]
 
-        padded = np.pad(img, ((xlp, xhp), (ylp, yhp), (zlp, zhp)), padding) # padding can be constant or reflect
+    @instrumented(nbytes=True)
+    def from_roi(self, coords, padding='constant', level=0, channel=0, out=None, order='xyz'):
+        # coords: [x_offset,y_offset,z_offset,x_size,y_size,z_size]
+        # out: optional buffer to read into, order: axis order of the returned image, 'xyz' or 'zyx'
+        return _from_roi(
+            coords, self.rois[level], self.images[level].dtype,
+            lambda region, target, sel: self._read_into(level, region, target, sel),
+            'xyz', padding=padding, out=out, order=order
+        )
 
-        return padded
+    @instrumented(nbytes=True)
+    def from_rois(self, coords_list, padding='constant', level=0, channel=0, num_workers=None):
+        # coords_list: N rois of the same size, returns (N,x_size,y_size,z_size)
+        # tiled or compressed files: tiles shared by several rois are decoded once,
+        # num_workers > 1 copies tiles in a thread pool
+        # memmapped files: every roi is read straight into its slot, num_workers > 1 reads rois in a thread pool
+        rois = _batch_rois(coords_list)
+        if self._store is not None:
+            return _from_rois_chunked(
+                self, self.images[level], None, rois, self.rois[level], padding, num_workers,
+                native='xyz', level=level, channel=channel
+            )
+        size = tuple(rois[0, 3:]) if len(rois) else (0, 0, 0)
+        out = np.empty((len(rois),) + size, dtype=self.images[level].dtype)
+        def _read(i):
+            self.from_roi(rois[i], padding=padding, level=level, channel=channel, out=out[i])
+        if num_workers is not None and num_workers > 1 and len(rois) > 1:
+            with ThreadPoolExecutor(max_workers=num_workers) as pool:
+                list(pool.map(_read, range(len(rois))))
+        else:
+            for i in range(len(rois)):
+                _read(i)
+        return out
 
 
 class Ims():
     '''
     ims image: [z,y,x]
     input roi and returned image: [x,y,z]
+    cache: BlockCache of decoded chunks, None for the shared default_block_cache(), False to read directly
+    HDF5 tuning, None for the defaults derived from get_info (see hdf5_cache_defaults):
+        rdcc_nbytes, rdcc_nslots, rdcc_w0: raw data chunk cache of the file
+        page_buf_size: page buffer in bytes, only for files written with paged file space
+        driver, driver_kwds: h5py file driver, e.g. 'core' to hold the whole file in memory
+    read_stats() reports the read throughput of __getitem__/from_roi/from_rois.
     '''
-    def __init__(self, image_path):
+    def __init__(self, image_path, cache=None, rdcc_nbytes=None, rdcc_nslots=None, rdcc_w0=None,
+                 page_buf_size=None, driver=None, driver_kwds=None):
+        self.image_path = image_path
+        self.cache = default_block_cache() if cache is None else (None if cache is False else cache)
+        self._stats_lock = threading.Lock()
+        self.reset_read_stats()
+        # chunk layout and dtype come from the file itself, so open it once with the h5py defaults
         self.hdf = h5py.File(image_path, 'r')
-        self.rois = []
         self.info = self.get_info()
+        self.hdf.close()
+        options = hdf5_cache_defaults(self.info, rdcc_nbytes)
+        for key, value in (('rdcc_nslots', rdcc_nslots), ('rdcc_w0', rdcc_w0)):
+            if value is not None:
+                options[key] = value
+        if page_buf_size:
+            options['page_buf_size'] = int(page_buf_size)
+        if driver is not None:
+            options['driver'] = driver
+        self.hdf5_options = options
+        try:
+            self.hdf = h5py.File(image_path, 'r', **options, **(driver_kwds or {}))
+        except (OSError, ValueError) as e:
+            if 'page_buf_size' not in options:
+                raise e
+            print(f"Page buffering is not available for {image_path}, opening without it: {e}")
+            del options['page_buf_size']
+            self.hdf = h5py.File(image_path, 'r', **options, **(driver_kwds or {}))
+        self.rois = []
         for i in self.info:
             self.rois.append([int(j/k) for j,k in zip(i['origin'],i['spacing'])] + i['image_size'])
         self.extension = self.info[0]['origin'] + self.info[0]['dims_physical']
@@ -77,6 +336,43 @@ class Ims():
         
         return list(time_point_group.keys())
 
+    def close(self):
+        self.hdf.close()
+
+    def _record(self, nbytes:int, seconds:float):
+        with self._stats_lock:
+            self._reads += 1
+            self._bytes += int(nbytes)
+            self._seconds += seconds
+
+    def reset_read_stats(self):
+        with self._stats_lock:
+            self._reads = 0
+            self._bytes = 0
+            self._seconds = 0.0
+
+    def read_stats(self):
+        # read throughput since the last reset_read_stats, with the HDF5 options in use
+        with self._stats_lock:
+            reads, nbytes, seconds = self._reads, self._bytes, self._seconds
+        return {
+            'reads': reads,
+            'bytes': nbytes,
+            'seconds': seconds,
+            'mb_per_s': nbytes / 1e6 / seconds if seconds else 0.0,
+            'reads_per_s': reads / seconds if seconds else 0.0,
+            'ms_per_read': 1000 * seconds / reads if reads else 0.0,
+            'hdf5': dict(self.hdf5_options),
+        }
+
+    def _read(self, level:int, channel:int, z_slice, y_slice, x_slice):
+        # image[z_slice,y_slice,x_slice] of the level/channel dataset, through the block cache
+        image = self.dataset[self.resolution_levels[level]][self.time_point_key][self.channels[channel]]['Data']
+        if self.cache is None:
+            return image[z_slice,y_slice,x_slice]
+        return self.cache.read(image, (self.image_path, level, channel), (z_slice,y_slice,x_slice))
+
+    @instrumented(nbytes=True)
     def __getitem__(self, indices, level=0, channel=0):
         x_min, x_max = indices[0].start, indices[0].stop
         y_min, y_max = indices[1].start, indices[1].stop
@@ -84,40 +380,57 @@ class Ims():
         x_slice = slice(x_min-self.rois[level][0],x_max-self.rois[level][0])
         y_slice = slice(y_min-self.rois[level][1],y_max-self.rois[level][1])
         z_slice = slice(z_min-self.rois[level][2],z_max-self.rois[level][2])
+        start = time.perf_counter()
+        image = self._read(level, channel, z_slice, y_slice, x_slice)
+        self._record(image.nbytes, time.perf_counter()-start)
+        return np.transpose(image,(2,1,0))
+
+    def _read_into(self, level:int, channel:int, region, target, sel):
+        # target[sel] = image[region]; without a cache h5py decodes straight into target when it can
         image = self.dataset[self.resolution_levels[level]][self.time_point_key][self.channels[channel]]['Data']
-        return np.transpose(image[z_slice,y_slice,x_slice],(2,1,0))
+        if self.cache is not None:
+            read_regions(image, [region], [target[sel]], cache=self.cache, key=(self.image_path, level, channel))
+        elif target.flags.c_contiguous and target.dtype == image.dtype:
+            image.read_direct(target, source_sel=region, dest_sel=sel)
+        else:
+            target[sel] = image[region]
 
-    def from_roi(self, coords, padding='constant', level=0, channel=0):
+    @instrumented(nbytes=True)
+    def from_roi(self, coords, padding='constant', level=0, channel=0, out=None, order='xyz'):
         # coords: [x_offset,y_offset,z_offset,x_size,y_size,z_size]
+        # out: optional buffer to read into, order: axis order of the returned image, 'xyz' or 'zyx'
         if isinstance(level,str):
             level = self.resolution_levels.index(level)
         if isinstance(channel,str):
             channel = self.channels.index(channel)
-
-        coords = [int(coord) for coord in coords]
-        x_min, x_max = coords[0], coords[3]+coords[0]
-        y_min, y_max = coords[1], coords[4]+coords[1]
-        z_min, z_max = coords[2], coords[5]+coords[2]
-        # add padding
-        [xlb,ylb,zlb] = self.rois[level][0:3]
-        [xhb,yhb,zhb] = [i+j for i,j in zip(self.rois[level][:3],self.rois[level][3:])]
-        xlp = max(xlb-x_min,0)
-        xhp = max(x_max-xhb,0)
-        ylp = max(ylb-y_min,0)
-        yhp = max(y_max-yhb,0)
-        zlp = max(zlb-z_min,0)
-        zhp = max(z_max-zhb,0)
-
-        x_slice = slice(x_min-self.rois[level][0]+xlp,x_max-self.rois[level][0]-xhp)
-        y_slice = slice(y_min-self.rois[level][1]+ylp,y_max-self.rois[level][1]-yhp)
-        z_slice = slice(z_min-self.rois[level][2]+zlp,z_max-self.rois[level][2]-zhp)
-        if isinstance(level, int) and isinstance(channel, int):
-            image = self.dataset[self.resolution_levels[level]][self.time_point_key][self.channels[channel]]['Data']
-        else:
+        if not (isinstance(level, int) and isinstance(channel, int)):
             return
-        img = np.transpose(image[z_slice,y_slice,x_slice],(2,1,0))
-        padded = np.pad(img, ((xlp, xhp), (ylp, yhp), (zlp, zhp)), padding)
-        return padded
+        image = self.dataset[self.resolution_levels[level]][self.time_point_key][self.channels[channel]]['Data']
+        start = time.perf_counter()
+        out = _from_roi(
+            coords, self.rois[level], image.dtype,
+            lambda region, target, sel: self._read_into(level, channel, region, target, sel),
+            'zyx', padding=padding, out=out, order=order
+        )
+        self._record(out.nbytes, time.perf_counter()-start)
+        return out
+
+    @instrumented(nbytes=True)
+    def from_rois(self, coords_list, padding='constant', level=0, channel=0, num_workers=None):
+        # coords_list: N rois of the same size, returns (N,x_size,y_size,z_size)
+        # chunks shared by several rois are read once; num_workers > 1 copies chunks in a thread pool
+        if isinstance(level,str):
+            level = self.resolution_levels.index(level)
+        if isinstance(channel,str):
+            channel = self.channels.index(channel)
+        image = self.dataset[self.resolution_levels[level]][self.time_point_key][self.channels[channel]]['Data']
+        start = time.perf_counter()
+        out = _from_rois_chunked(
+            self, image, (self.image_path, level, channel), _batch_rois(coords_list), self.rois[level],
+            padding, num_workers, level=level, channel=channel
+        )
+        self._record(out.nbytes, time.perf_counter()-start)
+        return out
 
     def get_info(self):
         if 'DataSetInfo' in self.hdf.keys():
@@ -152,7 +465,8 @@ class Ims():
                     'dims_physical':dims_physical,
                     'image_size':dims_data,
                     'data_shape':[data.shape[2],data.shape[1],data.shape[0]],
-                    'data_chunks':[data.chunks[2],data.chunks[1],data.chunks[0]],
+                    'data_chunks':[data.chunks[2],data.chunks[1],data.chunks[0]] if data.chunks else [data.shape[2],data.shape[1],data.shape[0]],
+                    'dtype':str(data.dtype),
                     'spacing':spacing,
                     'origin':origin
                 }
@@ -160,6 +474,16 @@ class Ims():
         return info
 
 
+def _open_zarr(image_path):
+    # zarr 3 only opens zip files through an explicit ZipStore, zarr 2 also detects them by the path
+    if os.path.isfile(image_path):
+        try:
+            store = zarr.storage.ZipStore(image_path, mode='r')
+        except AttributeError:
+            store = zarr.ZipStore(image_path, mode='r')
+        return zarr.open(store, mode='r')
+    return zarr.open(image_path, mode='r')
+
 class ZipZarr():
     '''
     Load hierachical image data of several resolution levels like:
@@ -168,9 +492,12 @@ class ZipZarr():
         ├── 4um uint16
         ├── 8um uint16
         └── 16um uint16
+    cache: BlockCache of decoded chunks, None for the shared default_block_cache(), False to read directly
     '''
-    def __init__(self, image_path):
-        self.store = zarr.open(image_path,mode='r')
+    def __init__(self, image_path, cache=None):
+        self.image_path = image_path
+        self.cache = default_block_cache() if cache is None else (None if cache is False else cache)
+        self.store = _open_zarr(image_path)
         if 'nm' in list(self.store.keys())[0]:
             self.store = self.store['488nm_10X']
         resolution_dict = {
@@ -193,7 +520,8 @@ class ZipZarr():
             elif '16um' in dataset:
                 resolution_dict['16um'] = dataset
         self.images = [self.store[dataset] for key, dataset in resolution_dict.items() if dataset != []]
-        self.roi = [0,0,0] + list(self.images[0].shape)
+        # arrays are [z,y,x], rois and image_size [x,y,z]
+        self.roi = [0,0,0] + list(self.images[0].shape)[::-1]
         self.info = []
         self.rois = []
         for i,image in enumerate(self.images):
@@ -201,44 +529,60 @@ class ZipZarr():
                 {
                     'level': i,
                     'spacing': [resolutions[i],resolutions[i],resolutions[i]],
-                    'image_size': list(image.shape)
+                    'image_size': list(image.shape)[::-1]
                 }
             )
-            self.rois.append([0,0,0]+list(image.shape))
+            self.rois.append([0,0,0]+list(image.shape)[::-1])
 
-    def __getitem__(self, indices, level=0):
+    def _image(self, level:int, channel):
+        # array and block cache key of a level; zip zarr images have a single channel, channel is ignored
+        return self.images[level], (self.image_path, level, 0)
+
+    def _read(self, level:int, channel, z_slice, y_slice, x_slice):
+        # image[z_slice,y_slice,x_slice] of the level, through the block cache
+        image, key = self._image(level, channel)
+        if self.cache is None:
+            return image[z_slice,y_slice,x_slice]
+        return self.cache.read(image, key, (z_slice,y_slice,x_slice))
+
+    @instrumented(nbytes=True)
+    def __getitem__(self, indices, level=0, channel=0):
         x_min, x_max = indices[0].start, indices[0].stop
         y_min, y_max = indices[1].start, indices[1].stop
         z_min, z_max = indices[2].start, indices[2].stop
         x_slice = slice(x_min-self.rois[level][0],x_max-self.rois[level][0])
         y_slice = slice(y_min-self.rois[level][1],y_max-self.rois[level][1])
         z_slice = slice(z_min-self.rois[level][2],z_max-self.rois[level][2])
-        return np.transpose(self.images[level][z_slice,y_slice,x_slice],(2,1,0))
+        return np.transpose(self._read(level, channel, z_slice, y_slice, x_slice),(2,1,0))
 
-    def from_roi(self, coords, level=0, channel=0, padding='constant'):
+    def _read_into(self, level:int, channel, region, target, sel):
+        # target[sel] = image[region]; without a cache zarr decodes straight into target
+        image, key = self._image(level, channel)
+        if self.cache is not None:
+            read_regions(image, [region], [target[sel]], cache=self.cache, key=key)
+        else:
+            _zarr_read_into(image, region, target, sel)
+
+    @instrumented(nbytes=True)
+    def from_roi(self, coords, level=0, channel=0, padding='constant', out=None, order='xyz'):
         # coords: [x_offset,y_offset,z_offset,x_size,y_size,z_size]
-        coords = [int(coord) for coord in coords]
-        x_min, x_max = coords[0], coords[3]+coords[0]
-        y_min, y_max = coords[1], coords[4]+coords[1]
-        z_min, z_max = coords[2], coords[5]+coords[2]
-        # add padding
-        [xlb,ylb,zlb] = self.rois[level][0:3] 
-        [xhb,yhb,zhb] = [i+j for i,j in zip(self.rois[level][:3],self.rois[level][3:])]
-        xlp = max(xlb-x_min,0)
-        xhp = max(x_max-xhb,0)
-        ylp = max(ylb-y_min,0)
-        yhp = max(y_max-yhb,0)
-        zlp = max(zlb-z_min,0)
-        zhp = max(z_max-zhb,0)
-
-        x_slice = slice(x_min-self.rois[level][0]+xlp,x_max-self.rois[level][0]-xhp)
-        y_slice = slice(y_min-self.rois[level][1]+ylp,y_max-self.rois[level][1]-yhp)
-        z_slice = slice(z_min-self.rois[level][2]+zlp,z_max-self.rois[level][2]-zhp) 
-        img = np.transpose(self.images[level][z_slice,y_slice,x_slice],(2,1,0))
-
-        padded = np.pad(img, ((xlp, xhp), (ylp, yhp), (zlp, zhp)), padding)
-
-        return padded
+        # out: optional buffer to read into, order: axis order of the returned image, 'xyz' or 'zyx'
+        image, _ = self._image(level, channel)
+        return _from_roi(
+            coords, self.rois[level], image.dtype,
+            lambda region, target, sel: self._read_into(level, channel, region, target, sel),
+            'zyx', padding=padding, out=out, order=order
+        )
+
+    @instrumented(nbytes=True)
+    def from_rois(self, coords_list, level=0, channel=0, padding='constant', num_workers=None):
+        # coords_list: N rois of the same size, returns (N,x_size,y_size,z_size)
+        # chunks shared by several rois are read once; num_workers > 1 copies chunks in a thread pool
+        image, key = self._image(level, channel)
+        return _from_rois_chunked(
+            self, image, key, _batch_rois(coords_list), self.rois[level],
+            padding, num_workers, level=level, channel=channel
+        )
 
     def get_info(self):
         if 'DataSetInfo' in self.hdf.keys():
@@ -280,13 +624,119 @@ class ZipZarr():
             )
         return info
 
-def ImageReader(image_path):
+class LocalZarr(ZipZarr):
+    '''
+    directory zarr store written by imageTranscode.transcode, one [z,y,x] array per channel and level
+    named 'c<channel>/<level>', see transcoded_array
+    rois and info are those of the source image, so coordinates are the same as with the source reader.
+    channels: channel names of the source, as Ims.channels; channel_images holds the transcoded ones by index,
+        reading any other channel raises ValueError
+    cache: see ZipZarr
+    '''
+    def __init__(self, image_path, cache=None):
+        meta = read_transcode_meta(image_path)
+        if meta is None:
+            raise ValueError(f"{image_path} is not a transcoded image store.")
+        self.image_path = image_path
+        self.cache = default_block_cache() if cache is None else (None if cache is False else cache)
+        self.store = zarr.open_group(image_path, mode='r')
+        self.channels = list(meta['channel_names'])
+        self.channel_images = {
+            channel: [self.store[transcoded_array(level, channel)] for level in range(meta['levels'])]
+            for channel in meta['channels']
+        }
+        self.images = self.channel_images[meta['channels'][0]]
+        self.rois = [list(roi) for roi in meta['rois']]
+        self.roi = self.rois[0]
+        self.info = meta['info']
+        self.meta = meta
+
+    def _image(self, level:int, channel):
+        # channel: index of the source channel, or its name as with Ims
+        if isinstance(channel, str) and channel in self.channels:
+            channel = self.channels.index(channel)
+        if channel not in self.channel_images:
+            raise ValueError(
+                f"{self.image_path} holds channels {sorted(self.channel_images)} of {self.meta['source']}, not {channel}."
+            )
+        return self.channel_images[channel][level], (self.image_path, level, channel)
+
+
+TRANSCODE_FORMAT = 2
+TRANSCODE_ATTR = 'neurodb_transcode'
+
+def transcoded_array(level:int, channel:int):
+    # name of the array of a channel and level in a transcoded store
+    return f'c{channel}/{level}'
+
+def json_safe(value):
+    # reader info and options as they are stored in the transcode attributes; info of the readers holds numpy scalars
+    return json.loads(json.dumps(value, default=lambda v: v.item() if hasattr(v, 'item') else str(v)))
+
+def default_transcode_dir():
+    return os.environ.get('NEURODB_TRANSCODE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'neurodb', 'images'))
+
+def transcoded_path(image_path:str, transcode_dir:str=None):
+    # where transcode writes the local copy of image_path by default
+    image_path = os.path.abspath(image_path)
+    name = hashlib.sha1(image_path.encode()).hexdigest()[:8]
+    return os.path.join(transcode_dir or default_transcode_dir(), f'{os.path.basename(image_path)}-{name}.zarr')
+
+def source_identity(image_path:str):
+    # changes when the source file is replaced or rewritten
+    stat = os.stat(image_path)
+    return {'source': os.path.abspath(image_path), 'source_size': stat.st_size, 'source_mtime_ns': stat.st_mtime_ns}
+
+def read_transcode_meta(path:str):
+    # attributes of a store written by transcode, None for anything else
+    if not os.path.isdir(path):
+        return None
+    try:
+        meta = zarr.open_group(path, mode='r').attrs.get(TRANSCODE_ATTR)
+    except Exception:
+        return None
+    if not isinstance(meta, dict) or meta.get('format') != TRANSCODE_FORMAT:
+        return None
+    return dict(meta)
+
+def find_transcoded(image_path:str, transcode_dir:str=None, reader_kwargs:dict=None):
+    # path of a complete, up to date transcoded copy of image_path, or None
+    # the copy has to hold every channel of the source and be written with the same reader_kwargs
+    path = transcoded_path(image_path, transcode_dir)
+    meta = read_transcode_meta(path)
+    if meta is None or not meta.get('complete'):
+        return None
+    if meta['channels'] != list(range(len(meta['channel_names']))):
+        return None
+    if meta.get('reader_kwargs') != json_safe(reader_kwargs or {}):
+        return None
+    try:
+        identity = source_identity(image_path)
+    except OSError:
+        return None
+    if any(meta.get(key) != value for key, value in identity.items()):
+        return None
+    return path
+
+def ImageReader(image_path, cache=None, transcoded=True, **kwargs):
+    # cache: see Ims/ZipZarr, not used for tiff images
+    # transcoded: open the complete local copy written by imageTranscode.transcode instead, when there is one;
+    #   a copy is only used if transcode was given the same kwargs, otherwise the source is read with them
+    # kwargs: passed to the reader, e.g. rdcc_nbytes/rdcc_nslots/rdcc_w0/page_buf_size/driver/driver_kwds of Ims
+    if read_transcode_meta(image_path) is not None:
+        if kwargs:
+            raise ValueError(f"{image_path} is a transcoded image store, reader options {sorted(kwargs)} do not apply to it.")
+        return LocalZarr(image_path, cache=cache)
+    if transcoded:
+        local_path = find_transcoded(image_path, reader_kwargs=kwargs)
+        if local_path is not None:
+            return LocalZarr(local_path, cache=cache)
     if 'ims' in image_path:
-        return Ims(image_path)
+        return Ims(image_path, cache=cache, **kwargs)
     elif 'zarr.zip' in image_path:
-        return ZipZarr(image_path)
+        return ZipZarr(image_path, cache=cache, **kwargs)
     elif 'tif' in image_path:
-        return Tiff(image_path)
+        return Tiff(image_path, **kwargs)
     else:
         raise Exception("image type not supported yet") 
 
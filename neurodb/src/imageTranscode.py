@@ -0,0 +1,216 @@
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import numpy as np
+import zarr
+from tqdm import tqdm
+
+from .imageReader import (
+    ImageReader, TRANSCODE_FORMAT, TRANSCODE_ATTR, transcoded_path, transcoded_array, source_identity,
+    read_transcode_meta, json_safe
+)
+
+'''
+    transcode an Ims / zip-zarr / tiff volume into a local directory zarr store, opened by ImageReader as LocalZarr
+        one [z,y,x] array per channel and level named 'c<channel>/<level>', chunks of TRANSCODE_CHUNKS compressed with blosc
+        levels are streamed in blocks of block_chunks^3 chunks, every chunk is written by exactly one block
+        done blocks are checkpointed to progress_c<channel>_<level>.npy, so an interrupted run continues where it stopped
+'''
+
+TRANSCODE_CHUNKS = (64, 64, 64)     # [z,y,x], about the size of a proofreading roi
+CHECKPOINT_SECONDS = 5
+
+_WORKER = None
+
+def _create_array(group, name:str, shape:tuple, chunks:tuple, dtype, cname:str, clevel:int):
+    if hasattr(group, 'create_array'):
+        from zarr.codecs import BloscCodec
+        return group.create_array(
+            name, shape=shape, chunks=chunks, dtype=dtype, fill_value=0, overwrite=True,
+            compressors=BloscCodec(cname=cname, clevel=clevel, shuffle='bitshuffle')
+        )
+    # zarr 2
+    from numcodecs import Blosc
+    return group.create_dataset(
+        name, shape=shape, chunks=chunks, dtype=dtype, fill_value=0, overwrite=True,
+        compressor=Blosc(cname=cname, clevel=clevel, shuffle=Blosc.BITSHUFFLE)
+    )
+
+def _block_grid(shape:tuple, block:tuple):
+    return tuple(-(-s // b) for s, b in zip(shape, block))
+
+def _progress_path(out_path:str, level:int, channel:int):
+    return os.path.join(out_path, f'progress_c{channel}_{level}.npy')
+
+def _load_progress(out_path:str, level:int, channel:int, num_blocks:int):
+    path = _progress_path(out_path, level, channel)
+    if os.path.exists(path):
+        try:
+            done = np.load(path)
+            if done.shape == (num_blocks,):
+                return done.astype(bool)
+        except Exception as e:
+            print(f"Error in transcode: unreadable progress {path}, channel {channel} level {level} is written again: {e}")
+    return np.zeros(num_blocks, dtype=bool)
+
+def _save_progress(out_path:str, level:int, channel:int, done:np.ndarray):
+    path = _progress_path(out_path, level, channel)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.save(f, done)
+    os.replace(tmp_path, path)
+
+def _init_worker(image_path:str, out_path:str, reader_kwargs:dict):
+    global _WORKER
+    reader = ImageReader(image_path, cache=False, transcoded=False, **reader_kwargs)
+    group = zarr.open_group(out_path, mode='r+')
+    _WORKER = (reader, group, {})
+
+def _close_worker():
+    global _WORKER
+    if _WORKER is not None and hasattr(_WORKER[0], 'close'):
+        _WORKER[0].close()
+    _WORKER = None
+
+def _transcode_block(task):
+    # task: (level, channel, block index, block shape [z,y,x]); copies one block of the source into the store
+    level, channel, block_id, block = task
+    reader, group, arrays = _WORKER
+    if (level, channel) not in arrays:
+        arrays[level, channel] = group[transcoded_array(level, channel)]
+    array = arrays[level, channel]
+    index = np.unravel_index(block_id, _block_grid(array.shape, block))
+    lo = [i*b for i, b in zip(index, block)]
+    hi = [min(l+b, s) for l, b, s in zip(lo, block, array.shape)]
+    roi = reader.rois[level]
+    coords = [roi[0]+lo[2], roi[1]+lo[1], roi[2]+lo[0], hi[2]-lo[2], hi[1]-lo[1], hi[0]-lo[0]]
+    image = reader.from_roi(coords, level=level, channel=channel, order='zyx')
+    array[lo[0]:hi[0], lo[1]:hi[1], lo[2]:hi[2]] = image
+    return level, channel, block_id
+
+def transcode(image_path:str, out_path:str=None, chunks:tuple=TRANSCODE_CHUNKS, cname:str='lz4', clevel:int=5,
+              channels:list=None, block_chunks:int=4, num_workers:int=None, transcode_dir:str=None, overwrite:bool=False,
+              **reader_kwargs):
+    # writes the local copy of image_path and returns its path (transcoded_path(image_path) by default)
+    # chunks: [z,y,x] chunk shape of the store; block_chunks: chunks per axis read from the source at once
+    # channels: channel indices to copy, all channels of the source by default;
+    #   ImageReader opens the copy in place of the source only when it holds all of them
+    # num_workers: processes copying blocks, os.cpu_count() by default, 1 to run in this process
+    # reader_kwargs: passed to the source reader, e.g. levels=3 for a tiff without a pyramid;
+    #   ImageReader uses the copy only when it is given the same kwargs
+    # rerunning after an interruption continues with the blocks that are not written yet,
+    # unless the source, channels, reader_kwargs, chunks or codec changed or overwrite is set
+    out_path = out_path or transcoded_path(image_path, transcode_dir)
+    chunks = tuple(int(c) for c in chunks)
+    block = tuple(c*block_chunks for c in chunks)
+    num_workers = num_workers or os.cpu_count() or 1
+
+    reader = ImageReader(image_path, cache=False, transcoded=False, **reader_kwargs)
+    try:
+        rois = [[int(i) for i in roi] for roi in reader.rois]
+        # tiff and zip zarr images have a single channel
+        channel_names = [str(name) for name in getattr(reader, 'channels', ['0'])]
+        channels = list(range(len(channel_names))) if channels is None else sorted(int(c) for c in channels)
+        if not channels or not set(channels) <= set(range(len(channel_names))):
+            raise ValueError(f"{image_path} has channels {list(range(len(channel_names)))}, not {channels}.")
+        dtypes = [np.dtype(reader.from_roi(rois[0][:3]+[1,1,1], level=0, channel=c).dtype).str for c in channels]
+        meta = dict(
+            source_identity(image_path),
+            format=TRANSCODE_FORMAT,
+            channels=channels,
+            channel_names=channel_names,
+            reader_kwargs=json_safe(reader_kwargs),
+            chunks=list(chunks),
+            codec={'cname': cname, 'clevel': clevel},
+            dtypes=dtypes,
+            levels=len(rois),
+            rois=rois,
+            info=json_safe(reader.info),
+            complete=False,
+        )
+    finally:
+        if hasattr(reader, 'close'):
+            reader.close()
+
+    existing = read_transcode_meta(out_path)
+    resume = (
+        existing is not None and not overwrite
+        and all(existing.get(key) == value for key, value in meta.items() if key != 'complete')
+    )
+    if resume and existing.get('complete'):
+        return out_path
+    if not resume:
+        if os.path.exists(out_path):
+            if existing is None:
+                raise ValueError(f"{out_path} exists and is not a transcoded image store.")
+            shutil.rmtree(out_path)
+        group = zarr.open_group(out_path, mode='w')
+        for channel, dtype in zip(channels, dtypes):
+            channel_group = group.require_group(f'c{channel}')
+            for level, roi in enumerate(rois):
+                shape = (roi[5], roi[4], roi[3])
+                _create_array(
+                    channel_group, str(level), shape, tuple(min(c, s) for c, s in zip(chunks, shape)), dtype, cname, clevel
+                )
+        group.attrs[TRANSCODE_ATTR] = meta
+
+    group = zarr.open_group(out_path, mode='r+')
+    dones = {}
+    tasks = []
+    for channel in channels:
+        for level in range(len(rois)):
+            num_blocks = int(np.prod(_block_grid(group[transcoded_array(level, channel)].shape, block)))
+            done = _load_progress(out_path, level, channel, num_blocks)
+            dones[level, channel] = done
+            tasks += [(level, channel, int(block_id), block) for block_id in np.flatnonzero(~done)]
+
+    def _checkpoint():
+        for (level, channel), done in dones.items():
+            _save_progress(out_path, level, channel, done)
+
+    pbar = tqdm(total=len(tasks), desc='transcoding')
+    last_checkpoint = time.monotonic()
+    try:
+        if num_workers <= 1 or len(tasks) <= 1:
+            _init_worker(image_path, out_path, reader_kwargs)
+            try:
+                for task in tasks:
+                    level, channel, block_id = _transcode_block(task)
+                    dones[level, channel][block_id] = True
+                    pbar.update(1)
+                    if time.monotonic() - last_checkpoint > CHECKPOINT_SECONDS:
+                        _checkpoint()
+                        last_checkpoint = time.monotonic()
+            finally:
+                _close_worker()
+        else:
+            with ProcessPoolExecutor(
+                max_workers=num_workers, initializer=_init_worker, initargs=(image_path, out_path, reader_kwargs)
+            ) as pool:
+                # a bounded number of blocks in flight, so huge volumes do not queue millions of futures
+                queue = iter(tasks)
+                pending = set()
+                while True:
+                    for task in queue:
+                        pending.add(pool.submit(_transcode_block, task))
+                        if len(pending) >= 4*num_workers:
+                            break
+                    if not pending:
+                        break
+                    finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        level, channel, block_id = future.result()
+                        dones[level, channel][block_id] = True
+                        pbar.update(1)
+                    if time.monotonic() - last_checkpoint > CHECKPOINT_SECONDS:
+                        _checkpoint()
+                        last_checkpoint = time.monotonic()
+    finally:
+        pbar.close()
+        _checkpoint()
+
+    group.attrs[TRANSCODE_ATTR] = dict(meta, complete=True)
+    for level, channel in dones:
+        os.remove(_progress_path(out_path, level, channel))
+    return out_path
@@ -0,0 +1,303 @@
+import functools
+import json
+import math
+import os
+import threading
+import time
+
+'''
+    opt-in instrumentation of NeuroDB, the DB layers and the image readers
+        enable()/disable(), or NEURODB_METRICS=1 in the environment; disabled, an instrumented call
+        costs one flag check
+        counters: monotonically increasing totals (rows, bytes, transactions, errors)
+        histograms: latency distributions in seconds over fixed BUCKETS
+        gauges: callbacks evaluated on snapshot(), e.g. block cache statistics
+    snapshot() returns all of them as plain python data, reset() clears counters and histograms.
+    exporters are callables taking a snapshot, run by export() or periodically by start_exporting().
+'''
+
+# upper bounds of the latency histograms in seconds, +inf is implied
+BUCKETS = tuple(float(f'{m}e{e}') for e in range(-5, 2) for m in (1, 2.5, 5)) + (100.0,)
+
+_enabled = os.environ.get('NEURODB_METRICS', '').lower() in ('1', 'true', 'yes', 'on')
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_gauges = {}
+_exporters = []
+_export_thread = None
+_export_stop = None
+
+
+class _Histogram():
+    __slots__ = ('counts', 'count', 'sum', 'min', 'max')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = 0.0
+
+    def observe(self, value:float):
+        index = 0
+        while index < len(BUCKETS) and value > BUCKETS[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def quantile(self, q:float):
+        # upper bound of the bucket holding the q-quantile, max for the overflow bucket
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+def disable():
+    global _enabled
+    _enabled = False
+
+def is_enabled():
+    return _enabled
+
+def _key(name:str, labels:dict):
+    return (name, tuple(sorted(labels.items())))
+
+def count(name:str, value:float=1, **labels):
+    # add value to the counter name{labels}
+    if not _enabled:
+        return
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+def observe(name:str, value:float, **labels):
+    # add one observation (seconds) to the histogram name{labels}
+    if not _enabled:
+        return
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = _Histogram()
+        histogram.observe(value)
+
+def transaction(backend:str, outcome:str):
+    # outcome: 'commit' or 'rollback' of an outermost transaction or an autocommitted call
+    if _enabled:
+        count('neurodb_transactions_total', 1, backend=backend, outcome=outcome)
+
+def _num_rows(value):
+    if isinstance(value, dict):
+        # columnar {'column': array}
+        value = next(iter(value.values()), ())
+    try:
+        return len(value)
+    except TypeError:
+        return 0
+
+def instrumented(op:str=None, rows:str=None, nbytes:bool=False):
+    # decorator recording the latency of every call in neurodb_call_seconds{op}, failed calls in neurodb_errors_total
+    # op: defaults to <class of self>.<method>, so subclasses are reported under their own name
+    # rows: 'arg' adds the length of the first argument, 'result' the length of the result to neurodb_rows_total{op}
+    # nbytes: add result.nbytes to neurodb_bytes_read_total{op}
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return fn(*args, **kwargs)
+            name = op or f'{type(args[0]).__name__}.{fn.__name__}'
+            start = time.perf_counter()
+            try:
+                result = fn(*args, **kwargs)
+            except BaseException as e:
+                count('neurodb_errors_total', 1, op=name, error=type(e).__name__)
+                raise
+            finally:
+                observe('neurodb_call_seconds', time.perf_counter() - start, op=name)
+            if rows == 'arg':
+                count('neurodb_rows_total', _num_rows(args[1] if len(args) > 1 else next(iter(kwargs.values()), ())), op=name)
+            elif rows == 'result':
+                count('neurodb_rows_total', _num_rows(result), op=name)
+            if nbytes and result is not None:
+                count('neurodb_bytes_read_total', getattr(result, 'nbytes', 0), op=name)
+            return result
+        return wrapper
+    return decorator
+
+def register_gauge(name:str, fn, **labels):
+    # fn() returns a number or a dict of numbers (one series per key, label 'field'), evaluated on snapshot()
+    with _lock:
+        _gauges[_key(name, labels)] = fn
+
+def unregister_gauge(name:str, **labels):
+    with _lock:
+        _gauges.pop(_key(name, labels), None)
+
+def snapshot():
+    # {'time', 'enabled', 'counters', 'histograms', 'gauges'}, series as {'name', 'labels', ...}
+    with _lock:
+        counters = list(_counters.items())
+        histograms = [(key, h.count, h.sum, h.min, h.max, list(h.counts), h.quantile(0.5), h.quantile(0.95), h.quantile(0.99))
+                      for key, h in _histograms.items()]
+        gauges = list(_gauges.items())
+    result = {
+        'time': time.time(),
+        'enabled': _enabled,
+        'counters': [{'name': name, 'labels': dict(labels), 'value': value} for (name, labels), value in counters],
+        'histograms': [],
+        'gauges': [],
+    }
+    for (name, labels), num, total, low, high, counts, p50, p95, p99 in histograms:
+        cumulative, buckets = 0, []
+        for bound, n in zip(BUCKETS + (math.inf,), counts):
+            cumulative += n
+            buckets.append([bound, cumulative])
+        result['histograms'].append({
+            'name': name, 'labels': dict(labels), 'count': num, 'sum': total,
+            'mean': total / num if num else 0.0, 'min': low if num else 0.0, 'max': high,
+            'p50': p50, 'p95': p95, 'p99': p99, 'buckets': buckets,
+        })
+    for (name, labels), fn in gauges:
+        try:
+            value = fn()
+        except Exception as e:
+            print(f"Error in metrics gauge {name}: {e}")
+            continue
+        if isinstance(value, dict):
+            for field, v in value.items():
+                if isinstance(v, (int, float)) and not isinstance(v, bool):
+                    result['gauges'].append({'name': name, 'labels': dict(labels, field=field), 'value': v})
+        else:
+            result['gauges'].append({'name': name, 'labels': dict(labels), 'value': value})
+    return result
+
+def reset():
+    # clear counters and histograms, gauges and exporters stay registered
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+
+def add_exporter(exporter):
+    # exporter(snapshot) is called by export()
+    with _lock:
+        _exporters.append(exporter)
+    return exporter
+
+def remove_exporter(exporter):
+    with _lock:
+        if exporter in _exporters:
+            _exporters.remove(exporter)
+
+def export():
+    # take a snapshot and hand it to every exporter
+    data = snapshot()
+    with _lock:
+        exporters = list(_exporters)
+    for exporter in exporters:
+        try:
+            exporter(data)
+        except Exception as e:
+            print(f"Error in metrics export: {e}")
+    return data
+
+def start_exporting(interval:float=60.0):
+    # export() every interval seconds in a daemon thread, until stop_exporting()
+    global _export_thread, _export_stop
+    stop_exporting()
+    _export_stop = threading.Event()
+    def _loop(stop):
+        while not stop.wait(interval):
+            export()
+    _export_thread = threading.Thread(target=_loop, args=(_export_stop,), name='neurodb-metrics', daemon=True)
+    _export_thread.start()
+
+def stop_exporting():
+    global _export_thread, _export_stop
+    if _export_thread is not None:
+        _export_stop.set()
+        _export_thread.join()
+        _export_thread = _export_stop = None
+
+
+class JsonLinesExporter():
+    '''
+    appends every snapshot as one json line to path
+    '''
+    def __init__(self, path:str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def __call__(self, data:dict):
+        line = json.dumps(data, default=lambda v: 'inf' if v == math.inf else str(v))
+        with self._lock, open(self.path, 'a') as f:
+            f.write(line + '\n')
+
+
+def _prometheus_name(name:str):
+    return ''.join(c if c.isalnum() or c in '_:' else '_' for c in name)
+
+def _prometheus_labels(labels:dict):
+    if not labels:
+        return ''
+    def _escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    body = ','.join(f'{_prometheus_name(k)}="{_escape(v)}"' for k, v in sorted(labels.items()))
+    return '{' + body + '}'
+
+def prometheus_text(data:dict):
+    # the snapshot in the Prometheus text exposition format
+    lines = []
+    typed = set()
+    def _type(name, kind):
+        if name not in typed:
+            typed.add(name)
+            lines.append(f'# TYPE {name} {kind}')
+    # samples of one metric have to follow its TYPE line
+    by_name = lambda series: series['name']
+    for series in sorted(data['counters'], key=by_name):
+        name = _prometheus_name(series['name'])
+        _type(name, 'counter')
+        lines.append(f"{name}{_prometheus_labels(series['labels'])} {series['value']}")
+    for series in sorted(data['gauges'], key=by_name):
+        name = _prometheus_name(series['name'])
+        _type(name, 'gauge')
+        lines.append(f"{name}{_prometheus_labels(series['labels'])} {series['value']}")
+    for series in sorted(data['histograms'], key=by_name):
+        name = _prometheus_name(series['name'])
+        _type(name, 'histogram')
+        for bound, cumulative in series['buckets']:
+            le = '+Inf' if bound == math.inf else repr(bound)
+            lines.append(f"{name}_bucket{_prometheus_labels(dict(series['labels'], le=le))} {cumulative}")
+        lines.append(f"{name}_sum{_prometheus_labels(series['labels'])} {series['sum']}")
+        lines.append(f"{name}_count{_prometheus_labels(series['labels'])} {series['count']}")
+    return '\n'.join(lines) + '\n'
+
+
+class PrometheusTextExporter():
+    '''
+    rewrites path with the latest snapshot in the Prometheus text format, e.g. for the textfile collector
+    of node_exporter; the file is replaced atomically so scrapers never see a partial file
+    '''
+    def __init__(self, path:str):
+        self.path = path
+
+    def __call__(self, data:dict):
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(prometheus_text(data))
+        os.replace(tmp_path, self.path)
@@ -1,18 +1,58 @@
+from contextlib import contextmanager
 from datetime import datetime
 import networkx as nx
 import numpy as np
 from tqdm import tqdm
 
 from .datajointDBIO import datajointDBIO
-from .sqliteDBIO import sqliteDBIO
+from .sqliteDBIO import sqliteDBIO, null_sentinel
+from .spatialIndex import GridIndex
+from .csrGraph import CSRGraph
+from .parallelConnect import score_end_nodes
+from .componentStats import ComponentCache
+from .graphSnapshot import default_snapshot_dir, snapshot_path, save_snapshot, load_snapshot
+from .metrics import instrumented
+
+# re-save a loaded snapshot once refresh() had to replay more changes than this
+SNAPSHOT_RESAVE_CHANGES = 10000
+
+def _nullable(values:np.ndarray):
+    # int column of read_nodes_columnar as a list, None where the database holds NULL
+    out = values.tolist()
+    for i in np.flatnonzero(values == null_sentinel(values.dtype)).tolist():
+        out[i] = None
+    return out
+
+def _non_nullable(values:list, dtype):
+    # inverse of _nullable, None becomes null_sentinel(dtype)
+    sentinel = null_sentinel(dtype)
+    return np.asarray([sentinel if value is None else value for value in values], dtype=dtype)
 
 class NeuroDB:
-    def __init__(self, db_name:str, config:dict=None, lazy_load_G:bool=True):
+    def __init__(self, db_name:str, config:dict=None, lazy_load_G:bool=True, graph_backend:str='networkx',
+                 snapshot:bool=False, snapshot_dir:str=None, rebuild:bool=False):
+        # graph_backend: 'networkx' for nx.Graph, 'csr' for the compact array-backed CSRGraph
+        # snapshot: load G from an on-disk snapshot (see graphSnapshot) and save one after a full load,
+        # a file of about the size of G per database under snapshot_dir
+        # rebuild: ignore an existing snapshot on the first load of G
+        if graph_backend not in ('networkx', 'csr'):
+            raise ValueError(f'Unknown graph backend: {graph_backend}')
         self.config = config
+        self.graph_backend = graph_backend
+        self.snapshot = snapshot
+        self.snapshot_dir = snapshot_dir or default_snapshot_dir()
+        self._rebuild = rebuild
         self.DB = None
         self.switch_to(db_name)
 
         self._G = None
+        self._index = None
+        self._components = None
+        self._seq = 0
+        self._seen = set()
+        self._batch = None
+        self._batch_date = None
+        self._undo = None
         if not lazy_load_G:
             self.init_graph()
     
@@ -22,6 +62,8 @@ class NeuroDB:
         if self.DB is not None:
             self.DB.switch_to(db_name)
             self._G = None
+            self._index = None
+            self._components = None
         else:
             if db_name.endswith('.db'):
                 self.DB = sqliteDBIO(db_name)
@@ -36,34 +78,323 @@ class NeuroDB:
         if self._G is None:
             self.init_graph()
         return self._G
+
+    @property
+    def nx_G(self):
+        # G as a networkx graph, read-only view for the csr backend
+        if isinstance(self.G, CSRGraph):
+            return self.G.nx_view()
+        return self.G
+
+    @property
+    def index(self):
+        # spatial index over the coords of nodes in G
+        if self._index is None:
+            self._index = GridIndex()
+            self._index.insert_many(self.G.nodes(data='coord'))
+        return self._index
     
-    def init_graph(self):
+    @instrumented()
+    def init_graph(self, rebuild:bool=False):
         if not self.DB:
             raise ValueError('DB not initialized.')
-        if self._G is None:
+        rebuild, self._rebuild = rebuild or self._rebuild, False
+        if self.snapshot and not rebuild and self._load_snapshot():
+            return
+        # read the change seq first, changes made while loading are re-applied by refresh()
+        self._seq = self.DB.get_max_change_seq()
+        self._seen = self._window_seqs()
+        NODES = self.DB.read_nodes_columnar()
+        EDGES = self.DB.read_edges_columnar()
+        self._build_graph(NODES, EDGES)
+        if self.snapshot:
+            self._save_snapshot(NODES, EDGES)
+
+    def _build_graph(self, NODES:dict, EDGES:dict):
+        self._components = None
+        coords = np.stack([NODES['x'], NODES['y'], NODES['z']], axis=1)
+        if self.graph_backend == 'csr':
+            self._G = CSRGraph.from_arrays(
+                nid=NODES['nid'], coord=coords, creator=NODES['creator'],
+                type=NODES['type'], checked=NODES['checked'], status=NODES['status'], date=NODES['date'],
+                src=EDGES['src'], dst=EDGES['dst'], edge_creator=EDGES['creator'], edge_date=EDGES['date'],
+            )
+        else:
             self._G = nx.Graph()
-        NODES = self.read_nodes()
-        EDGES = self.read_edges()
-        for node in NODES:
-            self._G.add_node(
-                node['nid'], 
-                coord=node['coord'], 
-                creator=node['creator'], 
-                type=node['type'], 
-                checked=node['checked'], 
-                status=node['status'], 
-                date=node['date']
+            node_dates = NODES['date'].tolist()
+            self._G.add_nodes_from(
+                (nid, {
+                    'coord': coord,
+                    'creator': creator,
+                    'type': type,
+                    'checked': checked,
+                    'status': status,
+                    'date': date
+                })
+                for nid, coord, creator, type, checked, status, date in zip(
+                    NODES['nid'].tolist(), coords.tolist(), NODES['creator'].tolist(), _nullable(NODES['type']),
+                    _nullable(NODES['checked']), _nullable(NODES['status']), node_dates
+                )
             )
-        for edge in EDGES:
-            self._G.add_edge(edge['src'], edge['dst'], creator=edge['creator'], date=edge['date'])
+            self._G.add_edges_from(
+                (src, dst, {'creator': creator, 'date': date})
+                for src, dst, creator, date in zip(
+                    EDGES['src'].tolist(), EDGES['dst'].tolist(), EDGES['creator'].tolist(), EDGES['date'].tolist()
+                )
+            )
+        self._index = GridIndex()
+        self._index.insert_many(zip(NODES['nid'].tolist(), coords.tolist()))
+
+    def _snapshot_path(self):
+        return snapshot_path(self.snapshot_dir, self.DB.get_identity())
+
+    def _load_snapshot(self):
+        # build G from the snapshot and bring it up to date with refresh(); False if it can not be used
+        snap = load_snapshot(self._snapshot_path())
+        if snap is None:
+            return False
+        meta, NODES, EDGES = snap
+        # a seq ahead of the DB means the database was recreated since the snapshot was taken
+        if meta['identity'] != self.DB.get_identity() or meta['seq'] > self.DB.get_max_change_seq():
+            return False
+        self._build_graph(NODES, EDGES)
+        self._seq = meta['seq']
+        # changes of the window that committed after the snapshot was saved are applied again by refresh()
+        self._seen = set()
+        num_changes = self.refresh()
+        if (self._num_stored_nodes(), self._G.number_of_edges()) != tuple(self.DB.get_counts()):
+            self._G, self._index = None, None
+            return False
+        if num_changes > SNAPSHOT_RESAVE_CHANGES:
+            self.save_snapshot()
+        return True
+
+    def _num_stored_nodes(self):
+        # nodes of G with a row in the DB; endpoints of edges without one are in G without attributes
+        if isinstance(self._G, CSRGraph):
+            return self._G.num_attributed_nodes()
+        return sum(1 for _, coord in self._G.nodes(data='coord') if coord is not None)
+
+    def _save_snapshot(self, NODES:dict, EDGES:dict):
+        meta = {
+            'identity': self.DB.get_identity(),
+            'seq': int(self._seq),
+            'num_nodes': len(NODES['nid']),
+            'num_edges': len(EDGES['src']),
+        }
+        try:
+            save_snapshot(self._snapshot_path(), meta, NODES, EDGES)
+        except Exception as e:
+            # a snapshot is only a cache, failing to write it must not break loading G
+            print(f'Error in save_snapshot: {e}')
+
+    @instrumented()
+    def save_snapshot(self):
+        # write the current G as the snapshot of this database
+        if self._batch is not None:
+            raise RuntimeError('save_snapshot() can not be called inside batch().')
+        G = self.G
+        # nodes without attributes are endpoints of edges without a node row, they come back with the edges
+        nodes = [(nid, attrs) for nid, attrs in G.nodes(data=True) if attrs.get('coord') is not None]
+        coords = np.asarray([attrs['coord'] for _, attrs in nodes], dtype=np.int32).reshape(-1, 3)
+        NODES = {
+            'nid': np.asarray([nid for nid, _ in nodes], dtype=np.int64),
+            'x': coords[:, 0], 'y': coords[:, 1], 'z': coords[:, 2],
+            'creator': np.asarray([attrs.get('creator') for _, attrs in nodes], dtype=object),
+            'type': _non_nullable([attrs.get('type', 0) for _, attrs in nodes], np.int8),
+            'checked': _non_nullable([attrs.get('checked', 0) for _, attrs in nodes], np.int8),
+            'status': _non_nullable([attrs.get('status', 0) for _, attrs in nodes], np.int8),
+            'date': np.asarray([attrs.get('date') for _, attrs in nodes], dtype='datetime64[us]'),
+        }
+        edges = list(G.edges(data=True))
+        EDGES = {
+            'src': np.asarray([min(src, dst) for src, dst, _ in edges], dtype=np.int64),
+            'dst': np.asarray([max(src, dst) for src, dst, _ in edges], dtype=np.int64),
+            'creator': np.asarray([data.get('creator') for _, _, data in edges], dtype=object),
+            'date': np.asarray([data.get('date') for _, _, data in edges], dtype='datetime64[us]'),
+        }
+        self._save_snapshot(NODES, EDGES)
+
+    @instrumented()
+    def refresh(self):
+        # apply the changes recorded in the DB changelog since G was loaded or last refreshed.
+        # the current DB state of every touched node/edge is re-read, so replaying a change is harmless.
+        # returns the number of changes applied
+        if self._batch is not None:
+            raise RuntimeError('refresh() can not be called inside batch().')
+        if self._G is None:
+            self.init_graph()
+            return 0
+        # a change with a seq below self._seq can still appear when its transaction commits late
+        # (CHANGELOG_WINDOW of the DB layer), so the window behind self._seq is read again
+        window = self.DB.CHANGELOG_WINDOW
+        changes = self.DB.read_changes(max(self._seq - window, 0))
+        changes = [change for change in changes if change['seq'] > self._seq or change['seq'] not in self._seen]
+        if len(changes) == 0:
+            return 0
+        nids, pairs = set(), set()
+        for change in changes:
+            if change['tbl'] == 'nodes':
+                nids.add(int(change['key1']))
+            else:
+                pairs.add((int(change['key1']), int(change['key2'])))
+
+        if nids:
+            NODES = self.DB.read_nodes_columnar(nids=sorted(nids))
+            coords = np.stack([NODES['x'], NODES['y'], NODES['z']], axis=1).tolist()
+            nid_list = NODES['nid'].tolist()
+            deleted = [nid for nid in nids - set(nid_list) if nid in self._G]
+            self._G.remove_nodes_from(deleted)
+            self._index.remove_many(deleted)
+            for nid, coord, creator, type, checked, status, date in zip(
+                nid_list, coords, NODES['creator'].tolist(), _nullable(NODES['type']),
+                _nullable(NODES['checked']), _nullable(NODES['status']), NODES['date'].tolist()
+            ):
+                self._G.add_node(nid, coord=coord, creator=creator, type=type, checked=checked, status=status, date=date)
+                self._index.insert(nid, coord)
+
+        if pairs:
+            EDGES = self.DB.read_edges_columnar(pairs=sorted(pairs))
+            edge_list = list(zip(EDGES['src'].tolist(), EDGES['dst'].tolist()))
+            deleted = [(src, dst) for src, dst in pairs - set(edge_list) if self._G.has_edge(src, dst)]
+            self._G.remove_edges_from(deleted)
+            for (src, dst), creator, date in zip(edge_list, EDGES['creator'].tolist(), EDGES['date'].tolist()):
+                self._G.add_edge(src, dst, creator=creator, date=date)
+
+        self._components = None
+        self._seq = max(self._seq, changes[-1]['seq'])
+        if window:
+            self._seen.update(change['seq'] for change in changes)
+            self._seen = {seq for seq in self._seen if seq > self._seq - window}
+        return len(changes)
+
+    def _window_seqs(self):
+        # seqs of the window behind self._seq that are committed now, i.e. contained in a state read after this
+        window = self.DB.CHANGELOG_WINDOW
+        if not window:
+            return set()
+        return {change['seq'] for change in self.DB.read_changes(max(self._seq - window, 0)) if change['seq'] <= self._seq}
+
+    @contextmanager
+    def batch(self):
+        # buffer the DB writes of enclosed mutations and flush them in one transaction on exit.
+        # G is updated immediately; if the block or the flush fails, DB and G are both rolled back.
+        if self._batch is not None:
+            yield self
+            return
+        self.index # load G before writes are buffered
+        self._batch, self._undo = [], []
+        self._batch_date = datetime.now()
+        try:
+            yield self
+            ops, self._batch = self._batch, None
+            with self.DB.transaction():
+                for method, args, kwargs in self._coalesce(ops):
+                    getattr(self.DB, method)(*args, **kwargs)
+        except BaseException:
+            for state in reversed(self._undo):
+                self._restore_state(state)
+            raise
+        finally:
+            self._batch, self._undo = None, None
+            self._batch_date = None
+
+    def _now(self):
+        # one date for all mutations of a batch(), so that their writes have equal arguments and merge
+        return self._batch_date or datetime.now()
+
+    @staticmethod
+    def _op_keys(method:str, items):
+        # nodes and edges a bulk write touches; an edge write also depends on its end nodes
+        keys = set()
+        for item in items:
+            if method.endswith('_edges'):
+                src, dst = (item['src'], item['dst']) if isinstance(item, dict) else item[:2]
+                keys.update((('n', src), ('n', dst), ('e', min(src, dst), max(src, dst))))
+            else:
+                keys.add(('n', item['nid'] if isinstance(item, dict) else item))
+        return keys
+
+    @staticmethod
+    def _coalesce(ops):
+        # merge calls of the same bulk method with equal keyword arguments into one call.
+        # a call joins the latest earlier group of its kind if no call in between touches the same
+        # nodes or edges, so the merged writes have the same effect as the calls in order.
+        groups = []   # [method, items, (other args, kwargs), touched keys]
+        for method, args, kwargs in ops:
+            params = (list(args[1:]), kwargs)
+            keys = NeuroDB._op_keys(method, args[0])
+            target = None
+            for group in reversed(groups):
+                if group[0] == method and group[2] == params:
+                    target = group
+                    break
+                if group[3] & keys:
+                    break
+            if target is None:
+                groups.append([method, list(args[0]), params, keys])
+            else:
+                target[1].extend(args[0])
+                target[3] |= keys
+        return [(method, [items] + rest, kwargs) for method, items, (rest, kwargs), _ in groups]
+
+    def _write(self, method:str, *args, **kwargs):
+        # write to DB now, or buffer until the enclosing batch() is flushed
+        if self._batch is not None:
+            self._batch.append((method, args, kwargs))
+        else:
+            getattr(self.DB, method)(*args, **kwargs)
+
+    def _save_state(self, nids=(), edges=()):
+        # inside batch(), remember nodes/edges (and edges incident to nids) so they can be restored
+        if self._undo is None:
+            return
+        G = self.G
+        nodes = {}
+        for nid in list(nids) + [nid for edge in edges for nid in edge[:2]]:
+            if nid not in nodes:
+                nodes[nid] = dict(G.nodes[nid]) if nid in G else None
+        edge_state = {}
+        for src, dst in list(G.edges([nid for nid in nids if nid in G])) + [edge[:2] for edge in edges]:
+            key = (src, dst) if src <= dst else (dst, src)
+            if key not in edge_state:
+                edge_state[key] = dict(G.edges[src, dst]) if G.has_edge(src, dst) else None
+        self._undo.append((nodes, edge_state))
 
+    def _restore_state(self, state):
+        nodes, edges = state
+        self._components = None
+        for nid, attrs in nodes.items():
+            if attrs is None:
+                continue
+            if nid not in self._G:
+                self._G.add_node(nid)
+            self._G.nodes[nid].clear()
+            self._G.nodes[nid].update(attrs)
+            if attrs.get('coord') is not None:
+                self._index.insert(nid, attrs['coord'])
+        for (src, dst), data in edges.items():
+            if data is None:
+                if self._G.has_edge(src, dst):
+                    self._G.remove_edge(src, dst)
+            else:
+                self._G.add_edge(src, dst)
+                self._G.edges[src, dst].clear()
+                self._G.edges[src, dst].update(data)
+        for nid, attrs in nodes.items():
+            if attrs is None and nid in self._G:
+                self._G.remove_node(nid)
+                self._index.remove(nid)
+
+    @instrumented()
     def add_nodes(self, nodes:list[dict]):
         # nodes: [{'nid', 'coord', 'creator', 'type', 'checked', 'status', 'date'}]
-        date = datetime.now()
+        date = self._now()
         for n in nodes:
             if 'date' not in n:
                 n['date'] = date
-        self.DB.add_nodes(nodes)
+        self._write('add_nodes', nodes)
+        self._save_state(nids=[node['nid'] for node in nodes])
         for node in nodes:
             self.G.add_node(
                 node['nid'], 
@@ -74,25 +405,41 @@ class NeuroDB:
                 status=node['status'], 
                 date=node['date']
             )
+            self.index.insert(node['nid'], node['coord'])
+            if self._components is not None:
+                self._components.add_node(self.G, node['nid'])
     
+    @instrumented()
     def add_edges(self, edges:list[dict]):
         # edges: [{'src', 'dst', 'creator', 'date'}]
-        date = datetime.now()
+        date = self._now()
         for e in edges:
             if 'date' not in e:
                 e['date'] = date
-        self.DB.add_edges(edges)
+        self._write('add_edges', edges)
+        self._save_state(edges=[(edge['src'], edge['dst']) for edge in edges])
         for edge in edges:
             self.G.add_edge(edge['src'], edge['dst'], creator=edge['creator'], date=edge['date'])
+            if self._components is not None:
+                self._components.add_edge(self.G, edge['src'], edge['dst'])
     
+    @instrumented()
     def delete_nodes(self, nids:list):
-        self.DB.delete_nodes(nids)
+        self._write('delete_nodes', nids)
+        self._save_state(nids=nids)
         self.G.remove_nodes_from(nids)
+        self.index.remove_many(nids)
+        if self._components is not None:
+            self._components.remove_nodes(self.G, nids)
     
+    @instrumented()
     def delete_edges(self, edges:list):
-        self.DB.delete_edges(edges)
+        self._write('delete_edges', edges)
+        self._save_state(edges=edges)
         for src, dst in edges:
             self.G.remove_edge(src, dst)
+            if self._components is not None:
+                self._components.remove_edge(self.G, src, dst)
     
     def read_nodes(self):
         return self.DB.read_nodes()
@@ -100,36 +447,127 @@ class NeuroDB:
     def read_edges(self, creator:str=None):
         return self.DB.read_edges(creator)
 
+    def iter_nodes(self, batch_size:int=10000):
+        return self.DB.iter_nodes(batch_size=batch_size)
+
+    def iter_edges(self, creator:str=None, batch_size:int=10000):
+        return self.DB.iter_edges(creator, batch_size=batch_size)
+
+    @instrumented()
+    def read_nid_within_roi(self, roi):
+        # roi: [x_offset,y_offset,z_offset,x_size,y_size,z_size], answered from the in-memory index
+        return self.index.query_roi(roi)
+
+    @instrumented()
+    def read_nid_nearest(self, coord, radius:int, k:int=None):
+        return self.index.query_radius(coord, radius, k)
+
+    @instrumented()
     def update_nodes(self, nids:list, creator:str=None, type:int=None, checked:int=None, status:int=None):
         def _update_nodes_in_graph(key:str, value:any=None, date:datetime=None):
             if value and (value != self.G.nodes[nid][key]):
                 self.G.nodes[nid][key] = value
                 self.G.nodes[nid]['date'] = date
-        date = datetime.now()
-        self.DB.update_nodes(nids, creator, type, checked, status, date)
+        date = self._now()
+        self._write('update_nodes', nids, creator=creator, type=type, checked=checked, status=status, date=date)
+        self._save_state(nids=nids)
         for nid in nids:
             _update_nodes_in_graph('creator', creator, date)
             _update_nodes_in_graph('type', type, date)
             _update_nodes_in_graph('checked', checked, date)
             _update_nodes_in_graph('status', status, date)
+        if self._components is not None:
+            self._components.update_nodes(self.G, nids)
     
     def check_node(self, nid:int):
-        date = datetime.now()
-        self.DB.check_node(nid, date)
+        date = self._now()
+        self._write('update_nodes', [nid], checked=1, date=date)
+        self._save_state(nids=[nid])
         self.G.nodes[nid]['checked'] = 1
         self.G.nodes[nid]['date'] = date
+        if self._components is not None:
+            self._components.update_nodes(self.G, [nid])
     
     def uncheck_nodes(self, nids:list[int]):
-        date = datetime.now()
-        self.DB.uncheck_nodes(nids, date)
+        date = self._now()
+        self._write('update_nodes', nids, checked=-1, date=date)
+        self._save_state(nids=nids)
         for nid in nids:
             self.G.nodes[nid]['checked'] = -1
             self.G.nodes[nid]['date'] = date
+        if self._components is not None:
+            self._components.update_nodes(self.G, nids)
+
+    @instrumented()
+    def segs2db(self, segs, bulk:bool=False, defer_indexes:bool=False):
+        # bulk, defer_indexes: high-throughput load of large segmentations, see sqliteDBIO.segs2db;
+        # the datajoint backend always inserts in batches and ignores them
+        if self._batch is not None:
+            raise RuntimeError('segs2db cannot be called inside batch().')
+        if bulk and isinstance(self.DB, sqliteDBIO):
+            self.DB.segs2db(segs, bulk=True, defer_indexes=defer_indexes)
+            # an already loaded graph picks the new nodes and edges up from the changelog
+            if self._G is not None:
+                self.refresh()
+            return
+        nodes, edges = self.DB.segs2db(segs)
+        # keep an already loaded graph in sync, otherwise it is read on first access
+        if self._G is None:
+            return
+        for node in nodes:
+            self._G.add_node(
+                node['nid'], 
+                coord=node['coord'], 
+                creator=node['creator'], 
+                type=node['type'], 
+                checked=node['checked'], 
+                status=node['status'], 
+                date=node['date']
+            )
+            self.index.insert(node['nid'], node['coord'])
+            if self._components is not None:
+                self._components.add_node(self._G, node['nid'])
+        for edge in edges:
+            self._G.add_edge(edge['src'], edge['dst'], creator=edge['creator'], date=edge['date'])
+            if self._components is not None:
+                self._components.add_edge(self._G, edge['src'], edge['dst'])
+
+    def _dfs_edges(self, source, depth_limit:int=None):
+        if isinstance(self.G, CSRGraph):
+            return self.G.dfs_edges(source, depth_limit=depth_limit)
+        return nx.dfs_edges(self.G, source, depth_limit=depth_limit)
+
+    def path_coords(self, source:int, depth_limit:int=None):
+        # coords of source and the nodes reached from it in depth-first order, e.g. for RoiPrefetcher.set_path
+        nids = [source] + [dst for _, dst in self._dfs_edges(source, depth_limit=depth_limit)]
+        return [self.G.nodes[nid]['coord'] for nid in nids]
 
-    def segs2db(self, segs):
-        self.DB.segs2db(segs)
+    def _connected_components(self):
+        if isinstance(self.G, CSRGraph):
+            return self.G.connected_components()
+        return nx.connected_components(self.G)
 
-    def connect_segs(self):
+    def _graph_arrays(self):
+        # G as read-only arrays over node rows (nids, coords, CSR indptr/indices), rows in node order
+        G = self.G
+        nids = np.fromiter(G.nodes, dtype=np.int64, count=G.number_of_nodes())
+        row_of = {nid: row for row, nid in enumerate(nids.tolist())}
+        node_coords = G.nodes(data='coord')
+        coords = np.asarray([node_coords[nid] for nid in nids.tolist()], dtype=np.int64).reshape(-1, 3)
+        degrees = np.fromiter((G.degree[nid] for nid in nids.tolist()), dtype=np.int64, count=len(nids))
+        indptr = np.zeros(len(nids)+1, dtype=np.int64)
+        np.cumsum(degrees, out=indptr[1:])
+        indices = np.fromiter(
+            (row_of[nbr] for nid in nids.tolist() for nbr in G.neighbors(nid)), dtype=np.int64, count=int(indptr[-1])
+        )
+        return nids, coords, indptr, indices
+
+    @instrumented()
+    def connect_segs(self, num_workers:int=None, tile_size:int=512):
+        # num_workers: None for the sequential walk over end nodes; otherwise end nodes are scored per
+        # spatial tile of tile_size voxels by num_workers processes (see parallelConnect) and matches
+        # are resolved greedily in end node order. Candidates are searched in a cube of dist_threshold
+        # centred on the end node.
         def _cal_angle(v1:np.ndarray, v2:np.ndarray):
             norm_v1 = np.linalg.norm(v1)
             norm_v2 = np.linalg.norm(v2)
@@ -138,97 +576,146 @@ class NeuroDB:
             angle = np.degrees(np.arccos(np.clip(np.dot(v1, v2), -1.0, 1.0)))
             return angle
 
+        def _cal_angles(v1:np.ndarray, v2:np.ndarray):
+            # row-wise _cal_angle for (N,3) arrays
+            with np.errstate(divide='ignore', invalid='ignore'):
+                v1 = v1 / np.linalg.norm(v1, axis=1, keepdims=True)
+                v2 = v2 / np.linalg.norm(v2, axis=1, keepdims=True)
+                dots = v1[:,0]*v2[:,0] + v1[:,1]*v2[:,1] + v1[:,2]*v2[:,2]
+                angles = np.degrees(np.arccos(np.clip(dots, -1.0, 1.0)))
+            return angles
+
         angle_disconnt = 100
         angle_connt_valid = 45
         angle_connt_invalid = 120
         dist_threshold = 12
 
-        # check all path nodes
-        path_nids = [node for node, degree in self.G.degree() if degree==2]
-        nodes_invalid = []
-        pbar = tqdm(path_nids, desc='proofreading')
-        for nid in pbar:
-            if self.G.degree[nid]!=2:
-                continue
-            nbr_nids = list(self.G.neighbors(nid))
-            v1 = np.asarray(self.G.nodes[nbr_nids[0]]['coord']) - np.asarray(self.G.nodes[nid]['coord'])
-            v2 = np.asarray(self.G.nodes[nbr_nids[1]]['coord']) - np.asarray(self.G.nodes[nid]['coord'])
-            angle = _cal_angle(v1, v2)
-            # if invalid
-            if angle < angle_disconnt:
-                self.delete_edges([[nid, nbr_nids[0]], [nid, nbr_nids[1]]])
-                nodes_invalid.append([nid, angle])
-            pbar.set_description(f'proofreading, num of invalid edges: {len(nodes_invalid)*2}')
+        # all edits are written to DB in one transaction
+        with self.batch():
+            # check all path nodes
+            # turning angles of all degree-2 nodes are computed in one batch. Removing the edges of an
+            # invalid node drops its neighbours to degree 1, so (as in a sequential walk in node order)
+            # a node is only marked invalid if no earlier neighbour in that order was marked invalid.
+            # The returned angles may differ from np.dot-based _cal_angle in the last ulp.
+            path_nids = [node for node, degree in self.G.degree() if degree==2]
+            nodes_invalid = []
+            edges_invalid = []
+            if path_nids:
+                node_coords = self.G.nodes(data='coord')
+                path_nbrs = [list(self.G.neighbors(nid)) for nid in path_nids]
+                coords = np.asarray([node_coords[nid] for nid in path_nids], dtype=np.float64)
+                nbr0_coords = np.asarray([node_coords[nbrs[0]] for nbrs in path_nbrs], dtype=np.float64)
+                nbr1_coords = np.asarray([node_coords[nbrs[1]] for nbrs in path_nbrs], dtype=np.float64)
+                angles = _cal_angles(nbr0_coords-coords, nbr1_coords-coords)
+                marked = set()
+                for idx in tqdm(np.flatnonzero(angles < angle_disconnt), desc='proofreading'):
+                    nid = path_nids[idx]
+                    nbr_nids = path_nbrs[idx]
+                    if nbr_nids[0] in marked or nbr_nids[1] in marked:
+                        continue
+                    marked.add(nid)
+                    nodes_invalid.append([nid, angles[idx]])
+                    edges_invalid.extend([[nid, nbr_nids[0]], [nid, nbr_nids[1]]])
+                if edges_invalid:
+                    self.delete_edges(edges_invalid)
         
-        # try to connect end nodes
-        edges_autoConnt = []
-        end_nids = [node for node, degree in self.G.degree() if degree==1]
-        pbar = tqdm(end_nids)
-        for end_nid in pbar:
-            if self.G.degree[end_nid]>1:
-                continue
-            curr_path_nids = [end_nid] + [des for src, des in list(nx.dfs_edges(self.G, end_nid, depth_limit=5))]
-            curr_coords = np.asarray([self.G.nodes[nid]['coord'] for nid in curr_path_nids])
-            offset = [i-dist_threshold//2 for i in curr_coords[0]]
-            roi = offset + [i+dist_threshold for i in offset]
-            curr_direction = np.sum(curr_coords[:-1:3] - curr_coords[1::3], axis=0)
-
-            nbr_nid_list = set(self.DB.read_nid_within_roi(roi)) - set(curr_path_nids)
-            nbr_nid_list = [nid for nid in nbr_nid_list if self.G.degree[nid]==1]
-            matched_nbr_nid = None
-            min_angle = angle_connt_valid
-            for nbr_nid in nbr_nid_list:
-                nbr_path_nids = [nbr_nid] + [des for src, des in list(nx.dfs_edges(self.G, nbr_nid, depth_limit=5))]
-                nbr_coords = np.asarray([self.G.nodes[nid]['coord'] for nid in nbr_path_nids])
-                nbr_direction = np.sum(nbr_coords[1::3] - nbr_coords[:-1:3], axis=0)
-
-                direction_angle = _cal_angle(curr_direction, nbr_direction)
-                connection_angle = min(
-                    _cal_angle(v1=curr_coords[1]-curr_coords[0], v2=nbr_coords[0]-curr_coords[0]),
-                    _cal_angle(v1=nbr_coords[1]-nbr_coords[0], v2=curr_coords[0]-nbr_coords[0]),
-                )
-                # if valid
-                if direction_angle<=min_angle and connection_angle>=angle_connt_invalid:
-                    min_angle = direction_angle
-                    matched_nbr_nid = nbr_nid
+            # try to connect end nodes
+            edges_autoConnt = []
+            if num_workers is not None:
+                nids, coords, indptr, indices = self._graph_arrays()
+                end_rows = np.flatnonzero(np.diff(indptr) == 1)
+                params = {
+                    'dist_threshold': dist_threshold,
+                    'angle_connt_valid': angle_connt_valid,
+                    'angle_connt_invalid': angle_connt_invalid,
+                    'depth_limit': 5,
+                }
+                matches = score_end_nodes(nids, coords, indptr, indices, end_rows, params, num_workers, tile_size)
+                # greedy as in the sequential walk: ends in node order take their best match that is still free.
+                # paths are traced before any connection is made, so matches that only appear through an
+                # earlier connection (short pieces between two auto connected ends) are not found.
+                used = set()
+                for end_nid in tqdm(nids[end_rows].tolist(), desc='auto connecting'):
+                    if end_nid in used:
+                        continue
+                    for _, nbr_nid in matches.get(end_nid, ()):
+                        if nbr_nid not in used:
+                            used.update((end_nid, nbr_nid))
+                            edges_autoConnt.append([end_nid, nbr_nid])
+                            break
+                if edges_autoConnt:
+                    self.add_edges([{'src':src, 'dst':dst, 'creator':'connector'} for src, dst in edges_autoConnt])
+                    self.uncheck_nodes([nid for edge in edges_autoConnt for nid in edge])
+            else:
+                end_nids = [node for node, degree in self.G.degree() if degree==1]
+                pbar = tqdm(end_nids)
+                for end_nid in pbar:
+                    if self.G.degree[end_nid]>1:
+                        continue
+                    curr_path_nids = [end_nid] + [des for src, des in list(self._dfs_edges(end_nid, depth_limit=5))]
+                    curr_coords = np.asarray([self.G.nodes[nid]['coord'] for nid in curr_path_nids])
+                    offset = [i-dist_threshold//2 for i in curr_coords[0]]
+                    # the same cube as the tiled mode; the roi size used to be offset+dist_threshold,
+                    # a cube reaching from the end node to about twice its coordinate
+                    roi = offset + [dist_threshold]*3
+                    curr_direction = np.sum(curr_coords[:-1:3] - curr_coords[1::3], axis=0)
+
+                    nbr_nid_list = set(self.read_nid_within_roi(roi)) - set(curr_path_nids)
+                    nbr_nid_list = [nid for nid in nbr_nid_list if self.G.degree[nid]==1]
+                    matched_nbr_nid = None
+                    min_angle = angle_connt_valid
+                    for nbr_nid in nbr_nid_list:
+                        nbr_path_nids = [nbr_nid] + [des for src, des in list(self._dfs_edges(nbr_nid, depth_limit=5))]
+                        nbr_coords = np.asarray([self.G.nodes[nid]['coord'] for nid in nbr_path_nids])
+                        nbr_direction = np.sum(nbr_coords[1::3] - nbr_coords[:-1:3], axis=0)
+
+                        direction_angle = _cal_angle(curr_direction, nbr_direction)
+                        connection_angle = min(
+                            _cal_angle(v1=curr_coords[1]-curr_coords[0], v2=nbr_coords[0]-curr_coords[0]),
+                            _cal_angle(v1=nbr_coords[1]-nbr_coords[0], v2=curr_coords[0]-nbr_coords[0]),
+                        )
+                        # if valid
+                        if direction_angle<=min_angle and connection_angle>=angle_connt_invalid:
+                            min_angle = direction_angle
+                            matched_nbr_nid = nbr_nid
 
-            if matched_nbr_nid is not None:
-                self.add_edges([{'src':end_nid, 'dst':matched_nbr_nid, 'creator':'connector'}])
-                self.uncheck_nodes([end_nid, matched_nbr_nid])
-                edges_autoConnt.append([end_nid, matched_nbr_nid])
-            pbar.set_description(f'auto connecting, num of auto connected segs: {len(edges_autoConnt)}')
+                    if matched_nbr_nid is not None:
+                        self.add_edges([{'src':end_nid, 'dst':matched_nbr_nid, 'creator':'connector'}])
+                        self.uncheck_nodes([end_nid, matched_nbr_nid])
+                        edges_autoConnt.append([end_nid, matched_nbr_nid])
+                    pbar.set_description(f'auto connecting, num of auto connected segs: {len(edges_autoConnt)}')
 
         print(f'Remove {len(nodes_invalid)*2} invalid edges.\nAuto Connect {len(edges_autoConnt)} segments.')
         return nodes_invalid, edges_autoConnt
 
-    def get_annotation_info(self, len_threshold:int=0):
-        connected_components = list(nx.connected_components(self.G))
-        valid_cc = []
-        for cc in connected_components:
-            if len(cc) < len_threshold:
-                continue
-            valid = True
-            for nid in cc:
-                if (self.G.degree(nid)==1 and self.G.nodes[nid]['checked']==0) or (self.G.nodes[nid]['checked']==-1):
-                    valid = False
-                    break
-            if valid:
-                valid_cc.append(cc)
-        info = []
-        for cc in valid_cc:
-            sub_G:nx.Graph = self.G.subgraph(cc)
-            length = 0
-            for src, des in sub_G.edges:
-                length += np.linalg.norm(np.array(sub_G.nodes[src]['coord']) - np.array(sub_G.nodes[des]['coord']))
-            branch_nid = [nid for nid in sub_G.nodes if sub_G.degree(nid) > 2]
-            end_nid = [nid for nid in sub_G.nodes if sub_G.degree(nid) == 1]
-            info.append({
-                'nid': list(cc),
-                'branch_nid': branch_nid,
-                'end_nid': end_nid,
-                'length': int(length)
-            })
-        info.sort(key=lambda x:x['length'], reverse=True)
-        return info
+    def _component_arrays(self):
+        # nids, coords, checked of the nodes of G in node order, and its edges once each as (src, dst) rows
+        G = self.G
+        if isinstance(G, CSRGraph):
+            columns = G.columns()
+            nids, coords, checked = columns['nid'], columns['coord'], columns['checked']
+            src, dst, _, _ = G.edge_rows()
+            remap = np.cumsum(G.alive()) - 1
+            once = src <= dst
+            edges = np.unique(np.stack([remap[src[once]], remap[dst[once]]], axis=1), axis=0).reshape(-1, 2)
+            return nids, coords, checked, edges[:, 0], edges[:, 1]
+        nids = np.fromiter(G.nodes, dtype=np.int64, count=G.number_of_nodes())
+        row_of = {nid: row for row, nid in enumerate(nids.tolist())}
+        attrs = [G.nodes[nid] for nid in nids.tolist()]
+        coords = np.asarray([attr.get('coord', (0, 0, 0)) for attr in attrs], dtype=np.float64).reshape(-1, 3)
+        checked = _non_nullable([attr.get('checked', 0) for attr in attrs], np.int64)
+        edges = np.fromiter(
+            (row_of[nid] for edge in G.edges() for nid in edge), dtype=np.int64, count=2*G.number_of_edges()
+        ).reshape(-1, 2)
+        return nids, coords, checked, edges[:, 0], edges[:, 1]
 
+    @property
+    def components(self):
+        # connected components of G with their statistics, maintained by the mutators after the first use
+        if self._components is None:
+            self._components = ComponentCache.from_arrays(*self._component_arrays())
+        return self._components
 
+    @instrumented()
+    def get_annotation_info(self, len_threshold:int=0):
+        return self.components.info(len_threshold)
@@ -0,0 +1,146 @@
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+'''
+    tile-parallel scoring of end node matches for NeuroDB.connect_segs
+        the graph is passed to the workers once, as read-only arrays over node rows:
+            nids: int64 (N,)
+            coords: int64 (N,3)
+            indptr, indices: CSR adjacency, neighbours in G's iteration order
+        end nodes are grouped into tiles of tile_size^3 voxels; a tile is scored against the
+        end nodes within its bounds grown by a halo of dist_threshold.
+'''
+
+_GRAPH = None
+
+def _init_worker(nids, coords, indptr, indices):
+    global _GRAPH
+    _GRAPH = (nids, coords, indptr, indices)
+
+def _dfs_rows(indptr, indices, source:int, depth_limit:int):
+    # rows in the order of [source] + [dst for src, dst in nx.dfs_edges(G, source, depth_limit)]
+    rows = [source]
+    visited = {source}
+    stack = [(source, depth_limit, iter(indices[indptr[source]:indptr[source+1]].tolist()))]
+    while stack:
+        parent, depth_now, children = stack[-1]
+        for child in children:
+            if child not in visited:
+                rows.append(child)
+                visited.add(child)
+                if depth_now > 1:
+                    stack.append((child, depth_now-1, iter(indices[indptr[child]:indptr[child+1]].tolist())))
+                break
+        else:
+            stack.pop()
+    return rows
+
+def _cal_angle(v1:np.ndarray, v2:np.ndarray):
+    norm_v1 = np.linalg.norm(v1)
+    norm_v2 = np.linalg.norm(v2)
+    v1 = v1 / norm_v1
+    v2 = v2 / norm_v2
+    angle = np.degrees(np.arccos(np.clip(np.dot(v1, v2), -1.0, 1.0)))
+    return angle
+
+def _score_tile(task):
+    # task: (end rows of the tile, end rows within tile + halo, parameters)
+    # returns [(end nid, [(direction angle, nbr nid), ...] of valid matches)]
+    tile_rows, halo_rows, params = task
+    nids, coords, indptr, indices = _GRAPH
+    dist_threshold = params['dist_threshold']
+    angle_connt_valid = params['angle_connt_valid']
+    angle_connt_invalid = params['angle_connt_invalid']
+    depth_limit = params['depth_limit']
+
+    halo_rows = np.asarray(halo_rows, dtype=np.int64)
+    halo_coords = coords[halo_rows]
+    # halo end nodes bucketed in cells of dist_threshold+1, a roi spans at most 2 cells per axis
+    cell = dist_threshold + 1
+    grid = {}
+    for i, key in enumerate(map(tuple, np.floor_divide(halo_coords, cell).tolist())):
+        grid.setdefault(key, []).append(i)
+    paths = {}
+    def _path(row):
+        if row not in paths:
+            path_rows = _dfs_rows(indptr, indices, row, depth_limit)
+            paths[row] = (path_rows, coords[path_rows])
+        return paths[row]
+
+    results = []
+    for end_row in tile_rows:
+        curr_rows, curr_coords = _path(end_row)
+        # roi as in read_nid_within_roi: offset at coord-dist_threshold//2, inclusive bounds
+        lo = curr_coords[0] - dist_threshold//2
+        hi = lo + dist_threshold
+        (x0, y0, z0), (x1, y1, z1) = np.floor_divide(lo, cell).tolist(), np.floor_divide(hi, cell).tolist()
+        candidates = sorted(
+            i for x in range(x0, x1+1) for y in range(y0, y1+1) for z in range(z0, z1+1)
+            for i in grid.get((x, y, z), ())
+        )
+        if not candidates:
+            continue
+        candidates = np.asarray(candidates, dtype=np.int64)
+        inside = np.all((halo_coords[candidates] >= lo) & (halo_coords[candidates] <= hi), axis=1)
+        curr_set = set(curr_rows)
+        nbr_rows = [row for row in halo_rows[candidates[inside]].tolist() if row not in curr_set]
+        if not nbr_rows:
+            continue
+        curr_direction = np.sum(curr_coords[:-1:3] - curr_coords[1::3], axis=0)
+        matches = []
+        for nbr_row in nbr_rows:
+            _, nbr_coords = _path(nbr_row)
+            nbr_direction = np.sum(nbr_coords[1::3] - nbr_coords[:-1:3], axis=0)
+            direction_angle = _cal_angle(curr_direction, nbr_direction)
+            connection_angle = min(
+                _cal_angle(v1=curr_coords[1]-curr_coords[0], v2=nbr_coords[0]-curr_coords[0]),
+                _cal_angle(v1=nbr_coords[1]-nbr_coords[0], v2=curr_coords[0]-nbr_coords[0]),
+            )
+            if direction_angle<=angle_connt_valid and connection_angle>=angle_connt_invalid:
+                matches.append((float(direction_angle), int(nids[nbr_row])))
+        if matches:
+            matches.sort()
+            results.append((int(nids[end_row]), matches))
+    return results
+
+def make_tiles(coords:np.ndarray, end_rows:np.ndarray, tile_size:int, halo:int):
+    # [(end rows of the tile, end rows within tile + halo)], tiles in sorted order
+    end_coords = coords[end_rows]
+    tile_ids = np.floor_divide(end_coords, tile_size)
+    keys, inverse = np.unique(tile_ids, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    order = np.argsort(inverse, kind='stable')
+    splits = np.flatnonzero(np.diff(inverse[order])) + 1
+    buckets = {tuple(key): members for key, members in zip(keys.tolist(), np.split(order, splits))}
+    # a halo reaches at most reach tiles beyond its own in every direction
+    reach = -(-halo // tile_size)
+    offsets = [(x, y, z) for x in range(-reach, reach+1) for y in range(-reach, reach+1) for z in range(-reach, reach+1)]
+    tiles = []
+    for key, members in buckets.items():
+        lo = np.asarray(key)*tile_size - halo
+        hi = (np.asarray(key)+1)*tile_size - 1 + halo
+        near = [buckets[nbr] for nbr in ((key[0]+x, key[1]+y, key[2]+z) for x, y, z in offsets) if nbr in buckets]
+        near = np.sort(np.concatenate(near))
+        inside = np.all((end_coords[near] >= lo) & (end_coords[near] <= hi), axis=1)
+        tiles.append((end_rows[members], end_rows[near[inside]]))
+    return tiles
+
+def score_end_nodes(nids, coords, indptr, indices, end_rows, params:dict, num_workers:int=1, tile_size:int=512):
+    # {end nid: [(direction angle, nbr nid), ...]} of valid matches, sorted by angle then nid
+    tiles = make_tiles(coords, end_rows, tile_size, params['dist_threshold'])
+    tasks = [(tile_rows.tolist(), halo_rows, params) for tile_rows, halo_rows in tiles]
+    matches = {}
+    if num_workers <= 1 or len(tasks) <= 1:
+        _init_worker(nids, coords, indptr, indices)
+        try:
+            for task in tasks:
+                matches.update(_score_tile(task))
+        finally:
+            _init_worker(None, None, None, None)
+    else:
+        with ProcessPoolExecutor(
+            max_workers=num_workers, initializer=_init_worker, initargs=(nids, coords, indptr, indices)
+        ) as pool:
+            for result in pool.map(_score_tile, tasks, chunksize=max(1, len(tasks)//(4*num_workers))):
+                matches.update(result)
+    return matches
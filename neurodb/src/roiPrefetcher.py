@@ -0,0 +1,148 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, CancelledError
+
+class RoiPrefetcher():
+    '''
+    Reads the next ROIs of a planned walk in background threads, for any reader with from_roi (Ims, ZipZarr, Tiff).
+        plan: list of roi [x_offset,y_offset,z_offset,x_size,y_size,z_size], set by set_rois or set_path
+        get(roi) returns the image of roi and keeps the lookahead ROIs after it in flight.
+    Changing the plan cancels the reads that have not started yet. Returned images are shared with the
+    cache and read-only.
+    '''
+    def __init__(self, reader, lookahead:int=8, num_workers:int=4, max_cached:int=64, level=0, channel=0, padding='constant'):
+        self.reader = reader
+        self.lookahead = lookahead
+        self.max_cached = max(max_cached, lookahead+1)
+        self.level = level
+        self.channel = channel
+        self.padding = padding
+        self.hits = 0
+        self.waits = 0
+        self.misses = 0
+        self._plan = []
+        self._plan_index = {}
+        self._pending = {}
+        self._cached = OrderedDict()
+        # re-entrant: done callbacks of futures that already finished run in the scheduling thread
+        self._lock = threading.RLock()
+        self._pool = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix='roi-prefetch')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _key(self, roi):
+        return tuple(int(c) for c in roi)
+
+    def _read(self, key):
+        image = self.reader.from_roi(list(key), padding=self.padding, level=self.level, channel=self.channel)
+        image.flags.writeable = False
+        return image
+
+    def _store(self, key, image):
+        # called with the lock held
+        self._cached[key] = image
+        self._cached.move_to_end(key)
+        while len(self._cached) > self.max_cached:
+            self._cached.popitem(last=False)
+
+    def _done(self, key, future):
+        with self._lock:
+            if self._pending.get(key) is future:
+                del self._pending[key]
+            if future.cancelled() or future.exception() is not None:
+                return
+            self._store(key, future.result())
+
+    def _schedule(self, start:int):
+        # called with the lock held: keep plan[start:start+lookahead] cached or in flight
+        for key in self._plan[start:start+self.lookahead]:
+            if key in self._cached or key in self._pending:
+                continue
+            future = self._pool.submit(self._read, key)
+            self._pending[key] = future
+            future.add_done_callback(lambda f, key=key: self._done(key, f))
+
+    def cancel(self):
+        # drop the plan and cancel the reads that have not started
+        with self._lock:
+            pending = list(self._pending.items())
+            self._plan, self._plan_index = [], {}
+        for key, future in pending:
+            if future.cancel():
+                with self._lock:
+                    if self._pending.get(key) is future:
+                        del self._pending[key]
+
+    def set_rois(self, rois:list):
+        # replace the plan; reads for ROIs of the old plan that have not started are cancelled
+        plan = [self._key(roi) for roi in rois]
+        keep = set(plan[:self.lookahead])
+        with self._lock:
+            stale = [(key, future) for key, future in self._pending.items() if key not in keep]
+        for key, future in stale:
+            if future.cancel():
+                with self._lock:
+                    if self._pending.get(key) is future:
+                        del self._pending[key]
+        with self._lock:
+            self._plan = plan
+            self._plan_index = {}
+            for i, key in enumerate(plan):
+                self._plan_index.setdefault(key, i)
+            self._schedule(0)
+
+    def set_path(self, coords:list, roi_size):
+        # plan ROIs of roi_size centred on coords, e.g. [G.nodes[nid]['coord'] for nid in path]
+        if isinstance(roi_size, int):
+            roi_size = [roi_size]*3
+        rois = [[int(c)-s//2 for c, s in zip(coord, roi_size)] + list(roi_size) for coord in coords]
+        self.set_rois(rois)
+
+    def get(self, roi):
+        # image of roi; ROIs that are part of the plan advance the lookahead window
+        key = self._key(roi)
+        with self._lock:
+            image = self._cached.get(key)
+            future = self._pending.get(key) if image is None else None
+            position = self._plan_index.get(key)
+            if position is not None:
+                self._schedule(position+1)
+            if image is not None:
+                self._cached.move_to_end(key)
+                self.hits += 1
+                return image
+            if future is not None:
+                self.waits += 1
+            else:
+                self.misses += 1
+        if future is not None:
+            try:
+                return future.result()
+            except CancelledError:
+                pass
+        image = self._read(key)
+        with self._lock:
+            self._store(key, image)
+        return image
+
+    def from_roi(self, coords):
+        # reader.from_roi with the padding/level/channel of the prefetcher
+        return self.get(coords)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'waits': self.waits,
+                'misses': self.misses,
+                'cached': len(self._cached),
+                'pending': len(self._pending),
+            }
+
+    def close(self):
+        self.cancel()
+        self._pool.shutdown(wait=True)
@@ -0,0 +1,53 @@
+import ast
+import struct
+import numpy as np
+
+'''
+    packed segment geometry:
+        header: magic b'NDBP', version: uint8, dtype code: uint8, ndim: uint16, shape: ndim * uint32
+        body: little-endian int32 ('i') or float32 ('f') values in C order
+'''
+
+MAGIC = b'NDBP'
+VERSION = 1
+_HEADER = struct.Struct('<4sBBH')
+_DTYPES = {
+    ord('i'): np.dtype('<i4'),
+    ord('f'): np.dtype('<f4'),
+}
+
+def is_packed(blob):
+    return isinstance(blob, (bytes, bytearray, memoryview)) and bytes(blob[:4]) == MAGIC
+
+def encode_points(points) -> bytes:
+    # points: list of [x,y,z] or array of shape (N,3)
+    # integer points are stored as int32 (ValueError outside its range), anything else as float32
+    arr = np.asarray(points)
+    if arr.size == 0:
+        arr = arr.reshape(0, 3)
+    if np.issubdtype(arr.dtype, np.integer):
+        limits = np.iinfo(np.int32)
+        if arr.size and (arr.min() < limits.min or arr.max() > limits.max):
+            raise ValueError(f'Points out of the int32 range: [{arr.min()}, {arr.max()}].')
+        code = ord('i')
+    else:
+        code = ord('f')
+    arr = np.ascontiguousarray(arr, dtype=_DTYPES[code])
+    header = _HEADER.pack(MAGIC, VERSION, code, arr.ndim) + struct.pack(f'<{arr.ndim}I', *arr.shape)
+    return header + arr.tobytes()
+
+def decode_points(blob) -> np.ndarray:
+    # zero-copy (read-only) view for packed blobs; legacy str(list) blobs and plain lists are parsed
+    if blob is None:
+        return None
+    if not isinstance(blob, (bytes, bytearray, memoryview, str)):
+        return np.asarray(blob)
+    if not is_packed(blob):
+        text = blob.decode() if not isinstance(blob, str) else blob
+        return np.asarray(ast.literal_eval(text))
+    magic, version, code, ndim = _HEADER.unpack_from(blob, 0)
+    if version != VERSION or code not in _DTYPES:
+        raise ValueError(f'Unsupported packed points (version {version}, dtype {chr(code)}).')
+    shape = struct.unpack_from(f'<{ndim}I', blob, _HEADER.size)
+    offset = _HEADER.size + 4*ndim
+    return np.frombuffer(blob, dtype=_DTYPES[code], offset=offset).reshape(shape)
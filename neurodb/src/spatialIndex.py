@@ -0,0 +1,97 @@
+import math
+
+class GridIndex():
+    '''
+    Uniform grid hash over node coordinates.
+    cell: (x//cell_size, y//cell_size, z//cell_size) -> set of nid
+    roi: [x_offset,y_offset,z_offset,x_size,y_size,z_size], bounds are inclusive
+    '''
+    def __init__(self, cell_size:int=32):
+        self.cell_size = cell_size
+        self.cells = {}
+        self.coords = {}
+
+    def __len__(self):
+        return len(self.coords)
+
+    def __contains__(self, nid):
+        return nid in self.coords
+
+    def _cell(self, coord):
+        return tuple(int(math.floor(c/self.cell_size)) for c in coord)
+
+    def insert(self, nid, coord):
+        if nid in self.coords:
+            self.remove(nid)
+        coord = tuple(coord)
+        self.coords[nid] = coord
+        self.cells.setdefault(self._cell(coord), set()).add(nid)
+
+    def insert_many(self, items):
+        # items: iterable of (nid, coord)
+        for nid, coord in items:
+            self.insert(nid, coord)
+
+    def remove(self, nid):
+        coord = self.coords.pop(nid, None)
+        if coord is None:
+            return
+        cell = self._cell(coord)
+        bucket = self.cells.get(cell)
+        if bucket is not None:
+            bucket.discard(nid)
+            if not bucket:
+                del self.cells[cell]
+
+    def remove_many(self, nids):
+        for nid in nids:
+            self.remove(nid)
+
+    def update(self, nid, coord):
+        self.insert(nid, coord)
+
+    def clear(self):
+        self.cells.clear()
+        self.coords.clear()
+
+    def query_roi(self, roi):
+        offset, size = roi[:3], roi[-3:]
+        lo = [offset[i] for i in range(3)]
+        hi = [offset[i]+size[i] for i in range(3)]
+        cell_lo = self._cell(lo)
+        cell_hi = self._cell(hi)
+        num_cells = 1
+        for l, h in zip(cell_lo, cell_hi):
+            num_cells *= max(h-l+1, 0)
+        # for large roi it is cheaper to walk the occupied cells than the covered ones
+        if num_cells > len(self.cells):
+            cells = [c for c in self.cells if all(l <= ci <= h for ci, l, h in zip(c, cell_lo, cell_hi))]
+        else:
+            cells = [
+                (i, j, k)
+                for i in range(cell_lo[0], cell_hi[0]+1)
+                for j in range(cell_lo[1], cell_hi[1]+1)
+                for k in range(cell_lo[2], cell_hi[2]+1)
+            ]
+        nids = []
+        for cell in cells:
+            for nid in self.cells.get(cell, ()):
+                coord = self.coords[nid]
+                if all(l <= c <= h for c, l, h in zip(coord, lo, hi)):
+                    nids.append(nid)
+        return nids
+
+    def query_radius(self, coord, radius, k:int=None):
+        # nids within euclidean distance radius of coord, sorted by distance
+        roi = [c-radius for c in coord] + [2*radius]*3
+        r2 = radius*radius
+        nearest = []
+        for nid in self.query_roi(roi):
+            d2 = sum((a-b)**2 for a, b in zip(self.coords[nid], coord))
+            if d2 <= r2:
+                nearest.append((d2, nid))
+        nearest.sort()
+        nids = [nid for _, nid in nearest]
+        if k is not None:
+            nids = nids[:k]
+        return nids
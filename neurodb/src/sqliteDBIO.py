@@ -1,12 +1,21 @@
 import os
 import sqlite3
+import threading
+from itertools import repeat
+import numpy as np
+import pandas as pd
+from contextlib import contextmanager
 from datetime import datetime
 
+from .segCodec import encode_points, decode_points, is_packed
+from .metrics import instrumented
+from . import metrics
+
 '''
     segs:
         {
-            points: [head,...,tail],
-            sampled_points: points[::interval],
+            points: [head,...,tail], packed int32/float32 blob (see segCodec)
+            sampled_points: points[::interval], packed int32/float32 blob
         }
     nodes:
         {
@@ -29,10 +38,148 @@ from datetime import datetime
             PRIMARY KEY: (src,dst)
             CHECK (src <= dst)
         }
+    nodes_rtree: R*Tree over (x,y,z) of nodes, kept in sync by triggers
+        {
+            nid: int,
+            min_x, max_x, min_y, max_y, min_z, max_z: int
+        }
+    changelog: append-only log of node/edge mutations, filled by triggers
+        {
+            seq: int, PRIMARY KEY AUTOINCREMENT
+            tbl: str, # 'nodes' or 'edges'
+            op: str, # 'insert', 'update' or 'delete'
+            key1: int, # nid for nodes, src for edges
+            key2: int, # dst for edges, NULL for nodes
+            date: str, TIMESTAMP
+        }
 '''
 
+# pragmas applied to every connection opened by sqliteDBIO
+DEFAULT_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'temp_store': 'MEMORY',
+    'mmap_size': 256 * 1024 * 1024,   # 256 MB
+    'cache_size': -64 * 1024,         # negative value means KiB, i.e. 64 MB
+    'busy_timeout': 30000,            # ms
+}
+
+# pragmas of segs2db(bulk=True), the connection's own values are restored after the load
+BULK_PRAGMAS = {
+    'synchronous': 'OFF',             # the load is one transaction, a crash loses it as a whole
+    'cache_size': -1024 * 1024,       # 1 GB
+}
+
+# PRAGMA user_version of an up-to-date database; 1: segs points are packed binary (segCodec)
+SCHEMA_VERSION = 1
+
+# keep "IN (?,...)" lists below SQLITE_MAX_VARIABLE_NUMBER of older sqlite builds
+MAX_QUERY_PARAMS = 900
+
+def null_sentinel(dtype):
+    # value of an integer column of the columnar reads where the database holds NULL
+    return np.iinfo(dtype).min
+
+SECONDARY_INDEX_SQL = {
+    'idx_nodes_nid': "CREATE INDEX IF NOT EXISTS idx_nodes_nid ON nodes (nid)",
+    'idx_edges_src': "CREATE INDEX IF NOT EXISTS idx_edges_src ON edges (src)",
+    'idx_edges_dst': "CREATE INDEX IF NOT EXISTS idx_edges_dst ON edges (dst)",
+}
+
+SPATIAL_INDEX_SQL = [
+    '''
+    CREATE VIRTUAL TABLE IF NOT EXISTS nodes_rtree USING rtree_i32(
+        nid, min_x, max_x, min_y, max_y, min_z, max_z
+    )
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS nodes_rtree_insert AFTER INSERT ON nodes
+    BEGIN
+        INSERT OR REPLACE INTO nodes_rtree VALUES (new.nid, new.x, new.x, new.y, new.y, new.z, new.z);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS nodes_rtree_delete AFTER DELETE ON nodes
+    BEGIN
+        DELETE FROM nodes_rtree WHERE nid = old.nid;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS nodes_rtree_update AFTER UPDATE OF nid, x, y, z ON nodes
+    BEGIN
+        DELETE FROM nodes_rtree WHERE nid = old.nid;
+        INSERT OR REPLACE INTO nodes_rtree VALUES (new.nid, new.x, new.x, new.y, new.y, new.z, new.z);
+    END
+    ''',
+]
+
+CHANGELOG_SQL = [
+    '''
+    CREATE TABLE IF NOT EXISTS changelog(
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        tbl TEXT,
+        op TEXT,
+        key1 INTEGER,
+        key2 INTEGER,
+        date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS nodes_changelog_insert AFTER INSERT ON nodes
+    BEGIN
+        INSERT INTO changelog (tbl, op, key1) VALUES ('nodes', 'insert', new.nid);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS nodes_changelog_update AFTER UPDATE ON nodes
+    BEGIN
+        INSERT INTO changelog (tbl, op, key1) VALUES ('nodes', 'update', old.nid);
+        INSERT INTO changelog (tbl, op, key1) SELECT 'nodes', 'update', new.nid WHERE new.nid != old.nid;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS nodes_changelog_delete AFTER DELETE ON nodes
+    BEGIN
+        INSERT INTO changelog (tbl, op, key1) VALUES ('nodes', 'delete', old.nid);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS edges_changelog_insert AFTER INSERT ON edges
+    BEGIN
+        INSERT INTO changelog (tbl, op, key1, key2) VALUES ('edges', 'insert', new.src, new.dst);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS edges_changelog_update AFTER UPDATE ON edges
+    BEGIN
+        INSERT INTO changelog (tbl, op, key1, key2) VALUES ('edges', 'update', old.src, old.dst);
+        INSERT INTO changelog (tbl, op, key1, key2) SELECT 'edges', 'update', new.src, new.dst
+            WHERE new.src != old.src OR new.dst != old.dst;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS edges_changelog_delete AFTER DELETE ON edges
+    BEGIN
+        INSERT INTO changelog (tbl, op, key1, key2) VALUES ('edges', 'delete', old.src, old.dst);
+    END
+    ''',
+]
+
 class sqliteDBIO:
-    def __init__(self, db_path):
+    # seqs behind the latest one that may still show up, see NeuroDB.refresh(). sqlite has a single writer:
+    # a change gets its seq inside the write transaction and nothing else commits before it, so none do
+    CHANGELOG_WINDOW = 0
+
+    def __init__(self, db_path, pragmas:dict=None):
+        # one long-lived connection per (thread, db_path), created on first use
+        self.db_path = None
+        self.pragmas = dict(DEFAULT_PRAGMAS)
+        if pragmas:
+            self.pragmas.update(pragmas)
+        self._local = threading.local()
+        self._conns = []
+        self._conns_lock = threading.Lock()
+
         if db_path is not None:
             self.switch_to(db_path)
         else:
@@ -50,17 +197,92 @@ class sqliteDBIO:
             self.inspect_database()
 
     def switch_to(self, db_path):
+        if db_path != self.db_path:
+            self.close()
         self.db_path = db_path
 
+    def _connect(self):
+        # return the connection of the current thread, open it if necessary
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.db_path == self.db_path:
+            return conn
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=self.pragmas.get('busy_timeout', 30000)/1000,
+            check_same_thread=False,
+        )
+        conn.row_factory = sqlite3.Row
+        for key, value in self.pragmas.items():
+            conn.execute(f"PRAGMA {key}={value}")
+        self._local.conn = conn
+        self._local.db_path = self.db_path
+        with self._conns_lock:
+            self._conns.append(conn)
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        # group writes of the current thread into one transaction, nested calls join the outer one
+        conn = self._connect()
+        depth = getattr(self._local, 'txn_depth', 0)
+        self._local.txn_depth = depth + 1
+        try:
+            yield conn
+        except BaseException:
+            self._local.txn_depth = depth
+            if depth == 0:
+                conn.rollback()
+                metrics.transaction('sqlite', 'rollback')
+            raise
+        else:
+            self._local.txn_depth = depth
+            if depth == 0:
+                conn.commit()
+                metrics.transaction('sqlite', 'commit')
+
+    def _commit(self, conn):
+        if getattr(self._local, 'txn_depth', 0) == 0:
+            conn.commit()
+            metrics.transaction('sqlite', 'commit')
+
+    def _rollback(self, conn):
+        # inside transaction() the exception propagates and the outermost level rolls back
+        if getattr(self._local, 'txn_depth', 0) == 0:
+            conn.rollback()
+            metrics.transaction('sqlite', 'rollback')
+
+    def close(self):
+        # close every connection opened by this instance (all threads)
+        with self._conns_lock:
+            conns, self._conns = self._conns, []
+        for conn in conns:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+        self._local = threading.local()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
     def init_db(self):
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         cursor.execute(
             '''
             CREATE TABLE IF NOT EXISTS segs(
                 sid INTEGER PRIMARY KEY,
-                points TEXT,
-                sampled_points TEXT,
+                points BLOB,
+                sampled_points BLOB,
                 version INTEGER,
                 date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
@@ -99,17 +321,22 @@ class sqliteDBIO:
             )
             '''
         )
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_nodes_nid ON nodes (nid)")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_edges_src ON edges (src)")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_edges_dst ON edges (dst)")
+        for sql in SECONDARY_INDEX_SQL.values():
+            cursor.execute(sql)
+        for sql in SPATIAL_INDEX_SQL:
+            cursor.execute(sql)
+        for sql in CHANGELOG_SQL:
+            cursor.execute(sql)
+        cursor.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
 
         conn.commit()
-        conn.close()
 
-    def add_segs(self, segs:list[dict]):
+    @instrumented(rows='arg')
+    def add_segs(self, segs:list[dict], skip_duplicates:bool=False):
         # given a list of segs, write them to segs table
-        # segs: [{'sid', 'points', 'sampled_points', 'date'}]
-        conn = sqlite3.connect(self.db_path)
+        # segs: [{'sid', 'points', 'sampled_points', 'version', 'date'}]
+        # skip_duplicates: ignore segs whose sid already exists, as datajoint's insert(skip_duplicates=True)
+        conn = self._connect()
         cursor = conn.cursor()
         try:
             date = datetime.now()
@@ -117,33 +344,35 @@ class sqliteDBIO:
             for s in segs:
                 entries.append({
                     'sid': s['sid'],
-                    'points': sqlite3.Binary(str(s['points']).encode()),
-                    'sampled_points': sqlite3.Binary(str(s['sampled_points']).encode()),
+                    'points': sqlite3.Binary(encode_points(s['points'])),
+                    'sampled_points': sqlite3.Binary(encode_points(s['sampled_points'])),
                     'version': s.get('version', 1),
                     'date': s.get('date', date)
                 })
+            insert = "INSERT OR IGNORE" if skip_duplicates else "INSERT"
             cursor.executemany(
-                "INSERT INTO segs (sid, points, sampled_points, version, date) VALUES (:sid, :points, :sampled_points, :version, :date)",
+                f"{insert} INTO segs (sid, points, sampled_points, version, date) VALUES (:sid, :points, :sampled_points, :version, :date)",
                 entries
             )
-            conn.commit()
-            conn.close()
+            self._commit(conn)
         except Exception as e:
             print(f"Error in add_segs: {e}")
-            conn.rollback()
-            conn.close()
+            self._rollback(conn)
             raise e
 
-    def add_nodes(self, nodes:list[dict]):
+    @instrumented(rows='arg')
+    def add_nodes(self, nodes:list[dict], skip_duplicates:bool=False):
         # given a list of nodes, write them to node table
         # nodes: [{'nid', 'coord', 'creator', 'type', 'checked', 'status', 'sid', 'date'}]
-        conn = sqlite3.connect(self.db_path)
+        # skip_duplicates: ignore nodes whose nid already exists
+        conn = self._connect()
         cursor = conn.cursor()
         try:
             date = datetime.now()
             entries = []
             for n in nodes:
-                x,y,z = n['coord']
+                # numpy scalars (e.g. coords of segs given as arrays) would be stored as blobs
+                x,y,z = (c.item() if isinstance(c, np.generic) else c for c in n['coord'])
                 entries.append({
                     'nid': n['nid'],
                     'x': x,
@@ -156,32 +385,24 @@ class sqliteDBIO:
                     'sid': n.get('sid', None),
                     'date': n.get('date', date)
                 })
-                entries.append((
-                    n['nid'],
-                    x,y,z,
-                    n['creator'],
-                    n['type'],
-                    n['checked'],
-                    n['status'],
-                    n.get('date', date)            
-                ))
+            insert = "INSERT OR IGNORE" if skip_duplicates else "INSERT"
             cursor.executemany(
-                "INSERT INTO nodes (nid, x, y, z, creator, type, checked, status, sid, date) " +
+                f"{insert} INTO nodes (nid, x, y, z, creator, type, checked, status, sid, date) " +
                 "VALUES (:nid, :x, :y, :z, :creator, :type, :checked, :status, :sid, :date)",
                 entries
             )
-            conn.commit()
-            conn.close()
+            self._commit(conn)
         except Exception as e:
             print(f"Error in add_nodes: {e}")
-            conn.rollback()
-            conn.close()
+            self._rollback(conn)
             raise e
 
-    def add_edges(self, edges:list[dict]):
+    @instrumented(rows='arg')
+    def add_edges(self, edges:list[dict], skip_duplicates:bool=False):
         # given list of edges, write them to edges table
         # edges: [{'src', 'dst', 'creator', 'date'}]
-        conn = sqlite3.connect(self.db_path)
+        # skip_duplicates: ignore edges that already exist
+        conn = self._connect()
         cursor = conn.cursor()
         try:
             date = datetime.now()
@@ -196,158 +417,282 @@ class sqliteDBIO:
                     'creator': e['creator'],
                     'date': e.get('date', date)
                 })
+            insert = "INSERT OR IGNORE" if skip_duplicates else "INSERT"
             cursor.executemany(
-                "INSERT INTO edges (src, dst, creator, date) VALUES (:src, :dst, :creator, :date)",
+                f"{insert} INTO edges (src, dst, creator, date) VALUES (:src, :dst, :creator, :date)",
                 entries
             )
-            conn.commit()
-            conn.close()
+            self._commit(conn)
         except Exception as e:
             print(f"Error in add_edges: {e}")
-            conn.rollback()
-            conn.close()
+            self._rollback(conn)
             raise e
     
-    def read_segs(self):
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
+    def iter_segs_batches(self, batch_size:int=1000, after:int=None):
+        # ([seg], last sid) ordered by sid, batch_size rows per query (keyset pagination)
+        # after: only segs with sid > after, e.g. the last sid of an earlier run
+        conn = self._connect()
         cursor = conn.cursor()
-        cursor.execute("SELECT * FROM segs")
-        rows = cursor.fetchall()
-        segs = []
-        for row in rows:
-            seg = {
+        while True:
+            if after is None:
+                cursor.execute("SELECT * FROM segs ORDER BY sid LIMIT ?", (batch_size,))
+            else:
+                cursor.execute("SELECT * FROM segs WHERE sid > ? ORDER BY sid LIMIT ?", (after, batch_size))
+            rows = cursor.fetchall()
+            if not rows:
+                return
+            after = rows[-1]['sid']
+            yield [{
                 'sid': row['sid'],
-                'points': eval(row['points']),
-                'sampled_points': eval(row['sampled_points'])
-            }
-            segs.append(seg)
-        conn.close()
-        return segs
+                'points': decode_points(row['points']),
+                'sampled_points': decode_points(row['sampled_points']),
+                'version': row['version'],
+                'date': row['date'],
+            } for row in rows], after
 
-    def read_nodes(self):
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
+    def iter_nodes_batches(self, batch_size:int=10000, after:int=None):
+        # ([node], last nid) ordered by nid, batch_size rows per query (keyset pagination)
+        conn = self._connect()
         cursor = conn.cursor()
-        cursor.execute("SELECT * FROM nodes ORDER BY nid")
-        rows = cursor.fetchall()
-        nodes = []
-        for row in rows:
-            data = {
+        while True:
+            if after is None:
+                cursor.execute("SELECT * FROM nodes ORDER BY nid LIMIT ?", (batch_size,))
+            else:
+                cursor.execute("SELECT * FROM nodes WHERE nid > ? ORDER BY nid LIMIT ?", (after, batch_size))
+            rows = cursor.fetchall()
+            if not rows:
+                return
+            after = rows[-1]['nid']
+            yield [{
                 'nid': row['nid'],
                 'coord': [row['x'], row['y'], row['z']],
                 'creator': row['creator'],
                 'type': row['type'],
                 'checked': row['checked'],
                 'status': row['status'],
+                'sid': row['sid'],
                 'date': row['date'],
-            }
-            nodes.append(data)
-        conn.close()
-        return nodes
-    
-    def read_edges(self, creator:str=None):
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
+            } for row in rows], after
+
+    def iter_edges_batches(self, creator:str=None, batch_size:int=10000, after:int=None):
+        # ([edge], last rowid) in insertion (rowid) order, batch_size rows per query (keyset pagination)
+        conn = self._connect()
         cursor = conn.cursor()
-        query = "SELECT * FROM edges"
-        if creator:
-            query += " WHERE creator=?"
-            cursor.execute(query, (creator,))
-        else:
-            cursor.execute(query)
-        rows = cursor.fetchall()
-        edges = []
-        for row in rows:
-            data = {
+        after = -1 if after is None else after
+        while True:
+            if creator:
+                cursor.execute(
+                    "SELECT rowid, * FROM edges WHERE rowid > ? AND creator=? ORDER BY rowid LIMIT ?",
+                    (after, creator, batch_size)
+                )
+            else:
+                cursor.execute("SELECT rowid, * FROM edges WHERE rowid > ? ORDER BY rowid LIMIT ?", (after, batch_size))
+            rows = cursor.fetchall()
+            if not rows:
+                return
+            after = rows[-1]['rowid']
+            yield [{
                 'src': row['src'],
                 'dst': row['dst'],
                 'creator': row['creator'],
                 'date': row['date'],
-            }
-            edges.append(data)
-        conn.close()
-        return edges
+            } for row in rows], after
+
+    def iter_segs(self, batch_size:int=1000):
+        # stream segs ordered by sid
+        for segs, _ in self.iter_segs_batches(batch_size):
+            yield from segs
+
+    def iter_nodes(self, batch_size:int=10000):
+        # stream nodes ordered by nid
+        for nodes, _ in self.iter_nodes_batches(batch_size):
+            yield from nodes
+
+    def iter_edges(self, creator:str=None, batch_size:int=10000):
+        # stream edges in insertion (rowid) order
+        for edges, _ in self.iter_edges_batches(creator, batch_size):
+            yield from edges
+
+    def _read_columnar(self, query:str, params, columns:dict, batch_size:int):
+        # columns: {name: dtype}, in SELECT order; rows are fetched as plain tuples in chunks
+        # NULL in an integer column becomes null_sentinel(dtype), the columns of nodes are nullable
+        cursor = self._connect().cursor()
+        cursor.row_factory = None
+        cursor.execute(query, params)
+        chunks = {name: [] for name in columns}
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            for (name, dtype), values in zip(columns.items(), zip(*rows)):
+                if dtype == 'datetime64[us]' or dtype is object:
+                    chunks[name].append(np.array(values, dtype=dtype))
+                else:
+                    if None in values:
+                        sentinel = null_sentinel(dtype)
+                        values = [sentinel if value is None else value for value in values]
+                    chunks[name].append(np.fromiter(values, dtype=dtype, count=len(rows)))
+        return {
+            name: np.concatenate(chunks[name]) if chunks[name] else np.empty(0, dtype=dtype)
+            for name, dtype in columns.items()
+        }
+
+    @staticmethod
+    def _concat_columnar(parts:list, columns:dict):
+        return {
+            name: np.concatenate([part[name] for part in parts]) if parts else np.empty(0, dtype=dtype)
+            for name, dtype in columns.items()
+        }
+
+    @instrumented(rows='result')
+    def read_nodes_columnar(self, nids:list=None, as_frame:bool=False, batch_size:int=100000):
+        # {'nid', 'x', 'y', 'z', 'creator', 'type', 'checked', 'status', 'date'} as numpy arrays, ordered by nid
+        # nids: only read these nodes (missing ones are skipped)
+        # NULL values are null_sentinel(dtype) in the int columns, None in creator and NaT in date
+        columns = {
+            'nid': np.int64, 'x': np.int32, 'y': np.int32, 'z': np.int32, 'creator': object,
+            'type': np.int8, 'checked': np.int8, 'status': np.int8, 'date': 'datetime64[us]'
+        }
+        query = f"SELECT {', '.join(columns)} FROM nodes"
+        if nids is None:
+            data = self._read_columnar(query + " ORDER BY nid", (), columns, batch_size)
+        else:
+            nids = sorted(set(int(nid) for nid in nids))
+            parts = []
+            for i in range(0, len(nids), MAX_QUERY_PARAMS):
+                chunk = nids[i:i+MAX_QUERY_PARAMS]
+                placeholders = ','.join('?' for _ in chunk)
+                parts.append(self._read_columnar(
+                    query + f" WHERE nid IN ({placeholders}) ORDER BY nid", chunk, columns, batch_size
+                ))
+            data = self._concat_columnar(parts, columns)
+        if as_frame:
+            return pd.DataFrame(data)
+        return data
+
+    @instrumented(rows='result')
+    def read_edges_columnar(self, creator:str=None, pairs:list=None, as_frame:bool=False, batch_size:int=100000):
+        # {'src', 'dst', 'creator', 'date'} as numpy arrays, in insertion order
+        # pairs: only read these (src,dst) edges (missing ones are skipped)
+        columns = {'src': np.int64, 'dst': np.int64, 'creator': object, 'date': 'datetime64[us]'}
+        query = f"SELECT {', '.join(columns)} FROM edges"
+        params = []
+        conditions = []
+        if creator:
+            conditions.append("creator=?")
+            params.append(creator)
+        if pairs is None:
+            if conditions:
+                query += " WHERE " + " AND ".join(conditions)
+            data = self._read_columnar(query + " ORDER BY rowid", params, columns, batch_size)
+        else:
+            pairs = sorted(set((int(src), int(dst)) for src, dst in pairs))
+            step = MAX_QUERY_PARAMS // 2
+            parts = []
+            for i in range(0, len(pairs), step):
+                chunk = pairs[i:i+step]
+                placeholders = ','.join('(?,?)' for _ in chunk)
+                where = " WHERE " + " AND ".join(conditions + [f"(src, dst) IN (VALUES {placeholders})"])
+                parts.append(self._read_columnar(
+                    query + where + " ORDER BY rowid", params + [v for pair in chunk for v in pair], columns, batch_size
+                ))
+            data = self._concat_columnar(parts, columns)
+        if as_frame:
+            return pd.DataFrame(data)
+        return data
+
+    def read_segs(self):
+        return list(self.iter_segs())
+
+    def read_nodes(self):
+        return list(self.iter_nodes())
     
+    def read_edges(self, creator:str=None):
+        return list(self.iter_edges(creator))
+    
+    @instrumented(rows='arg')
     def delete_nodes(self, nids):
         # given a list of nid, delete nodes from nodes table and edges from edges table
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         try:
             cursor.execute(f"DELETE FROM nodes WHERE nid IN ({','.join(map(str, nids))})")
             # Remove edges where either source or destination node is in the given list
             cursor.execute(f"DELETE FROM edges WHERE src IN ({','.join(map(str, nids))}) OR dst IN ({','.join(map(str, nids))})")
-            conn.commit()
-            conn.close()
+            self._commit(conn)
         except Exception as e:
             print(f"Error in delete_nodes: {e}")
-            conn.rollback()
-            conn.close()
+            self._rollback(conn)
             raise e
 
+    @instrumented(rows='arg')
     def delete_edges(self, edges):
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         try:
-            for src, dst in edges:
-                if src > dst:
-                    src, dst = dst, src
-                cursor.execute("DELETE FROM edges WHERE src=? AND dst=?", (src, dst))
-            conn.commit()
-            conn.close()
+            cursor.executemany(
+                "DELETE FROM edges WHERE src=? AND dst=?",
+                [(src, dst) if src <= dst else (dst, src) for src, dst in edges]
+            )
+            self._commit(conn)
         except Exception as e:
             print(f"Error in delete_edges: {e}")
-            conn.rollback()
-            conn.close()
+            self._rollback(conn)
+            raise e
     
+    @instrumented(rows='arg')
     def update_nodes(self, nids:list, creator:str=None, type:int=None, checked:int=None, status:int=None, date:datetime=None):
         if all(param is None for param in [creator, type, checked, status]) or not nids:
             return
         if not isinstance(nids, list):
             nids = [nids]
             
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         try:
             update_parts = []
+            update_params = []
             where_conditions = []
-            params = []
+            where_params = []
             if creator is not None:
                 update_parts.append("creator = ?")
                 where_conditions.append("(creator IS NULL OR creator != ?)")
-                params.extend([creator, creator])
+                update_params.append(creator)
+                where_params.append(creator)
             if type is not None:
                 update_parts.append("type = ?")
                 where_conditions.append("(type IS NULL OR type != ?)")
-                params.extend([type, type])
+                update_params.append(type)
+                where_params.append(type)
             if checked is not None:
                 update_parts.append("checked = ?")
                 where_conditions.append("(checked IS NULL OR checked != ?)")
-                params.extend([checked, checked])
+                update_params.append(checked)
+                where_params.append(checked)
             if status is not None:
                 update_parts.append("status = ?")
                 where_conditions.append("(status IS NULL OR status != ?)")
-                params.extend([status, status])
+                update_params.append(status)
+                where_params.append(status)
             if date is None:
                 date = datetime.now()
             update_parts.append("date = ?")
-            params.append(date)
+            update_params.append(date)
             
-            placeholders = ','.join('?' for _ in nids)
-            if where_conditions:
-                additional_conditions = f" AND ({' OR '.join(where_conditions)})"
-                query = f"UPDATE nodes SET {', '.join(update_parts)} WHERE nid IN ({placeholders}){additional_conditions}"
-            else:
-                query = f"UPDATE nodes SET {', '.join(update_parts)} WHERE nid IN ({placeholders})"
-            params.extend(nids)
-            
-            cursor.execute(query, params)
-            conn.commit()
-            conn.close()
+            # bound parameters are ordered as they appear in the statement: SET, nid IN, conditions
+            for i in range(0, len(nids), MAX_QUERY_PARAMS):
+                chunk = nids[i:i+MAX_QUERY_PARAMS]
+                placeholders = ','.join('?' for _ in chunk)
+                if where_conditions:
+                    additional_conditions = f" AND ({' OR '.join(where_conditions)})"
+                    query = f"UPDATE nodes SET {', '.join(update_parts)} WHERE nid IN ({placeholders}){additional_conditions}"
+                else:
+                    query = f"UPDATE nodes SET {', '.join(update_parts)} WHERE nid IN ({placeholders})"
+                cursor.execute(query, update_params + list(chunk) + where_params)
+            self._commit(conn)
         except Exception as e:
             print(f"Error in update_nodes: {e}")
-            conn.rollback()
-            conn.close()
+            self._rollback(conn)
             raise e
     
     def check_node(self, nid:int, date:datetime=None):
@@ -357,88 +702,237 @@ class sqliteDBIO:
         self.update_nodes(nids, checked=-1, date=date)
 
     def get_max_nid(self):
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         # Retrieve the highest existing nid value
         cursor.execute("SELECT MAX(nid) FROM nodes")
         max_nid = cursor.fetchone()[0] or 0  # If there are no existing items, set max_nid to 0
-        conn.commit()
-        conn.close()
+        self._commit(conn)
         return max_nid
     
     def get_max_sid_version(self):
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         cursor.execute("SELECT MAX(sid) FROM segs")
         max_sid = cursor.fetchone()[0] or 0
         cursor.execute("SELECT MAX(version) FROM segs")
         max_version = cursor.fetchone()[0] or 0
-        conn.close()
         return max_sid, max_version
     
+    def get_identity(self):
+        # stable name of this database, used to key graph snapshots
+        return f'sqlite:{os.path.abspath(self.db_path)}'
+
+    def get_counts(self):
+        # (number of nodes, number of edges)
+        conn = self._connect()
+        cursor = conn.cursor()
+        cursor.execute("SELECT COUNT(*) FROM nodes")
+        num_nodes = cursor.fetchone()[0]
+        cursor.execute("SELECT COUNT(*) FROM edges")
+        num_edges = cursor.fetchone()[0]
+        return num_nodes, num_edges
+
+    def get_max_change_seq(self):
+        # sequence number of the latest recorded change, 0 if there is none
+        conn = self._connect()
+        cursor = conn.cursor()
+        cursor.execute("SELECT MAX(seq) FROM changelog")
+        max_seq = cursor.fetchone()[0] or 0
+        return max_seq
+
+    @instrumented(rows='result')
+    def read_changes(self, since:int=0, limit:int=None):
+        # changes with seq > since, in seq order: [{'seq', 'tbl', 'op', 'key1', 'key2'}]
+        conn = self._connect()
+        cursor = conn.cursor()
+        query = "SELECT seq, tbl, op, key1, key2 FROM changelog WHERE seq > ? ORDER BY seq"
+        params = [since]
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
+        cursor.execute(query, params)
+        return [dict(row) for row in cursor.fetchall()]
+
+    @instrumented(rows='result')
     def read_nid_within_roi(self, roi):
+        # roi: [x_offset,y_offset,z_offset,x_size,y_size,z_size], bounds are inclusive
         offset, size = roi[:3], roi[-3:]
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
+        conn = self._connect()
         cursor = conn.cursor()
-        query = f"SELECT * FROM nodes "
-        where = f"WHERE x >= {offset[0]} AND x <= {offset[0]+size[0]} AND " +  \
-                f"y >= {offset[1]} AND y <= {offset[1]+size[1]} AND " + \
-                f"z >= {offset[2]} AND z <= {offset[2]+size[2]}"
-        cursor.execute(query+where)
-        rows = cursor.fetchall()
-        nids = []
-        for row in rows:
-            nids.append(row['nid'])
-        conn.close()
+        cursor.execute(
+            "SELECT nid FROM nodes_rtree WHERE " +
+            "max_x >= ? AND min_x <= ? AND max_y >= ? AND min_y <= ? AND max_z >= ? AND min_z <= ?",
+            (
+                int(offset[0]), int(offset[0]+size[0]),
+                int(offset[1]), int(offset[1]+size[1]),
+                int(offset[2]), int(offset[2]+size[2]),
+            )
+        )
+        nids = [row[0] for row in cursor.fetchall()]
+        return nids
+
+    @instrumented(rows='result')
+    def read_nid_nearest(self, coord, radius:int, k:int=None):
+        # nids within euclidean distance radius of coord, sorted by distance
+        x, y, z = [int(c) for c in coord]
+        r = int(radius)
+        conn = self._connect()
+        cursor = conn.cursor()
+        query = (
+            "SELECT n.nid, (n.x-?)*(n.x-?)+(n.y-?)*(n.y-?)+(n.z-?)*(n.z-?) AS d2 " +
+            "FROM nodes_rtree r JOIN nodes n ON n.nid = r.nid WHERE " +
+            "r.max_x >= ? AND r.min_x <= ? AND r.max_y >= ? AND r.min_y <= ? AND r.max_z >= ? AND r.min_z <= ? " +
+            "AND d2 <= ? ORDER BY d2"
+        )
+        params = [x, x, y, y, z, z, x-r, x+r, y-r, y+r, z-r, z+r, r*r]
+        if k is not None:
+            query += " LIMIT ?"
+            params.append(int(k))
+        cursor.execute(query, params)
+        nids = [row[0] for row in cursor.fetchall()]
         return nids
     
-    def segs2db(self, segs):
-        # insert segs into database
+    @instrumented(rows='arg')
+    def segs2db(self, segs, bulk:bool=False, defer_indexes:bool=False):
+        # insert segs, their sampled points as nodes and edges between consecutive nodes, in one transaction
+        # bulk: build the rows with numpy, write the changelog with one statement per table instead of
+        #   per-row triggers and load under BULK_PRAGMAS; returns columnar ({'nid','x','y','z','sid'}, {'src','dst'})
+        # defer_indexes: with bulk, drop the secondary and spatial indexes during the load and rebuild them after,
+        #   worth it when the load is large compared to the database
+        if bulk:
+            return self._bulk_segs2db(segs, defer_indexes)
         date = datetime.now()
-
-        # insert segs into database
-        max_sid, max_version = self.get_max_sid_version()
-        max_version += 1
-        segs_entries = []
-        for seg in segs:
-            max_sid+=1
-            segs_entries.append({
-                'sid': max_sid,
-                'points': seg['points'],
-                'sampled_points': seg['sampled_points'],
-                'version': max_version,
-                'date': date
-            })
-        self.add_segs(segs_entries)
-        print(f'Number of segs in database: {max_sid}; {len(segs_entries)} newly added.')
-
-        # insert nodes into database
-        max_nid = self.get_max_nid()
-        # assign unique nid for each node in segs according to index
-        nodes = []
-        edges = []
-        for sidx, seg in enumerate(segs):
-            coords = seg['sampled_points']
-            for cidx, coord in enumerate(coords):
-                max_nid += 1
-                nodes.append({
-                    'nid': max_nid,
-                    'coord': coord,
-                    'creator': 'seger',
-                    'type': 0,
-                    'checked': 0,
-                    'status': 1,
-                    'sid': segs_entries[sidx]['sid'],
+        with self.transaction():
+            # insert segs into database
+            max_sid, max_version = self.get_max_sid_version()
+            max_version += 1
+            segs_entries = []
+            for seg in segs:
+                max_sid+=1
+                segs_entries.append({
+                    'sid': max_sid,
+                    'points': seg['points'],
+                    'sampled_points': seg['sampled_points'],
+                    'version': max_version,
                     'date': date
                 })
-                if cidx < len(coords)-1:
-                    edges.append({'src':max_nid, 'dst':max_nid+1, 'creator':'seger', 'date':date})
+            self.add_segs(segs_entries)
+            print(f'Number of segs in database: {max_sid}; {len(segs_entries)} newly added.')
+
+            # insert nodes into database
+            max_nid = self.get_max_nid()
+            # assign unique nid for each node in segs according to index
+            nodes = []
+            edges = []
+            for sidx, seg in enumerate(segs):
+                coords = seg['sampled_points']
+                for cidx, coord in enumerate(coords):
+                    max_nid += 1
+                    nodes.append({
+                        'nid': max_nid,
+                        'coord': coord,
+                        'creator': 'seger',
+                        'type': 0,
+                        'checked': 0,
+                        'status': 1,
+                        'sid': segs_entries[sidx]['sid'],
+                        'date': date
+                    })
+                    if cidx < len(coords)-1:
+                        edges.append({'src':max_nid, 'dst':max_nid+1, 'creator':'seger', 'date':date})
+
+            print(f'Adding {len(nodes)} nodes to database')
+            self.add_nodes(nodes)
+            print(f'Adding {len(edges)} edges to database')
+            self.add_edges(edges)
+            return nodes, edges
+
+    def _bulk_segs2db(self, segs, defer_indexes:bool):
+        conn = self._connect()
+        # the text the sqlite3 datetime adapter writes, adapted once instead of once per row
+        date = datetime.now().isoformat(' ')
+        # synchronous can not be changed inside a transaction
+        outermost = getattr(self._local, 'txn_depth', 0) == 0 and not conn.in_transaction
+        saved_pragmas = {}
+        if outermost:
+            for key, value in BULK_PRAGMAS.items():
+                saved_pragmas[key] = conn.execute(f"PRAGMA {key}").fetchone()[0]
+                conn.execute(f"PRAGMA {key}={value}")
+        try:
+            with self.transaction():
+                cursor = conn.cursor()
+                # the dropped triggers and indexes come back on rollback as well
+                if not conn.in_transaction:
+                    cursor.execute("BEGIN")
+                max_sid, max_version = self.get_max_sid_version()
+                max_nid = self.get_max_nid()
 
-        print(f'Adding {len(nodes)} nodes to database')
-        self.add_nodes(nodes)
-        print(f'Adding {len(edges)} edges to database')
-        self.add_edges(edges)
+                points = [np.asarray(seg['sampled_points']).reshape(-1, 3) for seg in segs]
+                counts = np.array([len(p) for p in points], dtype=np.int64)
+                num_nodes = int(counts.sum())
+                sids = np.arange(max_sid+1, max_sid+1+len(segs), dtype=np.int64)
+                nids = np.arange(max_nid+1, max_nid+1+num_nodes, dtype=np.int64)
+                coords = np.concatenate(points) if points else np.empty((0, 3), dtype=np.int32)
+                node_sids = np.repeat(sids, counts)
+                # every node is linked to the next one, except the last node of a seg
+                linked = np.ones(num_nodes, dtype=bool)
+                linked[np.cumsum(counts)[counts > 0] - 1] = False
+                src = nids[linked]
+                dst = src + 1
+
+                triggers = ['nodes_changelog_insert', 'edges_changelog_insert']
+                if defer_indexes:
+                    triggers.append('nodes_rtree_insert')
+                    for name in SECONDARY_INDEX_SQL:
+                        cursor.execute(f"DROP INDEX IF EXISTS {name}")
+                for name in triggers:
+                    cursor.execute(f"DROP TRIGGER IF EXISTS {name}")
+
+                cursor.executemany(
+                    "INSERT INTO segs (sid, points, sampled_points, version, date) VALUES (?, ?, ?, ?, ?)",
+                    ((sid, sqlite3.Binary(encode_points(seg['points'])), sqlite3.Binary(encode_points(p)), max_version+1, date)
+                     for sid, seg, p in zip(sids.tolist(), segs, points))
+                )
+                print(f'Number of segs in database: {max_sid+len(segs)}; {len(segs)} newly added.')
+                print(f'Adding {num_nodes} nodes to database')
+                cursor.executemany(
+                    "INSERT INTO nodes (nid, x, y, z, creator, type, checked, status, sid, date) " +
+                    "VALUES (?, ?, ?, ?, 'seger', 0, 0, 1, ?, ?)",
+                    zip(nids.tolist(), coords[:, 0].tolist(), coords[:, 1].tolist(), coords[:, 2].tolist(),
+                        node_sids.tolist(), repeat(date))
+                )
+                print(f'Adding {len(src)} edges to database')
+                cursor.executemany(
+                    "INSERT INTO edges (src, dst, creator, date) VALUES (?, ?, 'seger', ?)",
+                    zip(src.tolist(), dst.tolist(), repeat(date))
+                )
+
+                # what the dropped triggers would have written, new rows are the ones above max_nid
+                cursor.execute(
+                    "INSERT INTO changelog (tbl, op, key1) SELECT 'nodes', 'insert', nid FROM nodes WHERE nid > ? ORDER BY nid",
+                    (max_nid,)
+                )
+                cursor.execute(
+                    "INSERT INTO changelog (tbl, op, key1, key2) SELECT 'edges', 'insert', src, dst FROM edges WHERE src > ? ORDER BY rowid",
+                    (max_nid,)
+                )
+                if defer_indexes:
+                    cursor.execute("INSERT INTO nodes_rtree SELECT nid, x, x, y, y, z, z FROM nodes WHERE nid > ?", (max_nid,))
+                    for sql in SECONDARY_INDEX_SQL.values():
+                        cursor.execute(sql)
+                for sql in SPATIAL_INDEX_SQL + CHANGELOG_SQL:
+                    cursor.execute(sql)
+        except Exception as e:
+            print(f"Error in segs2db: {e}")
+            raise e
+        finally:
+            for key, value in saved_pragmas.items():
+                conn.execute(f"PRAGMA {key}={value}")
+
+        nodes = {'nid': nids, 'x': coords[:, 0], 'y': coords[:, 1], 'z': coords[:, 2], 'sid': node_sids}
+        edges = {'src': src, 'dst': dst}
+        return nodes, edges
     
     @staticmethod
     def upgrade_database_schema(db_path):
@@ -533,9 +1027,63 @@ class sqliteDBIO:
             return False
         
         try:
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_nodes_nid ON nodes (nid)")
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_edges_src ON edges (src)")
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_edges_dst ON edges (dst)")
+            for sql in SECONDARY_INDEX_SQL.values():
+                cursor.execute(sql)
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            conn.close()
+            return False
+
+        try:
+            # segs stored as str(list) text are re-encoded as packed binary, once per database
+            cursor.execute("PRAGMA user_version")
+            user_version = cursor.fetchone()[0]
+            cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='segs'")
+            if user_version < 1 and cursor.fetchone() is not None:
+                cursor.execute("SELECT sid FROM segs WHERE substr(points, 1, 4) != ? OR substr(sampled_points, 1, 4) != ?", (b'NDBP', b'NDBP'))
+                sids = [row[0] for row in cursor.fetchall()]
+                if sids:
+                    print(f"Converting {len(sids)} segs to packed binary points")
+                for i in range(0, len(sids), MAX_QUERY_PARAMS):
+                    chunk = sids[i:i+MAX_QUERY_PARAMS]
+                    placeholders = ','.join('?' for _ in chunk)
+                    cursor.execute(f"SELECT sid, points, sampled_points FROM segs WHERE sid IN ({placeholders})", chunk)
+                    entries = []
+                    for row in cursor.fetchall():
+                        entries.append((
+                            row['points'] if is_packed(row['points']) else sqlite3.Binary(encode_points(decode_points(row['points']))),
+                            row['sampled_points'] if is_packed(row['sampled_points']) else sqlite3.Binary(encode_points(decode_points(row['sampled_points']))),
+                            row['sid']
+                        ))
+                    cursor.executemany("UPDATE segs SET points = ?, sampled_points = ? WHERE sid = ?", entries)
+            if user_version < SCHEMA_VERSION:
+                cursor.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            conn.close()
+            return False
+
+        try:
+            cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='nodes_rtree'")
+            rtree_exists = cursor.fetchone() is not None
+            if not rtree_exists:
+                print("Building spatial index for nodes")
+            for sql in SPATIAL_INDEX_SQL:
+                cursor.execute(sql)
+            if not rtree_exists:
+                cursor.execute("INSERT INTO nodes_rtree SELECT nid, x, x, y, y, z, z FROM nodes")
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            conn.close()
+            return False
+
+        try:
+            # changes made before the changelog existed are covered by a full graph load
+            for sql in CHANGELOG_SQL:
+                cursor.execute(sql)
             conn.commit()
         except Exception as e:
             conn.rollback()
@@ -546,7 +1094,7 @@ class sqliteDBIO:
         return True
 
     def inspect_database(self):
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         
         print("\n==== DATABASE INSPECTION ====")
@@ -584,5 +1132,4 @@ class sqliteDBIO:
             print(f"  Total records: {row_count}")
         
         print("==== ==== ==== ==== ==== ====\n")
-        conn.close()
     
\ No newline at end of file